@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+import numpy as np
 
 
 class Agent(ABC):
@@ -23,3 +24,82 @@ class FaultyAgent(Agent):
 	def update_state(self, new_state):
 		# This agent does not update it's state
 		return
+
+
+# The behaviour of each agent in an AgentStore
+HONEST = 0
+FAULTY = 1
+CUSTOM = 2
+
+# Agent classes that an AgentStore can represent with a behaviour alone, any other agent is kept as a custom agent
+AGENT_BEHAVIOURS = {
+	HonestAgent: HONEST,
+	FaultyAgent: FAULTY
+}
+
+
+# The agents of a network, stored as an array of states and an array of behaviours rather than an object per agent
+# Honest agents take the state they are given and faulty agents never update, so many agents can be updated at once
+# with a masked write. Any other Agent subclass is kept as a custom agent, and updated through its update_state method
+# Each agent costs 5 bytes (plus the custom agents), rather than an object per agent
+class AgentStore:
+	def __init__(self, states, behaviours=None, custom_agents=None):
+		# states is the state of every agent, behaviours is the behaviour of every agent (all honest if not given)
+		# custom_agents is a dictionary of index -> Agent of the agents with the custom behaviour
+		self.states = np.array(states, dtype=np.int32)
+
+		if behaviours is None:
+			self.behaviours = np.full(len(self.states), HONEST, dtype=np.uint8)
+		else:
+			self.behaviours = np.array(behaviours, dtype=np.uint8)
+
+		self.custom_agents = custom_agents if custom_agents is not None else {}
+
+		# Whether each agent takes the state it is given
+		self.honest = self.behaviours == HONEST
+
+	@classmethod
+	def from_agents(cls, agents):
+		# Creates a store from a list of Agent objects
+		behaviours = [AGENT_BEHAVIOURS.get(type(agent), CUSTOM) for agent in agents]
+		custom_agents = {i: agent for i, agent in enumerate(agents) if behaviours[i] == CUSTOM}
+		return cls([agent.state for agent in agents], behaviours, custom_agents)
+
+	def __len__(self):
+		return len(self.states)
+
+	def __getitem__(self, node):
+		# The agent of a node, honest and faulty agents are not stored as objects so a copy of them is returned
+		if node in self.custom_agents:
+			return self.custom_agents[node]
+
+		agent_class = HonestAgent if self.behaviours[node] == HONEST else FaultyAgent
+		return agent_class(int(self.states[node]))
+
+	def has_custom_agents(self):
+		return len(self.custom_agents) > 0
+
+	def update(self, node, new_state):
+		# Updates an agent using its behaviour, returning its state afterwards
+		behaviour = self.behaviours[node]
+		if behaviour == HONEST:
+			self.states[node] = new_state
+		elif behaviour == CUSTOM:
+			agent = self.custom_agents[node]
+			agent.update_state(new_state)
+			self.states[node] = agent.state
+
+		return int(self.states[node])
+
+	def update_many(self, indices, new_states):
+		# Updates many agents at once given arrays of their indices and new states, returning their states afterwards
+		honest = self.honest[indices]
+		self.states[indices[honest]] = new_states[honest]
+
+		# Only the custom agents among the indices are updated one at a time
+		if self.has_custom_agents():
+			custom = np.flatnonzero(self.behaviours[indices] == CUSTOM)
+			for node, new_state in zip(indices[custom].tolist(), new_states[custom].tolist()):
+				self.update(node, new_state)
+
+		return self.states[indices]
@@ -1,23 +1,434 @@
+import collections
+import json
 import math
 from abc import ABC, abstractmethod
-import matplotlib.pyplot as plt
-from agents import HonestAgent, FaultyAgent
-from network import PopulationNetwork
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from network import PopulationNetwork, as_seed_sequence
 from protocols import NMajorityProtocol
+from results import create_result_writer
+from cache import ResultCache, hash_key, key_words, topology_key
+
+# Trials are split into chunks of this size, each with its own random stream. The chunks do not depend on
+# the number of workers, so results are the same however many workers are used
+TRIAL_CHUNK_SIZE = 16
+
+# With several workers, the chunks of the data points an analysis will run next are submitted to the pool ahead of
+# time (see Analyser.prefetch), so the workers are kept busy across points. At most this many chunks per worker wait
+PREFETCH_CHUNKS_PER_WORKER = 4
+
+# Confidence intervals are shown at this level, z is the matching standard normal quantile
+CONFIDENCE_LEVEL = 0.95
+CONFIDENCE_Z = 1.959964
+
+# The adaptive bias search starts from this many evenly spaced biases, and only bisects the gap between two
+# biases if the probability of convergence changes by more than the resolution
+ADAPTIVE_INITIAL_BIASES = 9
+ADAPTIVE_RESOLUTION = 0.02
+
+# Default minimum number of repetitions of a data point when using a stopping rule
+MIN_REPETITIONS = 10
+
+# Networks on sparse topologies can lock into patterns that never converge (e.g stripes on a grid), so unless a
+# maximum is given their trials are stopped after this many rounds and count as not converging
+SPARSE_TOPOLOGY_MAX_ROUNDS = 10000
+
+
+def wilson_interval(successes, trials, z=CONFIDENCE_Z):
+	# The Wilson score confidence interval of a binomial proportion, returns arrays of the lower and upper bounds
+	successes = np.asarray(successes, dtype=np.float64)
+	proportion = successes / trials
+	centre = (proportion + z ** 2 / (2 * trials)) / (1 + z ** 2 / trials)
+	half_width = z * np.sqrt(proportion * (1 - proportion) / trials + z ** 2 / (4 * trials ** 2)) / (1 + z ** 2 / trials)
+
+	# The bounds are within [0, 1] other than rounding errors (e.g an upper bound of 1.0000000000000002)
+	return np.clip(centre - half_width, 0, 1), np.clip(centre + half_width, 0, 1)
+
+
+def mean_interval(samples, z=CONFIDENCE_Z):
+	# The mean of the samples and the half width of its (normal approximation) confidence interval
+	samples = np.asarray(samples, dtype=np.float64)
+	if len(samples) < 2:
+		return samples.mean() if len(samples) > 0 else math.nan, math.inf
+
+	return samples.mean(), z * samples.std(ddof=1) / math.sqrt(len(samples))
+
+
+# Decides when enough repetitions of a data point have been run, once the confidence interval of the mean is
+# narrower than ci_width, or its half width is within relative_error of the mean (if both are given, both must be met)
+# Repetitions always stop at max_repetitions, which defaults to the number of rounds of the analyser
+class StoppingRule:
+	def __init__(self, ci_width=None, relative_error=None, min_repetitions=MIN_REPETITIONS, max_repetitions=None):
+		if ci_width is None and relative_error is None:
+			raise ValueError("A stopping rule requires a confidence interval width or relative error")
+
+		self.ci_width = ci_width
+		self.relative_error = relative_error
+		self.min_repetitions = min_repetitions
+		self.max_repetitions = max_repetitions
+
+	def is_satisfied(self, samples):
+		if len(samples) < self.min_repetitions:
+			return False
+
+		mean, half_width = mean_interval(samples)
+		if self.ci_width is not None and 2 * half_width > self.ci_width:
+			return False
+
+		if self.relative_error is not None and half_width > self.relative_error * abs(mean):
+			return False
+
+		return True
+
+	def estimate_repetitions(self, samples):
+		# Estimates the total number of repetitions needed to satisfy the rule, as the half width of the
+		# interval shrinks with the square root of the repetitions
+		if len(samples) < max(2, self.min_repetitions):
+			return max(2, self.min_repetitions)
+
+		mean, half_width = mean_interval(samples)
+		targets = []
+		if self.ci_width is not None:
+			targets.append(self.ci_width / 2)
+
+		if self.relative_error is not None:
+			targets.append(self.relative_error * abs(mean))
+
+		target = min(targets)
+		if target <= 0:
+			return math.inf
+
+		return math.ceil(len(samples) * (half_width / target) ** 2)
+
+
+def show_figure(f):
+	# Shows a figure without blocking. With a non-interactive backend (e.g when figures are only saved) the
+	# figure cannot be shown, so it is just kept open
+	with warnings.catch_warnings():
+		warnings.filterwarnings("ignore", message=".*non-interactive.*")
+		f.show()
+
+
+def plot_average_rounds(x, samples, xlabel, title, show_repetitions=False):
+	# Plots the average number of rounds until convergence of each data point with its confidence interval
+	# samples is a list of the arrays of convergence rounds of each point, the number of repetitions
+	# of each point is plotted on a second axis if show_repetitions is set
+	intervals = [mean_interval(point_samples) for point_samples in samples]
+	y_avg_rounds = np.array([mean for mean, _ in intervals])
+	half_widths = np.array([half_width if math.isfinite(half_width) else 0 for _, half_width in intervals])
+
+	# pyplot is only imported once something is plotted, so simulations can run without loading it
+	import matplotlib.pyplot as plt
+	f = plt.figure()
+	plt.plot(x, y_avg_rounds)
+	plt.fill_between(x, y_avg_rounds - half_widths, y_avg_rounds + half_widths, alpha=0.3, label=f"{CONFIDENCE_LEVEL:.0%} confidence interval")
+	plt.legend(loc="upper left")
+
+	plt.xlabel(xlabel)
+	plt.ylabel("Average number of rounds until convergence")
+	plt.title(title)
+
+	if show_repetitions:
+		repetitions_axis = plt.gca().twinx()
+		repetitions_axis.plot(x, [len(point_samples) for point_samples in samples], color="grey", linestyle="--", label="Repetitions")
+		repetitions_axis.set_ylabel("Repetitions")
+		repetitions_axis.set_ylim(bottom=0)
+		repetitions_axis.legend(loc="upper right")
+
+	show_figure(f)
+
+
+def converged_trials(rounds, winners):
+	# The rounds of the trials that converged, and the number of trials that did not (these have a winner of -1, e.g
+	# mean-field networks that reach a fixed point)
+	converged = winners >= 0
+	return rounds[converged], int(np.count_nonzero(~converged))
+
+
+def warn_non_converged(non_converged, trials, consequence):
+	# Warns that some trials of a data point did not converge, and how the point treats them
+	if non_converged > 0:
+		print(f"Warning: {non_converged} of {trials} networks did not converge, {consequence}")
+
+
+def average_rounds_point(convergence_rounds, non_converged=0):
+	# The values written for a data point of the average number of rounds until convergence
+	# Only the networks that converged are averaged, the number that did not is written alongside
+	mean, half_width = mean_interval(convergence_rounds)
+	return {
+		"repetitions": len(convergence_rounds) + non_converged,
+		"non_converged": non_converged,
+		"average_rounds": mean,
+		"confidence_half_width": half_width
+	}
+
+
+def run_trial_chunk(engine, protocol, trials, state_config, faulty_config, seed, scheduler, topology, max_rounds):
+	# Runs a chunk of trials with its own random generator, this is run by worker processes
+	return engine.run_trials(protocol, trials, state_config, faulty_config, np.random.default_rng(seed), scheduler, topology, max_rounds)
 
 
 class Analyser(ABC):
-	def __init__(self, nodes, states, state_config, protocol, rounds):
+	def __init__(self, nodes, states, state_config, protocol, rounds, engine=PopulationNetwork, workers=1, scheduler="synchronous", topology=None, adaptive=False, stopping_rule=None, seed=None, output=None, plot=True, cache=None, checkpoint=None, max_rounds=None):
 		self.nodes = nodes
 		self.states = states
 		self.state_config = state_config
 		self.protocol = protocol
 		self.rounds = rounds
 
+		# The network class used to run simulations, e.g PopulationNetwork or CountNetwork
+		# the name of the scheduler its networks use, and their topology (complete if None)
+		self.engine = engine
+		self.scheduler = scheduler
+		self.topology = topology
+
+		# Networks that have not converged after max_rounds rounds are stopped and count as not converging (None for no
+		# limit), networks on sparse topologies are always limited
+		if max_rounds is None and topology is not None and not topology.is_complete():
+			max_rounds = SPARSE_TOPOLOGY_MAX_ROUNDS
+
+		self.max_rounds = max_rounds
+
+		# Whether analysers that sweep a parameter search it adaptively instead of running every value
+		self.adaptive = adaptive
+
+		# Optional StoppingRule, the analysers that average over repetitions stop each point once it is satisfied
+		# instead of always running self.rounds repetitions
+		self.stopping_rule = stopping_rule
+
+		# Number of worker processes the trials are spread across, the pool is created when first needed
+		self.workers = workers
+		self.executor = None
+
+		# Chunks submitted to the pool ahead of their point being run, point hash -> [end, deque of (start, size, future)]
+		# where end is the index after the last trial submitted
+		self.prefetched = {}
+
+		# Every chunk of trials gets an independent random stream spawned from this, so an analysis is
+		# reproducible given the same seed (a random seed is used if None)
+		self.seed_sequence = as_seed_sequence(seed)
+
+		# The file the data points of the analysis are written to as they are run (see results.py), or None
+		# and whether the results are plotted once the analysis finishes
+		self.output = output
+		self.plot = plot
+
+		# The trials of every data point that has been run (see cache.py), kept in memory if there is no cache directory
+		self.cache = cache if cache is not None else ResultCache()
+
+		# The Checkpoint the trials run so far are periodically saved to, or None
+		self.checkpoint = checkpoint
+
+		# The results file of the running analysis, for analysers that write points from several methods
+		self.results = create_result_writer(None, [])
+
 	@abstractmethod
 	def analyse(self):
 		pass
 
+	def get_metadata(self):
+		# Describes the analysis, written alongside its results
+		return {
+			"analyser": type(self).__name__,
+			"nodes": self.nodes,
+			"states": self.states,
+			"state_config": self.state_config,
+			"protocol": self.protocol.get_protocol_name() if self.protocol is not None else None,
+			"rounds": self.rounds,
+			"engine": self.engine.__name__,
+			"scheduler": self.scheduler,
+			"topology": type(self.topology).__name__ if self.topology is not None else "CompleteTopology",
+			"max_rounds": self.max_rounds,
+			"adaptive": self.adaptive,
+			"stopping_rule": vars(self.stopping_rule) if self.stopping_rule is not None else None,
+			"seed": self.seed_sequence.entropy
+		}
+
+	def open_results(self, columns):
+		# Opens the results file of the analysis, with the given columns of each data point
+		# Nothing is written if the analysis has no output file
+		return create_result_writer(self.output, columns, self.get_metadata())
+
+	def point_key(self, protocol, state_config, faulty_config=None):
+		# Describes a data point, its trials are cached by this key and seeded from it (with the seed of the analysis)
+		return {
+			"protocol": protocol.get_protocol_name(),
+			"protocol_parameters": vars(protocol),
+			"state_config": [int(count) for count in state_config],
+			"faulty_config": [int(count) for count in faulty_config] if faulty_config is not None else None,
+			"engine": self.engine.__name__,
+			"scheduler": self.scheduler,
+			"topology": topology_key(self.topology),
+			"max_rounds": self.max_rounds,
+			"seed": [self.seed_sequence.entropy, list(self.seed_sequence.spawn_key)]
+		}
+
+	def point_seed(self, key, start):
+		# The seed of the chunk of trials of a data point starting at the trial with index start. Points are seeded by
+		# their key rather than the order they are run in, so the same point always runs the same trials
+		return np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=self.seed_sequence.spawn_key + key_words(key) + (start,))
+
+	def run_trials(self, protocol, state_config, faulty_config=None, trials=None):
+		# Returns the first trials (self.rounds by default) trials of the data point with the given configuration, where
+		# each trial runs a network until it converges. Trials already in the cache are reused, and only the missing trials are run
+		# Returns arrays of the number of rounds and the winning state of each network
+		if trials is None:
+			trials = self.rounds
+
+		key = self.point_key(protocol, state_config, faulty_config)
+		cached = self.cache.get(key)
+		if cached is not None and len(cached[0]) >= trials:
+			return cached[0][:trials], cached[1][:trials]
+
+		rounds, winners = cached if cached is not None else (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+		for chunk_rounds, chunk_winners in self.run_new_trials(protocol, state_config, faulty_config, key, len(rounds), trials - len(rounds)):
+			rounds = np.concatenate([rounds, chunk_rounds])
+			winners = np.concatenate([winners, chunk_winners])
+
+			# Keep the trials of the point run so far, so a checkpoint includes them if the analysis is stopped
+			self.cache.put(key, rounds, winners, persist=False)
+			self.save_checkpoint()
+
+		self.cache.put(key, rounds, winners)
+		return rounds, winners
+
+	def run_new_trials(self, protocol, state_config, faulty_config, key, start, trials):
+		# Runs trials independent networks with the given configuration until they converge, yielding the rounds and
+		# winners of each chunk of trials in order. Each chunk is seeded by the point and the index of its first trial
+		# (from start), so a point's trials are the same however many times it is stopped and continued
+		chunks = self.chunk_plan(key, start, trials)
+
+		# Chunks already submitted by prefetch are used if they are the chunks planned here, any others are cancelled
+		_, prefetched = self.prefetched.pop(hash_key(key), (None, collections.deque()))
+		futures = []
+		while len(futures) < len(chunks) and len(prefetched) > 0 and prefetched[0][:2] == chunks[len(futures)][:2]:
+			futures.append(prefetched.popleft()[2])
+
+		for _, _, future in prefetched:
+			future.cancel()
+
+		remaining = chunks[len(futures):]
+		if self.workers > 1:
+			futures += [self.get_executor().submit(run_trial_chunk, *self.chunk_args(protocol, state_config, faulty_config, size, seed))
+						for _, size, seed in remaining]
+			return (future.result() for future in futures)
+
+		return (run_trial_chunk(*self.chunk_args(protocol, state_config, faulty_config, size, seed)) for _, size, seed in remaining)
+
+	def chunk_plan(self, key, start, trials):
+		# The (start, size, seed) of each chunk of trials run for a data point, from the trial with index start
+		return [(chunk_start, min(TRIAL_CHUNK_SIZE, start + trials - chunk_start), self.point_seed(key, chunk_start))
+				for chunk_start in range(start, start + trials, TRIAL_CHUNK_SIZE)]
+
+	def chunk_args(self, protocol, state_config, faulty_config, size, seed):
+		# The arguments of run_trial_chunk for a chunk of trials
+		return self.engine, protocol, size, state_config, faulty_config, seed, self.scheduler, self.topology, self.max_rounds
+
+	def get_executor(self):
+		if self.executor is None:
+			self.executor = ProcessPoolExecutor(self.workers)
+
+		return self.executor
+
+	def prefetch(self, points):
+		# Submits the chunks of the data points the analysis will run next to the worker pool, so workers are not left
+		# idle while a point waits for its last chunks. points are (protocol, state_config, faulty_config, trials) in the
+		# order they will be run, the point about to be run first. Chunks are submitted until PREFETCH_CHUNKS_PER_WORKER
+		# chunks per worker are waiting. Chunks are planned and seeded as run_trials would run them, so prefetching does
+		# not change the results
+		if self.workers <= 1:
+			return
+
+		waiting = sum(len(chunks) for _, chunks in self.prefetched.values())
+		for protocol, state_config, faulty_config, trials in points:
+			if waiting >= PREFETCH_CHUNKS_PER_WORKER * self.workers:
+				return
+
+			key = self.point_key(protocol, state_config, faulty_config)
+			key_hash = hash_key(key)
+			if key_hash not in self.prefetched:
+				cached = self.cache.get(key)
+				self.prefetched[key_hash] = [len(cached[0]) if cached is not None else 0, collections.deque()]
+
+			entry = self.prefetched[key_hash]
+			for chunk_start, size, seed in self.chunk_plan(key, entry[0], trials - entry[0]):
+				if waiting >= PREFETCH_CHUNKS_PER_WORKER * self.workers:
+					return
+
+				future = self.get_executor().submit(run_trial_chunk, *self.chunk_args(protocol, state_config, faulty_config, size, seed))
+				entry[1].append((chunk_start, size, future))
+				entry[0] = chunk_start + size
+				waiting += 1
+
+	def first_batch(self):
+		# The number of trials run_repetitions first runs of each data point
+		if self.stopping_rule is None:
+			return self.rounds
+
+		max_repetitions = self.stopping_rule.max_repetitions if self.stopping_rule.max_repetitions is not None else self.rounds
+		return min(max(self.stopping_rule.estimate_repetitions([]), TRIAL_CHUNK_SIZE), max_repetitions)
+
+	def run_repetitions(self, protocol, state_config, faulty_config=None):
+		# Runs networks with the given configuration until they converge, returning the number of rounds of each
+		# network that converged and the number of networks that did not (which are left out of the rounds)
+		# Without a stopping rule this is self.rounds networks, otherwise networks are run in batches until the rule
+		# is satisfied, each batch sized by the rule's estimate of the repetitions still needed
+		if self.stopping_rule is None:
+			convergence_rounds, non_converged = converged_trials(*self.run_trials(protocol, state_config, faulty_config))
+			warn_non_converged(non_converged, self.rounds, "they are left out of the average")
+			return convergence_rounds, non_converged
+
+		max_repetitions = self.stopping_rule.max_repetitions
+		if max_repetitions is None:
+			max_repetitions = self.rounds
+
+		convergence_rounds, non_converged = np.zeros(0, dtype=np.int64), 0
+		while len(convergence_rounds) + non_converged < max_repetitions and not self.stopping_rule.is_satisfied(convergence_rounds):
+			trials_run = len(convergence_rounds) + non_converged
+			needed = self.stopping_rule.estimate_repetitions(convergence_rounds) - len(convergence_rounds)
+			trials = min(max(needed, TRIAL_CHUNK_SIZE), max_repetitions - trials_run)
+
+			# The trials already run are kept by the cache, so only the new batch is run
+			convergence_rounds, non_converged = converged_trials(*self.run_trials(protocol, state_config, faulty_config, trials_run + trials))
+
+		warn_non_converged(non_converged, len(convergence_rounds) + non_converged, "they are left out of the average")
+		return convergence_rounds, non_converged
+
+	def save_checkpoint(self, force=False):
+		# Saves the trials of every point run so far to the checkpoint, if the checkpoint interval has passed (or force is set)
+		if self.checkpoint is not None and (force or self.checkpoint.is_due()):
+			self.checkpoint.save(self.get_checkpoint_metadata(), self.cache.points)
+
+	def get_checkpoint_metadata(self):
+		# The description of the analysis saved with a checkpoint, normalised as it is loaded from JSON
+		return json.loads(json.dumps(self.get_metadata()))
+
+	def resume(self):
+		# Loads the trials saved by the checkpoint, so only the trials that were not run are run again
+		# Returns the number of points loaded
+		metadata, points = self.checkpoint.load()
+		if metadata != self.get_checkpoint_metadata():
+			changed = [name for name in metadata if metadata.get(name) != self.get_checkpoint_metadata().get(name)]
+			raise ValueError(f"The checkpoint was saved by a different analysis (differs in {', '.join(changed)})")
+
+		self.cache.points.update(points)
+		return len(points)
+
+	def close(self):
+		# Saves a final checkpoint and shuts down any worker processes
+		self.save_checkpoint(force=True)
+
+		for _, chunks in self.prefetched.values():
+			for _, _, future in chunks:
+				future.cancel()
+
+		self.prefetched = {}
+
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
 	# Override this method to display info about the analyser
 	@staticmethod
 	def info():
@@ -27,17 +438,20 @@ class Analyser(ABC):
 def basic_analysis(data, state_colours=None):
 	# A basic analyser that takes a round of data logs and produces a
 	# plot of each state in the network against the
+	# data is the trajectory of a network, read the state counts of every round
+	round_counts = {rnd: data.get_counts(rnd) for rnd in data.keys()}
 
 	# X value will show the round number
 	x = list(data.keys())
 
-	initial_states = list(set(data.get(0, [])))
+	initial_states = list(round_counts.get(0, {}).keys())
 
+	import matplotlib.pyplot as plt
 	f = plt.figure()
 	for state in initial_states:
 		y = []
 		for rnd in data.keys():
-			count = data.get(rnd).count(state)
+			count = round_counts.get(rnd).get(state, 0)
 			y.append(count)
 
 		line, = plt.plot(x, y)
@@ -59,7 +473,7 @@ def basic_analysis(data, state_colours=None):
 	plt.xlabel("Round number")
 	plt.ylabel("Node count")
 	plt.title('States in network')
-	f.show()
+	show_figure(f)
 
 
 # A basic analyser that just runs 1 round, and outputs the
@@ -78,19 +492,33 @@ class BasicAnalyser(Analyser):
 			print("Error: Please specify the protocol to run")
 			return
 
-		network = PopulationNetwork.network_from_configuration(self.nodes, self.states, self.protocol, self.state_config)
-		while not network.has_converged():
+		network = self.engine.network_from_configuration(self.nodes, self.states, self.protocol, self.state_config, scheduler=self.scheduler, topology=self.topology, seed=self.seed_sequence.spawn(1)[0])
+		while not network.is_finished() and (self.max_rounds is None or network.round <= self.max_rounds):
 			network.run_round()
 
+		# The mean-field engine stops at a fixed point or after MEAN_FIELD_MAX_ROUNDS rounds without converging, and
+		# any network is stopped after max_rounds
+		if not network.has_converged():
+			print(f"Warning: The network did not converge, it was stopped on round {network.round - 1}")
+
 		# print(f"Finished, network converged on round {network.round - 1}")
-		basic_analysis(network.data)
+		# Write the number of nodes in each state of every round
+		states = range(self.states)
+		with self.open_results(["round"] + [f"state_{state}" for state in states]) as results:
+			for rnd in network.data.keys():
+				counts = network.data.get_counts(rnd)
+				results.write_point(dict({"round": rnd}, **{f"state_{state}": counts.get(state, 0) for state in states}))
+
+		if self.plot:
+			basic_analysis(network.data)
 
 	@staticmethod
 	def info():
 		return "A basic analyser showing the number of nodes in each state over each round"
 
 
-# An analyser that slowly increases the bias and plots a graph of the frequencies over time
+# An analyser that increases the bias and plots the probability of state 0 winning against the bias
+# The bias is either swept one step at a time, or searched adaptively (see adaptive_search)
 class BiasAnalyser(Analyser):
 	def analyse(self):
 		if self.rounds < 100:
@@ -102,52 +530,103 @@ class BiasAnalyser(Analyser):
 
 		# We have 2 states, and start with a bias of 0 or 1 (depending on if the number of nodes is odd or even)
 		state_0_initial_count = int(self.nodes / 2)
-		bias = 0
-
-		# We analyse the probability of state 0 winning
-		# against the bias
-		x_bias = []
-		y_prob = []
-		while bias + state_0_initial_count <= self.nodes:
-			print(f"Running with bias {bias}/{self.nodes - state_0_initial_count}")
-			# Run the network and check the final counts
-			state_0_count = bias + state_0_initial_count
-			state_1_count = self.nodes - state_0_count
-			states_config = [state_0_count, state_1_count]
-
-			# Run this network with the specified number of rounds
-			state_0_win_count = 0
-
-			for i in range(self.rounds):
-				network = PopulationNetwork.network_from_configuration(self.nodes, 2, self.protocol, states_config)
-
-				while not network.has_converged():
-					network.run_round()
-
-				# Now check the final configuration, as network has converged
-				last_round = max(network.data)
-				last_round_states = network.data.get(last_round)
-
-				if last_round_states[0] == 0:
-					state_0_win_count += 1
-
-			# Once all the rounds have run, we can this data to out plot
-			x_bias.append(bias)
+		max_bias = self.nodes - state_0_initial_count
+
+		# We analyse the probability of state 0 winning against the bias
+		# Number of networks state 0 won for each bias run
+		win_counts = {}
+		with self.open_results(["bias", "state_0_count", "trials", "wins", "non_converged", "probability", "lower", "upper"]) as self.results:
+			if self.adaptive:
+				# The search runs biases out of order, so its points are written sorted by bias once it has finished
+				points = self.adaptive_search(win_counts, state_0_initial_count, max_bias)
+				for bias in sorted(points):
+					self.results.write_point(points[bias])
+			else:
+				for bias in range(max_bias + 1):
+					self.prefetch_biases(state_0_initial_count, range(bias, max_bias + 1))
+					point = self.run_bias(state_0_initial_count, bias, max_bias)
+					win_counts[bias] = point["wins"]
+					self.results.write_point(point)
+
+		if not self.plot:
+			return
 
-			# Calculate probability of state 0 winning as the number of times it won
-			prob_state_0_wins = state_0_win_count / self.rounds
-			y_prob.append(prob_state_0_wins)
+		x_bias = sorted(win_counts)
 
-			bias += 1
+		# Calculate probability of state 0 winning as the number of times it won, with its confidence interval
+		y_prob = np.array([win_counts[bias] / self.rounds for bias in x_bias])
+		lower, upper = wilson_interval(np.array([win_counts[bias] for bias in x_bias]), self.rounds)
 
 		# Plot the data and show it
+		import matplotlib.pyplot as plt
 		f = plt.figure()
-		plt.plot(x_bias, y_prob)
+		plt.plot(x_bias, y_prob, marker="." if self.adaptive else None)
+		plt.fill_between(x_bias, lower, upper, alpha=0.3, label=f"{CONFIDENCE_LEVEL:.0%} confidence interval")
+		plt.legend()
 
 		plt.xlabel("Bias")
 		plt.ylabel(f"Convergence frequency with {self.rounds} rounds")
-		plt.title(f"Frequency of convergence as bias increases with {self.nodes} nodes and 2 states, using {self.protocol.get_protocol_name()} protocol")
-		f.show()
+		plt.title(f"Frequency of convergence as bias increases with {self.nodes} nodes and 2 states, using {self.protocol.get_protocol_name()} protocol"
+				+ (f"\n({len(x_bias)}/{max_bias + 1} biases run adaptively)" if self.adaptive else ""))
+		show_figure(f)
+
+	def run_bias(self, state_0_initial_count, bias, max_bias):
+		# Runs self.rounds networks with the given bias towards state 0, returning the data point of the bias
+		# (including wins, how many state 0 won)
+		print(f"Running with bias {bias}/{max_bias}")
+		state_config = self.bias_config(state_0_initial_count, bias)
+		state_0_count = state_config[0]
+
+		# Run this network with the specified number of rounds, and check which state each network converged to
+		_, winners = self.run_trials(self.protocol, state_config)
+		wins = np.count_nonzero(winners == 0)
+
+		# Networks that did not converge are not wins for state 0
+		non_converged = np.count_nonzero(winners < 0)
+		warn_non_converged(non_converged, self.rounds, "they are counted as state 0 not winning")
+
+		lower, upper = wilson_interval(wins, self.rounds)
+		return {"bias": bias, "state_0_count": state_0_count, "trials": self.rounds, "wins": wins,
+				"non_converged": non_converged, "probability": wins / self.rounds, "lower": lower, "upper": upper}
+
+	def bias_config(self, state_0_initial_count, bias):
+		# The state configuration of a network with the given bias towards state 0
+		state_0_count = bias + state_0_initial_count
+		return [state_0_count, self.nodes - state_0_count]
+
+	def prefetch_biases(self, state_0_initial_count, biases):
+		# Submits the trials of the biases about to be run to the worker pool (see Analyser.prefetch)
+		self.prefetch((self.protocol, self.bias_config(state_0_initial_count, bias), None, self.rounds) for bias in biases)
+
+	def adaptive_search(self, win_counts, state_0_initial_count, max_bias):
+		# The win probability only changes in a narrow region of biases, below it is flat (around 0.5) and
+		# above it is 1. Starting from a coarse grid of biases, every gap between neighbouring biases where the
+		# probability changes significantly (their confidence intervals do not overlap) is bisected, until the
+		# gaps are 1 bias wide. So biases are only run densely where the probability is changing
+		# Returns a dictionary of bias -> data point of every bias run
+		biases = np.unique(np.linspace(0, max_bias, ADAPTIVE_INITIAL_BIASES).round().astype(int))
+		new_biases = biases.tolist()
+		points = {}
+
+		while len(new_biases) > 0:
+			for i, bias in enumerate(new_biases):
+				self.prefetch_biases(state_0_initial_count, new_biases[i:])
+				points[bias] = self.run_bias(state_0_initial_count, bias, max_bias)
+				win_counts[bias] = points[bias]["wins"]
+
+			biases = sorted(win_counts)
+			wins = np.array([win_counts[bias] for bias in biases])
+			lower, upper = wilson_interval(wins, self.rounds)
+			change = np.diff(wins) / self.rounds
+
+			# Bisect the gaps where the probability changes by more than the confidence intervals and the resolution
+			significant = (lower[1:] > upper[:-1]) | (upper[1:] < lower[:-1])
+			significant &= np.abs(change) > ADAPTIVE_RESOLUTION
+			significant &= np.diff(biases) > 1
+
+			new_biases = [(biases[i] + biases[i + 1]) // 2 for i in np.flatnonzero(significant)]
+
+		return points
 
 	@staticmethod
 	def info():
@@ -169,40 +648,32 @@ class NMajorityAnalyser(Analyser):
 
 		# We analyse the average number of rounds til convergence for each majority protocol
 		x_majority_axis = []
-		y_avg_rounds = []
-		for n_majority in range(3, self.nodes, 2):
-			print(f"Running {n_majority} protocol")
-			# Increase n majority of protocol by 2 each time
-			protocol = NMajorityProtocol(n_majority)
-
+		samples = []
+		with self.open_results(["n", "repetitions", "non_converged", "average_rounds", "confidence_half_width"]) as results:
 			# The state of each node should be unique
 			state_config = [1] * self.nodes
 
-			total_convergence_rounds = 0
-			for i in range(self.rounds):
-				# Create and run the network
-				network = PopulationNetwork.network_from_configuration(self.nodes, self.nodes, protocol, state_config)
+			for n_majority in range(3, self.nodes, 2):
+				self.prefetch((NMajorityProtocol(n), state_config, None, self.first_batch()) for n in range(n_majority, self.nodes, 2))
 
-				while not network.has_converged():
-					network.run_round()
+				print(f"Running {n_majority} protocol")
+				# Increase n majority of protocol by 2 each time
+				protocol = NMajorityProtocol(n_majority)
 
-				number_of_rounds = len(network.data.keys())
-				total_convergence_rounds += number_of_rounds
+				# Create and run the networks, the number of rounds includes the initial configuration
+				convergence_rounds, non_converged = self.run_repetitions(protocol, state_config)
 
-			# Calculate average number of rounds until convergence for this protocol
-			avg_convergence_rounds = total_convergence_rounds / self.rounds
+				x_majority_axis.append(n_majority)
+				samples.append(convergence_rounds)
+				results.write_point(dict(average_rounds_point(convergence_rounds, non_converged), n=n_majority))
 
-			x_majority_axis.append(n_majority)
-			y_avg_rounds.append(avg_convergence_rounds)
+		if not self.plot:
+			return
 
 		# Plot data and show it
-		f = plt.figure()
-		plt.plot(x_majority_axis, y_avg_rounds)
-
-		plt.xlabel("Nodes sampled")
-		plt.ylabel("Average number of rounds until convergence")
-		plt.title(f"Average number of rounds until convergence for N-Majority protocols with {self.nodes} nodes")
-		f.show()
+		plot_average_rounds(x_majority_axis, samples, "Nodes sampled",
+							f"Average number of rounds until convergence for N-Majority protocols with {self.nodes} nodes",
+							self.stopping_rule is not None)
 
 	@staticmethod
 	def info():
@@ -225,48 +696,49 @@ class AdversarialAnalyser(Analyser):
 		# We analyse the average number of rounds til convergence for every adversary, up until
 		# all nodes are adversaries
 		x_adversary_count = []
-		y_avg_rounds = []
-
-		for adversary_count in range(2, self.nodes + 1):
-			print(f"Running adversarial analysis with {adversary_count}/{self.nodes} adversaries")
-
-			# We need a manual list of agents, since we are including faulty agents
-			agents = []
-
-			# Honest agents will be in states 0 and 1
-			honest_node_count = self.nodes - adversary_count
-			state_0_count = math.floor(honest_node_count / 2)
-			state_1_count = honest_node_count - state_0_count
-
-			agents.extend([HonestAgent(0)] * state_0_count)
-			agents.extend([HonestAgent(1)] * state_1_count)
+		samples = []
 
-			# Add faulty agents
-			agents.extend([FaultyAgent(2)] * adversary_count)
+		with self.open_results(["adversaries", "repetitions", "non_converged", "average_rounds", "confidence_half_width"]) as results:
+			for adversary_count in range(2, self.nodes + 1):
+				self.prefetch((self.protocol, *self.adversary_configs(count), self.first_batch()) for count in range(adversary_count, self.nodes + 1))
 
-			total_convergence_rounds = 0
-			for i in range(self.rounds):
-				network = PopulationNetwork(agents.copy(), self.protocol)
+				print(f"Running adversarial analysis with {adversary_count}/{self.nodes} adversaries")
+				state_config, faulty_config = self.adversary_configs(adversary_count)
 
-				while not network.has_converged():
-					network.run_round()
+				# The number of rounds includes the initial configuration
+				convergence_rounds, non_converged = self.run_repetitions(self.protocol, state_config, faulty_config)
 
-				number_rounds = len(network.data.keys())
-				total_convergence_rounds += number_rounds
+				x_adversary_count.append(adversary_count)
+				samples.append(convergence_rounds)
+				results.write_point(dict(average_rounds_point(convergence_rounds, non_converged), adversaries=adversary_count))
 
-			# Calculate average number of rounds
-			avg_convergence_rounds = total_convergence_rounds / self.rounds
-
-			x_adversary_count.append(adversary_count)
-			y_avg_rounds.append(avg_convergence_rounds)
+		if not self.plot:
+			return
 
 		# Plot data and show it
-		plt.plot(x_adversary_count, y_avg_rounds)
+		plot_average_rounds(x_adversary_count, samples, "Number of faulty nodes",
+							"Average number of rounds until convergence with faulty nodes",
+							self.stopping_rule is not None)
+
+	def adversary_configs(self, adversary_count):
+		# The state configuration of the honest agents and of the faulty agents with the given number of adversaries
+		# Honest agents will be in states 0 and 1
+		honest_node_count = self.nodes - adversary_count
+		state_0_count = math.floor(honest_node_count / 2)
+		state_1_count = honest_node_count - state_0_count
 
-		plt.xlabel("Number of faulty nodes")
-		plt.ylabel("Average number of rounds")
-		plt.title(f"Average number of rounds until convergence with faulty nodes")
+		# All faulty agents are in state 2
+		return [state_0_count, state_1_count, 0], [0, 0, adversary_count]
 
 	@staticmethod
 	def info():
 		return "An analyser that increases the number of faulty nodes, plotting the average number of rounds to convergence. "
+
+
+# Different types of analysis that can be performed name -> analyser class
+ANALYSERS = {
+	"basic": BasicAnalyser,
+	"bias": BiasAnalyser,
+	"n-majority": NMajorityAnalyser,
+	"adversarial": AdversarialAnalyser
+}
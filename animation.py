@@ -0,0 +1,158 @@
+# This file renders a simulation to an animation file (GIF or MP4) without a window, using the views of the GUI
+# The network is simulated first, then its recorded rounds are drawn off-screen (with the Agg renderer) by worker
+# processes, each drawing a chunk of consecutive rounds. Chunks are written to the file in order as they finish
+#
+# Usage:
+#	network = PopulationNetwork.network_from_configuration(50, 3, ThreeMajority(), recording=animation_recording(PopulationNetwork, 50))
+#	frames = animate(network, "run.gif", workers=4)
+
+import collections
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from network import RecordedNetwork
+from views import NetworkFrame, NODE_VIEW_LIMIT, create_view, shows_nodes, sample_nodes
+
+# Default number of rounds shown per second of animation
+DEFAULT_FPS = 10
+
+# A network is simulated for at most this many rounds, so networks that never converge can be animated
+MAX_ANIMATION_ROUNDS = 1000
+
+# Number of consecutive rounds drawn by a worker at a time, each chunk sets up its own figure and view
+FRAME_CHUNK_SIZE = 32
+
+# Size of each frame, in inches and dots per inch (800 x 400 pixels)
+FIGURE_SIZE = (10, 5)
+FIGURE_DPI = 80
+
+# Colours of the first states, later states are given random colours (as in the GUI)
+STATE_COLOUR_CYCLE = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf"]
+
+
+def animation_recording(engine, nodes):
+	# The recording mode a network needs to be animated, networks drawn node by node need the state of every node
+	return "deltas" if engine.stores_states and nodes <= NODE_VIEW_LIMIT else "counts"
+
+
+def default_state_colours(states, seed=None):
+	# A dictionary of state -> colour for the given states
+	rng = np.random.default_rng(seed)
+	return {state: STATE_COLOUR_CYCLE[state] if state < len(STATE_COLOUR_CYCLE) else f"#{rng.integers(0x1000000):06x}" for state in states}
+
+
+def render_chunk(data, topology, state_colours, sample, first_round, last_round):
+	# Draws the rounds first_round to last_round (exclusive) of a recorded trajectory, this is run by worker processes
+	# Returns a list of the frames as (height x width x 3) RGB arrays
+	from matplotlib.figure import Figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+	figure = Figure(figsize=FIGURE_SIZE, dpi=FIGURE_DPI)
+	FigureCanvasAgg(figure)
+
+	network = RecordedNetwork(data, topology=topology)
+	view = create_view(figure, network, state_colours, NetworkFrame.from_trajectory(data, first_round, sample=sample))
+
+	# The round number is drawn over the view in each frame
+	label = figure.text(0.01, 0.97, "", verticalalignment="top", animated=True)
+
+	frames = []
+	for rnd in range(first_round, last_round):
+		view.update(NetworkFrame.from_trajectory(data, rnd, sample=sample))
+		view.redraw()
+
+		label.set_text(f"Round {rnd}")
+		figure.draw_artist(label)
+		frames.append(np.asarray(figure.canvas.buffer_rgba())[..., :3].copy())
+
+	return frames
+
+
+def render_frames(data, topology, state_colours, sample, workers=1):
+	# Draws every round of a recorded trajectory, yielding the frames in order
+	# With several workers, at most two chunks per worker are drawn ahead of the frames written, to bound the memory used
+	chunks = [(data, topology, state_colours, sample, first_round, min(first_round + FRAME_CHUNK_SIZE, len(data)))
+			  for first_round in range(0, len(data), FRAME_CHUNK_SIZE)]
+
+	if workers <= 1:
+		for chunk in chunks:
+			yield from render_chunk(*chunk)
+
+		return
+
+	with ProcessPoolExecutor(workers) as executor:
+		pending = collections.deque()
+		for chunk in chunks:
+			pending.append(executor.submit(render_chunk, *chunk))
+			if len(pending) >= 2 * workers:
+				yield from pending.popleft().result()
+
+		while len(pending) > 0:
+			yield from pending.popleft().result()
+
+
+def write_gif(path, frames, fps):
+	# Writes the frames to an animated GIF, each frame reduced to its own palette of 256 colours
+	from PIL import Image
+
+	images = (Image.fromarray(frame).convert("P", palette=Image.ADAPTIVE) for frame in frames)
+	first_image = next(images)
+	first_image.save(path, save_all=True, append_images=images, duration=round(1000 / fps), loop=0)
+
+
+def write_mp4(path, frames, fps):
+	# Writes the frames to an H.264 MP4 video by piping them to ffmpeg
+	ffmpeg = shutil.which("ffmpeg")
+	if ffmpeg is None:
+		raise ValueError("Writing MP4 files requires ffmpeg, which was not found (a .gif file can be written instead)")
+
+	process = None
+	try:
+		for frame in frames:
+			if process is None:
+				height, width, _ = frame.shape
+				process = subprocess.Popen([ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+											"-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+											"-vcodec", "libx264", "-pix_fmt", "yuv420p", path], stdin=subprocess.PIPE)
+
+			process.stdin.write(frame.tobytes())
+	finally:
+		if process is not None:
+			process.stdin.close()
+			process.wait()
+
+	if process is not None and process.returncode != 0:
+		raise ValueError(f"ffmpeg failed to write {path}")
+
+
+# Animation formats file extension -> function writing the frames to a file
+ANIMATION_FORMATS = {
+	"gif": write_gif,
+	"mp4": write_mp4
+}
+
+
+def animation_format(path):
+	# The format of an animation file given its path, from its extension
+	extension = os.path.splitext(path)[1].lstrip(".").lower()
+	if extension not in ANIMATION_FORMATS:
+		raise ValueError(f"Unknown animation format .{extension}, expected one of {', '.join('.' + name for name in ANIMATION_FORMATS)}")
+
+	return extension
+
+
+def animate(network, path, fps=DEFAULT_FPS, workers=1, max_rounds=MAX_ANIMATION_ROUNDS, seed=None):
+	# Runs a network until it finishes (see PopulationNetwork.is_finished) or for max_rounds rounds, and writes every round to an animation file
+	# The network must record its rounds as given by animation_recording. Returns the number of frames written
+	while not network.is_finished() and network.round <= max_rounds:
+		network.run_round()
+
+	data = network.data
+	recorded = RecordedNetwork(data, topology=getattr(network, "topology", None))
+	state_colours = default_state_colours(data.get_counts(0), seed)
+	sample = None if shows_nodes(recorded) else sample_nodes(recorded, seed=seed)
+
+	ANIMATION_FORMATS[animation_format(path)](path, render_frames(data, recorded.topology, state_colours, sample, workers), fps)
+	return len(data)
@@ -0,0 +1,314 @@
+# This file contains a benchmark suite that measures the throughput of the simulation engines
+# It times single rounds (rounds/sec), full runs until convergence (trials/sec) and each analyser,
+# across node counts, protocols and engines. Results are written to a JSON file, which can be
+# compared against an earlier run to catch performance regressions
+#
+# Usage: python benchmarks.py -o results.json [-compare previous.json]
+# Options:
+# -o, -output : string ; The JSON file the results are written to
+# -sizes : list of ints ; The node counts to benchmark (comma separated)
+# -engines : list of strings ; The engines to benchmark (comma separated), every engine by default
+# -scheduler : string ; The scheduler used by the agent engine
+# -min-time : float ; Each benchmark is repeated until it has run for at least this many seconds
+# -trials : int ; The number of trials run together in the convergence benchmark
+# -max-trial-nodes : int ; Convergence runs are only benchmarked up to this many nodes
+# -analyser-nodes : int ; The number of nodes used to benchmark the analysers
+# -seed : int ; Seeds every benchmark, so the same work is timed each run
+# -compare : string ; A previous results file, any benchmark slower than it by more than -tolerance is reported
+# -tolerance : float ; The fraction a benchmark may slow down by before it is reported as a regression
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import numpy as np
+import matplotlib
+
+# Analysers plot their results, so use a non-interactive backend before pyplot is imported
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from analysers import ANALYSERS
+from network import ENGINES
+from protocols import VoterModel, TwoChoiceProtocol, ThreeMajority, NMajorityProtocol
+from schedulers import SCHEDULERS
+
+# Node counts benchmarked by default, 10 to 10^6
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+
+# The protocols benchmarked, every protocol in protocols.py
+BENCHMARK_PROTOCOLS = [VoterModel(), TwoChoiceProtocol(), ThreeMajority(), NMajorityProtocol(5)]
+
+DEFAULT_MIN_TIME = 1.0
+DEFAULT_TRIALS = 16
+DEFAULT_MAX_TRIAL_NODES = 1000
+DEFAULT_ANALYSER_NODES = 10
+DEFAULT_TOLERANCE = 0.2
+
+# The number of repetitions of each data point when benchmarking the analysers
+ANALYSER_ROUNDS = 20
+
+# Networks run by the analyser benchmarks are stopped after this many rounds, as some points never converge (e.g
+# n-majority sampling every other node of an even split can swap the two states every round)
+ANALYSER_MAX_ROUNDS = 1000
+
+# Benchmarks are split evenly between two states, so runs are not decided by the initial configuration
+BENCHMARK_STATES = 2
+
+
+def even_configuration(nodes, states=BENCHMARK_STATES):
+	# Splits the nodes as evenly as possible between the states
+	return [nodes // states + (state < nodes % states) for state in range(states)]
+
+
+def benchmark_rounds(engine, protocol, nodes, scheduler, min_time, seed_sequence):
+	# Times PopulationNetwork.run_round (or the engine's equivalent), creating a new network whenever one
+	# finishes (converges, or e.g a mean-field network reaches a fixed point), until at least min_time seconds
+	# have been spent running rounds
+	# Network creation is timed separately
+	rounds = 0
+	elapsed = 0
+	setup_time = 0
+	networks = 0
+	while elapsed < min_time:
+		start = time.perf_counter()
+		network = engine.network_from_configuration(nodes, BENCHMARK_STATES, protocol, even_configuration(nodes), scheduler=scheduler, seed=seed_sequence.spawn(1)[0])
+		setup_time += time.perf_counter() - start
+		networks += 1
+
+		while not network.is_finished() and elapsed < min_time:
+			start = time.perf_counter()
+			network.run_round()
+			elapsed += time.perf_counter() - start
+			rounds += 1
+
+		if rounds == 0:
+			# The network converged immediately, so there is nothing to time
+			break
+
+	return {
+		"rounds": rounds,
+		"seconds": elapsed,
+		"rounds_per_second": rounds / elapsed if elapsed > 0 else None,
+		"setup_seconds": setup_time / networks
+	}
+
+
+def benchmark_trials(engine, protocol, nodes, scheduler, trials, min_time, seed_sequence):
+	# Times full runs until convergence using the engine's run_trials, repeating until at least min_time seconds have passed
+	# Trials that did not converge (a winner of -1) are left out of the average rounds
+	completed = 0
+	converged = 0
+	total_rounds = 0
+	elapsed = 0
+	while elapsed < min_time:
+		rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+		start = time.perf_counter()
+		rounds, winners = engine.run_trials(protocol, trials, even_configuration(nodes), rng=rng, scheduler=scheduler)
+		elapsed += time.perf_counter() - start
+
+		completed += trials
+		converged += int(np.count_nonzero(winners >= 0))
+		total_rounds += int(rounds[winners >= 0].sum())
+
+	return {
+		"trials": completed,
+		"non_converged": completed - converged,
+		"seconds": elapsed,
+		"trials_per_second": completed / elapsed,
+		"average_rounds": total_rounds / converged if converged > 0 else None
+	}
+
+
+def benchmark_analyser(analyser_type, engine, nodes, scheduler, seed_sequence):
+	# Times a whole analysis with a small number of repetitions, the progress it prints and the figures it plots are discarded
+	# The basic analyser only runs a single network. Trials stopped by ANALYSER_MAX_ROUNDS are counted as non_converged
+	rounds = 1 if analyser_type is ANALYSERS["basic"] else ANALYSER_ROUNDS
+	analyser = analyser_type(nodes, BENCHMARK_STATES, even_configuration(nodes), ThreeMajority(), rounds, engine, scheduler=scheduler,
+							seed=seed_sequence.spawn(1)[0], max_rounds=ANALYSER_MAX_ROUNDS)
+
+	start = time.perf_counter()
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			analyser.analyse()
+	finally:
+		analyser.close()
+
+	elapsed = time.perf_counter() - start
+	plt.close("all")
+
+	return {
+		"rounds": rounds,
+		"non_converged": sum(int(np.count_nonzero(winners < 0)) for _, winners in analyser.cache.points.values()),
+		"seconds": elapsed
+	}
+
+
+def run_benchmark(results, description, benchmark, *args):
+	# Runs a benchmark and adds its result to the list of results, along with the parameters that describe it
+	# Engines raise a ValueError for configurations they do not support, these are recorded as skipped
+	try:
+		result = benchmark(*args)
+	except (ValueError, NotImplementedError) as e:
+		result = {"skipped": str(e)}
+
+	result.update(description)
+	results.append(result)
+	print(" ".join(f"{key}={value}" for key, value in result.items()))
+
+
+def run_benchmarks(sizes, engines, scheduler, min_time, trials, max_trial_nodes, analyser_nodes, seed):
+	# Runs every benchmark, returning a list of results
+	# Every benchmark gets its own random stream spawned from the seed, so the same work is timed each run
+	results = []
+	seed_sequence = np.random.SeedSequence(seed)
+
+	for engine_name in engines:
+		engine = ENGINES[engine_name]
+		for protocol in BENCHMARK_PROTOCOLS:
+			for nodes in sizes:
+				description = {"benchmark": "round", "engine": engine_name, "protocol": protocol.get_protocol_name(), "n": getattr(protocol, "n", None), "nodes": nodes, "scheduler": scheduler}
+				run_benchmark(results, description, benchmark_rounds, engine, protocol, nodes, scheduler, min_time, seed_sequence.spawn(1)[0])
+
+				if nodes <= max_trial_nodes:
+					description = dict(description, benchmark="convergence", trials_per_run=trials)
+					run_benchmark(results, description, benchmark_trials, engine, protocol, nodes, scheduler, trials, min_time, seed_sequence.spawn(1)[0])
+
+		for analyser_name, analyser_type in ANALYSERS.items():
+			description = {"benchmark": "analyser", "engine": engine_name, "analyser": analyser_name, "nodes": analyser_nodes, "scheduler": scheduler}
+			run_benchmark(results, description, benchmark_analyser, analyser_type, engine, analyser_nodes, scheduler, seed_sequence.spawn(1)[0])
+
+	return results
+
+
+def benchmark_key(result):
+	# The parameters that identify a benchmark, used to match results between runs
+	return tuple((key, result.get(key)) for key in ("benchmark", "engine", "protocol", "n", "analyser", "nodes", "scheduler"))
+
+
+def benchmark_cost(result):
+	# Seconds per unit of work of a benchmark result (lower is faster), or None if it was skipped
+	if "skipped" in result:
+		return None
+
+	if result["benchmark"] == "round":
+		return result["seconds"] / result["rounds"] if result["rounds"] > 0 else None
+
+	if result["benchmark"] == "convergence":
+		return result["seconds"] / result["trials"]
+
+	return result["seconds"]
+
+
+def compare_results(previous, results, tolerance):
+	# Returns a list of (key, previous cost, cost) for every benchmark that is slower than the previous
+	# results by more than the tolerance (a fraction)
+	previous_costs = {benchmark_key(result): benchmark_cost(result) for result in previous}
+	regressions = []
+	for result in results:
+		key = benchmark_key(result)
+		previous_cost = previous_costs.get(key)
+		cost = benchmark_cost(result)
+		if previous_cost is None or cost is None:
+			continue
+
+		if cost > previous_cost * (1 + tolerance):
+			regressions.append((key, previous_cost, cost))
+
+	return regressions
+
+
+def benchmark_metadata(seed):
+	# Information about the machine and versions the benchmarks were run on, so runs can be compared fairly
+	return {
+		"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"platform": platform.platform(),
+		"processor": platform.processor(),
+		"seed": seed
+	}
+
+
+def sizes_list(val):
+	# A comma separated list of node counts
+	split_list = val.split(",")
+	if not all(e.isdigit() and int(e) > 1 for e in split_list):
+		raise argparse.ArgumentTypeError("Expected a comma-separated list of node counts greater than 1")
+
+	return [int(e) for e in split_list]
+
+
+def engines_list(val):
+	# A comma separated list of engine names
+	split_list = val.split(",")
+	for engine in split_list:
+		if engine not in ENGINES:
+			raise argparse.ArgumentTypeError(f"Unknown engine {engine}, expected one of {', '.join(ENGINES)}")
+
+	return split_list
+
+
+def positive_float(val):
+	if float(val) <= 0:
+		raise argparse.ArgumentTypeError("Expected a positive number greater than 0")
+
+	return float(val)
+
+
+def positive_number(val):
+	if int(val) <= 0:
+		raise argparse.ArgumentTypeError("Expected a positive integer greater than 0")
+
+	return int(val)
+
+
+parser = argparse.ArgumentParser(prog='Population Protocol Benchmarks',
+								description='Measure the throughput of the population protocol simulation engines')
+
+parser.add_argument('-o', '-output', dest='output', help='The JSON file the results are written to', default="benchmarks.json")
+parser.add_argument('-sizes', '--sizes', dest='sizes', help='Comma separated node counts to benchmark', type=sizes_list, default=DEFAULT_SIZES)
+parser.add_argument('-engines', '--engines', dest='engines', help='Comma separated engines to benchmark', type=engines_list, default=list(ENGINES))
+parser.add_argument('-scheduler', '--scheduler', dest='scheduler', help='The scheduler used by the networks (the count engine only supports synchronous)', choices=SCHEDULERS.keys(), default="synchronous")
+parser.add_argument('-min-time', '--min-time', dest='min_time', help='Each benchmark is repeated until it has run for at least this many seconds', type=positive_float, default=DEFAULT_MIN_TIME)
+parser.add_argument('-trials', '--trials', dest='trials', help='The number of trials run together in the convergence benchmark', type=positive_number, default=DEFAULT_TRIALS)
+parser.add_argument('-max-trial-nodes', '--max-trial-nodes', dest='max_trial_nodes', help='Runs until convergence are only benchmarked up to this many nodes', type=positive_number, default=DEFAULT_MAX_TRIAL_NODES)
+parser.add_argument('-analyser-nodes', '--analyser-nodes', dest='analyser_nodes', help='The number of nodes used to benchmark the analysers', type=positive_number, default=DEFAULT_ANALYSER_NODES)
+parser.add_argument('-seed', '--seed', dest='seed', help='Seed for every benchmark', type=int, default=0)
+parser.add_argument('-compare', '--compare', dest='compare', help='A previous results file to compare against, exits with an error if any benchmark has regressed', default=None)
+parser.add_argument('-tolerance', '--tolerance', dest='tolerance', help='The fraction a benchmark may slow down by before it is a regression', type=positive_float, default=DEFAULT_TOLERANCE)
+
+
+def main():
+	args = parser.parse_args()
+
+	if args.analyser_nodes < 4:
+		parser.error("The analysers require at least 4 nodes")
+
+	results = run_benchmarks(args.sizes, args.engines, args.scheduler, args.min_time, args.trials, args.max_trial_nodes, args.analyser_nodes, args.seed)
+
+	with open(args.output, "w") as f:
+		json.dump({"metadata": benchmark_metadata(args.seed), "results": results}, f, indent=2)
+
+	print(f"Results written to {args.output}")
+
+	if args.compare is not None:
+		with open(args.compare) as f:
+			previous = json.load(f)["results"]
+
+		regressions = compare_results(previous, results, args.tolerance)
+		for key, previous_cost, cost in regressions:
+			description = ", ".join(f"{name}={value}" for name, value in key if value is not None)
+			print(f"Regression: {description} took {cost:.3g}s, previously {previous_cost:.3g}s")
+
+		if len(regressions) > 0:
+			sys.exit(1)
+
+		print(f"No regressions compared to {args.compare}")
+
+
+if __name__ == "__main__":
+	main()
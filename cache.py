@@ -0,0 +1,109 @@
+# This file contains a cache of the trials run for each data point of an analysis
+# A data point is described by a key (its protocol, configuration, engine, scheduler, topology and seed), and
+# its trials are stored in order, so an analysis that asks for more trials of a point only runs the missing ones
+# The cache is kept in memory, and optionally in a directory so it is reused between runs. The directory is
+# bounded in size, the least recently used points are removed first
+
+import hashlib
+import json
+import os
+import numpy as np
+from results import replace_file
+
+# Changing this invalidates every cached point, it should be increased whenever the results of a simulation change
+CACHE_VERSION = 2
+
+# Default maximum size of a cache directory in bytes
+DEFAULT_CACHE_SIZE = 512 * 2 ** 20
+
+
+def hash_key(key):
+	# A hash of a key (any dictionary that can be written as JSON), the same for equal keys
+	return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def key_words(key, words=4):
+	# The hash of a key as a tuple of 32 bit integers, e.g to seed the trials of a data point
+	digest = bytes.fromhex(hash_key(key))
+	return tuple(int.from_bytes(digest[4 * i:4 * i + 4], "little") for i in range(words))
+
+
+def topology_key(topology):
+	# Describes a topology for a key, sparse topologies are identified by a hash of their adjacency arrays
+	if topology is None or topology.is_complete():
+		return "complete"
+
+	digest = hashlib.sha256(topology.indptr.tobytes() + topology.indices.astype(np.int64).tobytes()).hexdigest()
+	return f"{type(topology).__name__}:{digest}"
+
+
+class ResultCache:
+	def __init__(self, directory=None, max_size=DEFAULT_CACHE_SIZE):
+		# directory is where points are stored between runs, or None to only keep them in memory
+		# max_size is the maximum number of bytes stored in the directory
+		self.directory = directory
+		self.max_size = max_size
+
+		# Points used by this run, hash -> (rounds, winners)
+		self.points = {}
+
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+
+	def get(self, key):
+		# Returns arrays of the number of rounds and the winner of each cached trial of the point, or None
+		key_hash = hash_key(dict(key, version=CACHE_VERSION))
+		if key_hash in self.points:
+			return self.points[key_hash]
+
+		if self.directory is None:
+			return None
+
+		path = self.get_path(key_hash)
+		try:
+			with np.load(path) as point:
+				trials = point["rounds"], point["winners"]
+		except (OSError, ValueError, KeyError):
+			# Not cached, or the file is unreadable (e.g from an interrupted write)
+			return None
+
+		# Mark the point as recently used
+		os.utime(path)
+		self.points[key_hash] = trials
+		return trials
+
+	def put(self, key, rounds, winners, persist=True):
+		# Stores the trials of a point, replacing any trials already cached for it
+		# If persist is not set, the trials are only kept in memory (e.g while the point is still running)
+		key = dict(key, version=CACHE_VERSION)
+		key_hash = hash_key(key)
+		self.points[key_hash] = (rounds, winners)
+
+		if self.directory is None or not persist:
+			return
+
+		def write(path):
+			with open(path, "wb") as f:
+				np.savez(f, rounds=rounds, winners=winners, key=json.dumps(key, sort_keys=True))
+
+		replace_file(self.get_path(key_hash), write)
+		self.evict()
+
+	def get_path(self, key_hash):
+		return os.path.join(self.directory, key_hash + ".npz")
+
+	def evict(self):
+		# Removes the least recently used points until the directory is within its maximum size
+		entries = []
+		for entry in os.scandir(self.directory):
+			if entry.is_file() and entry.name.endswith(".npz"):
+				stat = entry.stat()
+				entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+		size = sum(entry_size for _, entry_size, _ in entries)
+		for _, entry_size, path in sorted(entries):
+			if size <= self.max_size:
+				break
+
+			os.remove(path)
+			size -= entry_size
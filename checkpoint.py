@@ -0,0 +1,54 @@
+# This file contains checkpoints of long running analyses, so they can be resumed after being stopped
+# A checkpoint stores the description of the analysis (including its seed) and the trials run so far for every
+# data point, including points that were still running. The trials of a point are seeded from the seed and the
+# point (see Analyser.point_seed), so a resumed analysis runs exactly the trials it would have run without stopping
+
+import json
+import time
+import numpy as np
+from results import replace_file
+
+# Default minimum number of seconds between checkpoints
+DEFAULT_CHECKPOINT_INTERVAL = 60.0
+
+
+class Checkpoint:
+	def __init__(self, path, interval=DEFAULT_CHECKPOINT_INTERVAL):
+		self.path = path
+		self.interval = interval
+		self.last_saved = time.monotonic()
+
+	def is_due(self):
+		# Whether interval seconds have passed since the last checkpoint
+		return time.monotonic() - self.last_saved >= self.interval
+
+	def save(self, metadata, points):
+		# Saves the description of the analysis and the trials of each point, given as point hash -> (rounds, winners)
+		arrays = {}
+		for key_hash, (rounds, winners) in points.items():
+			arrays[f"{key_hash}_rounds"] = rounds
+			arrays[f"{key_hash}_winners"] = winners
+
+		def write(path):
+			with open(path, "wb") as f:
+				np.savez(f, metadata=json.dumps(metadata), **arrays)
+
+		replace_file(self.path, write)
+		self.last_saved = time.monotonic()
+
+	def load_metadata(self):
+		# The description of the analysis that saved the checkpoint
+		with np.load(self.path) as checkpoint:
+			return json.loads(str(checkpoint["metadata"]))
+
+	def load(self):
+		# Returns the description of the analysis and the trials of each point, as saved
+		points = {}
+		with np.load(self.path) as checkpoint:
+			metadata = json.loads(str(checkpoint["metadata"]))
+			for name in checkpoint.files:
+				if name.endswith("_rounds"):
+					key_hash = name[:-len("_rounds")]
+					points[key_hash] = (checkpoint[name], checkpoint[f"{key_hash}_winners"])
+
+		return metadata, points
@@ -0,0 +1,120 @@
+# This file contains a simulator that runs many independent trials of the same network at once
+# Each trial is a row of a 2-D array, either the state of every node (R x nodes) or the number
+# of nodes in each state (R x states), so a round of every trial is a few vectorised operations
+
+import numpy as np
+
+# Maximum number of node states held in memory at once when simulating node states,
+# trials are simulated in blocks of rows to stay below this
+ENSEMBLE_STATE_LIMIT = 2 ** 22
+
+
+class EnsembleSimulation:
+	def __init__(self, protocol, trials, state_config, faulty_config=None, counts=False, rng=None, topology=None):
+		# state_config is the number of honest nodes in each state, faulty_config is the number of faulty nodes
+		# in each state. If counts is True, only the number of nodes in each state is stored for each trial
+		# (using PopulationProtocol.run_counts), otherwise the state of every node is stored (using run_batch)
+		# Every trial shares the same topology (complete if None), which is only supported when storing states
+		self.protocol = protocol
+		self.trials = trials
+		self.state_config = np.array(state_config, dtype=np.int64)
+
+		if faulty_config is None:
+			self.faulty_config = np.zeros_like(self.state_config)
+		else:
+			self.faulty_config = np.array(faulty_config, dtype=np.int64)
+
+		self.counts = counts
+		self.rng = rng if rng is not None else np.random.default_rng()
+		self.topology = topology
+
+		if counts and topology is not None and not topology.is_complete():
+			raise ValueError("Only complete networks can be simulated using counts")
+
+		# Results of each trial, set by run
+		# rounds is the number of rounds logged until convergence (including the initial configuration), the
+		# same as PopulationNetwork.round once converged. winners is the state every node converged to
+		self.rounds = None
+		self.winners = None
+
+	def get_number_of_nodes(self):
+		return int(self.state_config.sum() + self.faulty_config.sum())
+
+	def get_number_of_states(self):
+		return len(self.state_config)
+
+	def run(self, max_rounds=None):
+		# Runs every trial until it converges, or max_rounds have been run
+		# Trials that do not converge have a winner of -1
+		# Returns the number of rounds and winner of each trial
+		self.rounds = np.zeros(self.trials, dtype=np.int64)
+		self.winners = np.full(self.trials, -1, dtype=np.int64)
+
+		block_size = self.trials
+		if not self.counts:
+			block_size = max(1, ENSEMBLE_STATE_LIMIT // self.get_number_of_nodes())
+
+		for start in range(0, self.trials, block_size):
+			block = slice(start, min(start + block_size, self.trials))
+			if self.counts:
+				self.run_count_block(block, max_rounds)
+			else:
+				self.run_state_block(block, max_rounds)
+
+		return self.rounds, self.winners
+
+	def run_state_block(self, block, max_rounds):
+		# Simulates the states of every node for a block of trials
+		number_of_states = self.get_number_of_states()
+		states = np.concatenate([
+			np.repeat(np.arange(number_of_states), self.state_config),
+			np.repeat(np.arange(number_of_states), self.faulty_config)
+		])
+		faulty = np.arange(len(states)) >= self.state_config.sum()
+
+		states = np.tile(states, (block.stop - block.start, 1))
+		active = np.arange(block.start, block.stop)
+
+		while len(active) > 0:
+			state_counts = self.count_states(states, number_of_states)
+			active, states = self.finish_converged(active, states, state_counts, max_rounds)
+			if len(active) == 0:
+				break
+
+			new_states = self.protocol.run_batch(states, self.rng, self.topology)
+
+			# Faulty nodes never update their state
+			states = np.where(faulty, states, new_states)
+
+	def run_count_block(self, block, max_rounds):
+		# Simulates the number of nodes in each state for a block of trials
+		counts = np.tile(self.state_config, (block.stop - block.start, 1))
+		active = np.arange(block.start, block.stop)
+
+		while len(active) > 0:
+			active, counts = self.finish_converged(active, counts, counts + self.faulty_config, max_rounds)
+			if len(active) == 0:
+				break
+
+			counts = self.protocol.run_counts(counts, self.faulty_config, self.rng)
+
+	def finish_converged(self, active, trial_data, state_counts, max_rounds):
+		# Logs a round for the active trials, records the results of any that have converged (or reached
+		# max_rounds) and returns the trials still running along with their data
+		self.rounds[active] += 1
+
+		converged = self.protocol.converged_batch(state_counts)
+		self.winners[active[converged]] = state_counts[converged].argmax(axis=-1)
+
+		running = ~converged
+		if max_rounds is not None:
+			running &= self.rounds[active] <= max_rounds
+
+		return active[running], trial_data[running]
+
+	@staticmethod
+	def count_states(states, number_of_states):
+		# Counts the number of nodes in each state for every trial, giving a (trials x states) array
+		offsets = np.arange(len(states))[:, None] * number_of_states
+		flat_counts = np.bincount((states + offsets).ravel(), minlength=len(states) * number_of_states)
+		return flat_counts.reshape(len(states), number_of_states)
@@ -1,22 +1,49 @@
 import tkinter as tk
+from tkinter import filedialog
 import customtkinter as ctk
-import networkx as nx
 import matplotlib.pyplot as plt
 import matplotlib
+import collections
 import random
 import time
 import threading
 from analysers import basic_analysis
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from network import PopulationNetwork
+from network import ENGINES, RecordedNetwork
 from protocols import ThreeMajority, VoterModel, TwoChoiceProtocol
+from trajectory import save_trajectory, load_trajectory
+from views import NetworkFrame, NODE_VIEW_LIMIT, create_view, shows_nodes, sample_nodes
 
 matplotlib.use("TkAgg")
 
 ctk.set_appearance_mode("light")
 ctk.set_default_color_theme("dark-blue")
 
-GUI_NODE_LIMIT = 50
+# Networks with more nodes than this are shown as their state counts over time and a sample of their nodes, rather than node by node
+GUI_NODE_LIMIT = NODE_VIEW_LIMIT
+
+# Maximum number of nodes allowed when using the GUI with each engine
+GUI_ENGINE_NODE_LIMITS = {
+    "agent": 10 ** 6,
+    "count": 10 ** 9,
+    "mean-field": 10 ** 15,
+    "diffusion": 10 ** 15
+}
+
+# Maximum number of frames drawn per second, frames published faster than this are skipped
+RENDER_FRAME_RATE = 20
+
+# Number of frames kept waiting for the renderer, older frames are dropped when the simulation is faster than the renderer
+FRAME_QUEUE_SIZE = 2
+
+# Playback speeds name -> maximum rounds simulated per second, None runs the simulation as fast as it can
+PLAYBACK_SPEEDS = {
+    "1 round/s": 1,
+    "5 rounds/s": 5,
+    "20 rounds/s": 20,
+    "100 rounds/s": 100,
+    "Unlimited": None
+}
 
 # A list of all protocols available for the GUI
 GUI_PROTOCOLS = [VoterModel(), TwoChoiceProtocol(), ThreeMajority()]
@@ -30,6 +57,7 @@ class ConfigurationModal:
         self.rounds = None
         self.max_rounds = None
         self.protocol = None
+        self.engine = None
 
         self.top = ctk.CTkToplevel(parent)
         self.top.title("")
@@ -62,6 +90,18 @@ class ConfigurationModal:
                                             text_color="#000")
         protocol_option.pack()
 
+        # Engine selection menu, only engines that store every agent can show networks node by node
+        ctk.CTkLabel(self.top, text='Engine:').pack()
+        self.chosen_engine = ctk.StringVar(self.top)
+        self.chosen_engine.set("agent")
+
+        engine_option = ctk.CTkOptionMenu(master=self.top,
+                                          values=list(GUI_ENGINE_NODE_LIMITS.keys()),
+                                          variable=self.chosen_engine,
+                                          fg_color="#fff",
+                                          text_color="#000")
+        engine_option.pack()
+
         ctk.CTkButton(self.top, text='Simulate!', command=self.validate).pack()
 
     def validate(self):
@@ -69,11 +109,13 @@ class ConfigurationModal:
         # otherwise show an alert for the relevant incorrect input(s)
         # return self.number_nodes_entry.get()
 
-        # Validate the number of nodes
+        # Validate the number of nodes, networks over GUI_NODE_LIMIT nodes are shown as an aggregate
+        self.engine = self.chosen_engine.get()
+        node_limit = GUI_ENGINE_NODE_LIMITS[self.engine]
         number_nodes = self.number_nodes_entry.get()
-        if (not number_nodes.isnumeric()) or int(number_nodes) <= 0 or int(number_nodes) > GUI_NODE_LIMIT:
+        if (not number_nodes.isnumeric()) or int(number_nodes) <= 0 or int(number_nodes) > node_limit:
             tk.messagebox.showerror("Error",
-                                    f"Node input is invalid. Please enter a number between 1 and {GUI_NODE_LIMIT}")
+                                    f"Node input is invalid. Please enter a number between 1 and {node_limit} for the {self.engine} engine")
             return
 
         self.nodes = int(number_nodes)
@@ -124,6 +166,41 @@ class StateEntryWidget(ctk.CTkFrame):
         self.node_count_label.configure(text=count)
 
 
+# Passes frames from the simulation thread to the GUI thread
+# The simulation never waits for the renderer: when the queue is full the oldest frame is dropped, and the
+# renderer only draws the newest frame waiting, so stale frames are skipped
+class FrameQueue:
+    def __init__(self, size=FRAME_QUEUE_SIZE):
+        self.frames = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+        # Number of frames that were never drawn
+        self.dropped = 0
+
+    def publish(self, frame):
+        with self.lock:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+
+            self.frames.append(frame)
+
+    def take_latest(self):
+        # Returns the newest frame, discarding any older frames, or None if there are no new frames
+        with self.lock:
+            if len(self.frames) == 0:
+                return None
+
+            self.dropped += len(self.frames) - 1
+            frame = self.frames.pop()
+            self.frames.clear()
+            return frame
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.dropped = 0
+
+
 class SimulationGUI:
     def __init__(self):
         self.window = ctk.CTk()
@@ -148,6 +225,10 @@ class SimulationGUI:
         # Round info label
         self.status_label = ctk.CTkLabel(top_bar, text="", padx=5)
 
+        # Timeline of the rounds run so far, moving it shows a recorded round
+        self.timeline = ctk.CTkSlider(top_bar, from_=0, to=1, number_of_steps=1, command=self.seek)
+        self.timeline.set(0)
+
         # List of tuples for all states of (color, id, nodes supporting)
         self.state_node_list = []
 
@@ -157,10 +238,23 @@ class SimulationGUI:
         step_btn = ctk.CTkButton(right_panel, text="Step", command=self.step)
         view_data_btn = ctk.CTkButton(right_panel, text="View data", command=self.show_basic_analysis)
 
+        # Playback speed selection menu
+        speed_label = ctk.CTkLabel(right_panel, text="Speed")
+        self.chosen_speed = ctk.StringVar(self.window)
+        self.chosen_speed.set(next(iter(PLAYBACK_SPEEDS)))
+        self.rounds_per_second = PLAYBACK_SPEEDS[self.chosen_speed.get()]
+        speed_option = ctk.CTkOptionMenu(master=right_panel,
+                                         values=list(PLAYBACK_SPEEDS.keys()),
+                                         variable=self.chosen_speed,
+                                         command=self.set_speed,
+                                         fg_color="#fff",
+                                         text_color="#000")
+
         # Pack all components
 
         # Top bar packing
         self.status_label.pack(side=ctk.LEFT)
+        self.timeline.pack(side=ctk.RIGHT, fill="x", expand=True, padx=10)
         top_bar.pack(fill="x")
 
         # Right button panel
@@ -168,6 +262,8 @@ class SimulationGUI:
         pause_btn.pack()
         step_btn.pack()
         view_data_btn.pack()
+        speed_label.pack()
+        speed_option.pack()
 
         # Create the state list frame and pack all necessary elements
         states_label.pack(fill="x")
@@ -186,16 +282,29 @@ class SimulationGUI:
 
         self.state_entries = None
         self.max_rounds = None
+        self.network_view = None
+        self.sample = None
+
+        # The recorded round being shown when the timeline has been moved back, None when showing the latest round
+        self.replay_round = None
+
+        # Frames of the network published by the simulation, drawn by the GUI thread (see render_frames)
+        self.frames = FrameQueue()
         self.set_network(None)
 
         self.paused = True
         self.running_thread = None
-        self.window.bind("<<update_network>>", self.show_network_evt)
+        self.window.after(0, self.render_frames)
         self.window.protocol("WM_DELETE_WINDOW", self.quit)
         self.window.resizable(False, False)
         self.window.mainloop()
 
+    def set_speed(self, speed):
+        # Kept outside of the Tk variable, so the simulation thread can read it
+        self.rounds_per_second = PLAYBACK_SPEEDS[speed]
+
     def quit(self):
+        self.paused = True
         self.window.quit()
 
     def show_basic_analysis(self):
@@ -211,6 +320,8 @@ class SimulationGUI:
         # File menu
         file_menu = tk.Menu(menu, tearoff=0)
         file_menu.add_command(label="Create protocol..", command=lambda: self.show_config_modal())
+        file_menu.add_command(label="Open run..", command=self.open_run)
+        file_menu.add_command(label="Save run..", command=self.save_run)
         file_menu.add_separator()
         file_menu.add_command(label="Quit", command=self.quit)
         menu.add_cascade(label="File", menu=file_menu)
@@ -219,28 +330,62 @@ class SimulationGUI:
         self.window.config(menu=menu)
 
     def show_help(self):
-        tk.messagebox.showinfo("Help", "To begin, create a network by clicking File -> Create protocol... Use the controls on the right to run the simulation.\nVersion: 1.0")
+        tk.messagebox.showinfo("Help", "To begin, create a network by clicking File -> Create protocol... Use the controls on the right to run the simulation, and the timeline at the top to go back to an earlier round. Runs can be saved and replayed later with File -> Save run... and File -> Open run...\nVersion: 1.0")
 
     def show_config_modal(self):
         config = ConfigurationModal(self.window)
         self.window.wait_window(config.top)
         if config.nodes is not None and config.states is not None and config.protocol is not None:
+            self.wait_round()
             self.max_rounds = config.max_rounds
-            new_network = PopulationNetwork.network_from_configuration(config.nodes, config.states, config.protocol)
+
+            # Networks shown node by node record the changes of every round, so any round can be shown again
+            # Larger networks only record their state counts
+            recording = "deltas" if ENGINES[config.engine].stores_states and config.nodes <= GUI_NODE_LIMIT else "counts"
+            new_network = ENGINES[config.engine].network_from_configuration(config.nodes, config.states, config.protocol, recording=recording)
             self.set_network(new_network)
 
-    def show_network(self):
-        # Show the current network in the canvas
-        # Clear current network
-        plt.clf()
+    def save_run(self):
+        # Saves the rounds run so far, so they can be replayed with open_run
+        if self.network is None:
+            return
 
-        color_map = list(map(lambda state: self.state_colours.get(state), self.network.get_states()))
+        path = filedialog.asksaveasfilename(defaultextension=".npz", filetypes=[("Recorded runs", "*.npz")])
+        if not path:
+            return
 
-        # Create network graph GUI, fix pos seed to not randomize graph position each time
-        pos = nx.spring_layout(self.graph, seed=1)
+        self.wait_round()
+        metadata = {
+            "converged": bool(self.network.has_converged()),
+            "state_colours": {str(state): colour for state, colour in self.state_colours.items()}
+        }
+        save_trajectory(path, self.network.data, metadata)
+
+    def open_run(self):
+        # Loads a run saved by save_run, its rounds are replayed rather than simulated
+        path = filedialog.askopenfilename(filetypes=[("Recorded runs", "*.npz")])
+        if not path:
+            return
 
-        nx.draw(self.graph, pos=pos, node_color=color_map)
-        self.canvas.draw()
+        self.wait_round()
+        try:
+            data, metadata = load_trajectory(path)
+        except (OSError, ValueError, KeyError) as e:
+            tk.messagebox.showerror("Error", f"Could not open the run: {e}")
+            return
+
+        network = RecordedNetwork(data, metadata.get("converged", True))
+
+        # A run that did not converge stops at its last recorded round
+        self.max_rounds = None if network.converged else len(data) - 1
+        state_colours = {int(state): colour for state, colour in metadata.get("state_colours", {}).items()}
+        self.set_network(network, state_colours if len(state_colours) > 0 else None)
+
+    def show_network(self, frame):
+        # Show the network of a frame in the canvas
+        # Only the nodes that changed state are recoloured, and only the parts of the view that change are redrawn
+        if self.network_view.update(frame):
+            self.network_view.redraw()
 
     def start(self):
         if self.network is None:
@@ -273,14 +418,48 @@ class SimulationGUI:
         if self.network is None:
             return
 
-        if self.network_max_rounds_reached() or self.network.has_converged():
+        if self.is_finished():
             return
 
         self.close_extra_figures()
         self.wait_round()
+        self.advance()
+
+    def is_finished(self):
+        # Whether there are no more rounds to show, rounds are left to replay when the timeline has been moved back
+        return self.replay_round is None and (self.network_max_rounds_reached() or self.network.is_finished())
+
+    def advance(self):
+        # Shows the next round, replaying it if the timeline has been moved back, otherwise running a new round
+        if self.replay_round is not None:
+            self.replay_round += 1
+            if self.replay_round < self.network.round - 1:
+                self.frames.publish(NetworkFrame.from_trajectory(self.network.data, self.replay_round, self.max_rounds, self.sample))
+                return
+
+            # Back at the latest round
+            self.replay_round = None
+        else:
+            self.network.run_round()
+
+        self.publish_frame()
+
+    def seek(self, value):
+        # Shows the round chosen with the timeline, pausing the simulation
+        if self.network is None:
+            return
+
+        self.wait_round()
+        rnd = int(round(value))
+        if rnd >= self.network.round - 1:
+            self.replay_round = None
+            frame = NetworkFrame.from_network(self.network, self.max_rounds, self.sample)
+        else:
+            self.replay_round = rnd
+            frame = NetworkFrame.from_trajectory(self.network.data, rnd, self.max_rounds, self.sample)
 
-        self.network.run_round()
-        self.window.event_generate("<<update_network>>", when="tail")
+        self.frames.clear()
+        self.show_frame(frame)
 
     def network_max_rounds_reached(self):
         # Check if the simulation has reached
@@ -290,40 +469,66 @@ class SimulationGUI:
 
         return self.network.round > self.max_rounds
 
-    def show_network_evt(self, evt):
+    def publish_frame(self):
+        # Publish a snapshot of the network for the renderer
+        self.frames.publish(NetworkFrame.from_network(self.network, self.max_rounds, self.sample))
+
+    def render_frames(self):
+        # Draws the newest frame published by the simulation (if any), then schedules itself again
+        # This runs on the GUI thread at most RENDER_FRAME_RATE times a second, so drawing never slows down the simulation
+        frame = self.frames.take_latest()
+        if frame is not None and self.network is not None:
+            self.show_frame(frame)
+
+        self.window.after(round(1000 / RENDER_FRAME_RATE), self.render_frames)
+
+    def show_frame(self, frame):
         # Update all necessary GUI elements, including network
 
         # Update the round/status label
-        current_round = self.network.round - 1
-
-        if self.max_rounds is not None and current_round >= self.max_rounds:
+        latest_round = self.network.round - 1
+        if frame.recorded:
+            self.status_label.configure(text=f"Round {frame.round} of {latest_round} (recorded)")
+        elif frame.max_rounds_reached:
             self.status_label.configure(text=f"Maximum round of {self.max_rounds} reached")
-        elif self.network.has_converged():
-            self.status_label.configure(text=f"Network converged on round {str(current_round)}")
+        elif frame.converged:
+            self.status_label.configure(text=f"Network converged on round {str(frame.round)}")
+        elif frame.finished:
+            self.status_label.configure(text=f"Network stopped without converging on round {str(frame.round)}")
         else:
-            self.status_label.configure(text=f"Round {str(self.network.round - 1)}")
+            self.status_label.configure(text=f"Round {str(frame.round)}")
 
         # Update the state entry list
-        self.update_state_entries()
+        self.update_state_entries(frame.state_counts)
+
+        # Move the timeline to the round shown
+        self.timeline.configure(to=max(latest_round, 1), number_of_steps=max(latest_round, 1))
+        self.timeline.set(frame.round)
 
         # Show the network
-        self.show_network()
+        self.show_network(frame)
 
     def propel(self):
-        # Run the simulation until it has finished or is paused
-        while not (self.network.has_converged() or self.network_max_rounds_reached()) and not self.paused:
-            self.network.run_round()
-            self.window.event_generate("<<update_network>>", when="tail")
-            time.sleep(1)
+        # Run the simulation until it has finished or is paused, at most at the chosen playback speed
+        # Each round is published as a frame, the renderer draws them at its own rate
+        next_round_time = time.monotonic()
+        while not self.is_finished() and not self.paused:
+            self.advance()
+
+            rounds_per_second = self.rounds_per_second
+            if rounds_per_second is not None:
+                # Wait until the next round is due, without catching up on time lost to slow rounds
+                next_round_time = max(next_round_time + 1 / rounds_per_second, time.monotonic())
+                time.sleep(max(0.0, next_round_time - time.monotonic()))
 
     def pause(self):
         if self.network is None:
             return
         self.paused = True
 
-    def set_network(self, network):
+    def set_network(self, network, state_colours=None):
         # This method clears any current network, and resets the GUI to load a new network
-        # It also generates random colours for the states in the network
+        # It also generates random colours for the states in the network, unless state_colours is given
         if network is None:
             # No network selected (e.g when GUI starts)
             self.network = None
@@ -336,6 +541,8 @@ class SimulationGUI:
 
         self.status_label.configure(text="Press play to begin protocol")
         self.network = network
+        self.replay_round = None
+        self.frames.clear()
 
         # Clear state entry list GUI
         if self.state_entries is not None:
@@ -345,12 +552,27 @@ class SimulationGUI:
             self.state_entries = None
 
         # Create graph and coloured nodes
-        self.graph = nx.complete_graph(self.network.get_number_of_nodes())
-        self.state_colours = {state: f"#{random.randrange(0x1000000):06x}" for state in self.network.get_states()}
-        self.update_state_entries()
-        self.show_network()
+        # The layout and edges are drawn once here, each frame then only recolours the nodes (see NetworkView)
+        # Large networks (or networks that only store counts) are shown as their state counts and a sample of nodes
+        if state_colours is None:
+            state_colours = {state: f"#{random.randrange(0x1000000):06x}" for state in self.network.get_state_counts()}
 
-    def update_state_entries(self):
+        self.state_colours = state_colours
+        self.sample = None if shows_nodes(self.network) else sample_nodes(self.network)
+        frame = NetworkFrame.from_network(self.network, self.max_rounds, self.sample)
+        self.update_state_entries(frame.state_counts)
+        self.timeline.configure(to=1, number_of_steps=1)
+        self.timeline.set(0)
+
+        if self.network_view is not None:
+            self.network_view.remove()
+
+        self.graph_figure.clf()
+        self.network_view = create_view(self.graph_figure, self.network, self.state_colours, frame)
+
+        self.canvas.draw()
+
+    def update_state_entries(self, state_counts):
         # Set the state entry list
         if self.state_entries is None:
             # Entries have not yet been created, add them to the array
@@ -364,9 +586,7 @@ class SimulationGUI:
                 state_entry.pack(fill="x")
                 self.state_entries.insert(state, state_entry)
 
-        # Adjust the number of nodes in each entry
-        network_states = self.network.get_states()
-
+        # Adjust the number of nodes in each entry, using the state counts of the frame being shown
         for state_entry in self.state_entries:
             # Loop through all state entries and update their counts
-            state_entry.set_state_count(network_states.count(state_entry.state_id))
+            state_entry.set_state_count(state_counts.get(state_entry.state_id, 0))
@@ -1,8 +1,18 @@
 import argparse
+import contextlib
+import os
+import sys
+import time
+import numpy as np
 from protocols import ThreeMajority, NMajorityProtocol, TwoChoiceProtocol, VoterModel
-from gui import SimulationGUI
-import matplotlib.pyplot as plt
-from analysers import BasicAnalyser, BiasAnalyser, NMajorityAnalyser, AdversarialAnalyser
+from network import ENGINES
+from schedulers import SCHEDULERS
+from topology import TOPOLOGIES
+from profiling import Profiler
+from results import result_format
+from cache import ResultCache, DEFAULT_CACHE_SIZE
+from checkpoint import Checkpoint, DEFAULT_CHECKPOINT_INTERVAL
+from analysers import ANALYSERS, StoppingRule, MIN_REPETITIONS, SPARSE_TOPOLOGY_MAX_ROUNDS
 
 # The parser for commandline arguments for the population protocols
 # Options:
@@ -11,27 +21,59 @@ from analysers import BasicAnalyser, BiasAnalyser, NMajorityAnalyser, Adversaria
 # -n, -nodes  : int ; The number of nodes in the network
 # -s, -states : int or list of ints ; The number of states in the network (< -n) or a list of how many nodes in each state initially
 # 				(must add up to -n)
-# -o, -output : string ; The output of the function, currently unknown options
+# -o, -output : string ; A CSV, JSON or NPZ file the data points of the analysis are written to as they are run, instead of showing figures
+# -e, -engine : string ; The simulation engine, either agent (one object per node), count (per-state counts only), mean-field (expected
+# 				state fractions) or diffusion (expected state fractions with random fluctuations)
+# -j, -workers : int ; The number of worker processes used to run the trials of an analysis
+# -scheduler : string ; Either synchronous (all nodes update each round) or sequential (one random node at a time, n updates per round, the converging round counts as a whole round)
+# -topology : string ; Which nodes neighbour each other, complete (every node) or a sparse graph (regular, erdos-renyi, grid, small-world)
+# -degree : int ; The (average) number of neighbours of each node in a sparse topology
+# -max-rounds : int ; Networks that have not converged after this many rounds are stopped and count as not converging
+# 				(networks on sparse topologies are always limited, by default to 10000 rounds)
+# -adaptive : Boolean ; The bias analyser searches for the biases where the probability of convergence changes instead of running every bias
+# -ci-width : float ; Stop repeating a data point once the confidence interval of its average is narrower than this
+# -relative-error : float ; Stop repeating a data point once the confidence interval of its average is within this fraction of it
+# -min-rounds : int ; The minimum number of repetitions of a data point when using -ci-width or -relative-error (-r is then the maximum)
+# -profile : Boolean ; Records the time spent in each phase of the simulation and prints a report after the analysis
+# -seed : int ; Seeds the random streams of the analysis (and any random topology) so it can be reproduced
+# -cache : string ; A directory the trials of each data point are cached in, so repeated or extended analyses only run new points
+# -cache-size : int ; The maximum size of the cache directory in MiB, the least recently used points are removed first
+# -checkpoint : string ; A file the trials run so far are periodically saved to, so a stopped analysis can be resumed
+# -checkpoint-interval : float ; The minimum number of seconds between checkpoints
+# -resume : Boolean ; Continues the analysis saved in the -checkpoint file, using its seed
+# -save-figures : string ; Saves the figures of the analysis to this directory (using a non-interactive backend) instead of showing them
+# -animate : string ; Runs a single network and renders every round to this GIF or MP4 file off-screen, instead of running an analysis
+# -fps : int ; The number of rounds shown per second of a -animate file
+#
+# The GUI and plotting libraries are only imported when they are used, so analyses without the GUI start quickly
+# and can run on machines without a display
 
 # Constants
 DEFAULT_NODE_COUNT = 10
 DEFAULT_STATE_COUNT = 2
 DEFAULT_ROUNDS_COUNT = 1
+DEFAULT_DEGREE = 4
 
 # Maximum number of nodes allowed when using the GUI
 GUI_NODE_LIMIT = 50
 MAX_NODE_LIMIT = 10000
 
+# Maximum number of nodes allowed when using the count engine, which does not store individual nodes
+MAX_COUNT_NODE_LIMIT = 1000000000
+
+# Maximum number of nodes allowed when using the mean-field engines, whose rounds do not depend on the number of nodes
+MAX_MEAN_FIELD_NODE_LIMIT = 10 ** 15
+
 # Dictionary of protocol name -> protocol
 CLI_PROTOCOLS = [VoterModel(), TwoChoiceProtocol(), ThreeMajority()]
 PROTOCOLS = {protocol.get_protocol_name(): protocol for protocol in CLI_PROTOCOLS}
 
-# Different types of analysis that can be performed name -> callback
-ANALYSERS = {
-	"basic": BasicAnalyser,
-	"bias": BiasAnalyser,
-	"n-majority": NMajorityAnalyser,
-	"adversarial": AdversarialAnalyser
+# Maximum number of nodes for each engine
+ENGINE_NODE_LIMITS = {
+	"agent": MAX_NODE_LIMIT,
+	"count": MAX_COUNT_NODE_LIMIT,
+	"mean-field": MAX_MEAN_FIELD_NODE_LIMIT,
+	"diffusion": MAX_MEAN_FIELD_NODE_LIMIT
 }
 
 
@@ -42,6 +84,41 @@ def positive_number(val):
 	return int(val)
 
 
+def non_negative_number(val):
+	if int(val) < 0:
+		raise argparse.ArgumentTypeError("Expected an integer greater than or equal to 0")
+
+	return int(val)
+
+
+def positive_float(val):
+	if float(val) <= 0:
+		raise argparse.ArgumentTypeError("Expected a positive number greater than 0")
+
+	return float(val)
+
+
+def results_file(val):
+	# A results file must have the extension of a known format
+	try:
+		result_format(val)
+	except ValueError as e:
+		raise argparse.ArgumentTypeError(str(e))
+
+	return val
+
+
+def animation_file(val):
+	# An animation file must have the extension of a known format, the animation module is only loaded when it is used
+	from animation import animation_format
+	try:
+		animation_format(val)
+	except ValueError as e:
+		raise argparse.ArgumentTypeError(str(e))
+
+	return val
+
+
 def network_config(val):
 	# Network configuration is given either as a number, or list of numbers (comma separeted)
 	# Ensure all elements are numbers if using a list
@@ -54,6 +131,16 @@ def network_config(val):
 	return [int(a) for a in split_list]
 
 
+def save_figures(directory, name):
+	# Saves every open figure to the directory, named after the analysis
+	import matplotlib.pyplot as plt
+	os.makedirs(directory, exist_ok=True)
+	for number in plt.get_fignums():
+		path = os.path.join(directory, f"{name}-{number}.png")
+		plt.figure(number).savefig(path)
+		print(f"Saved figure to {path}")
+
+
 parser = argparse.ArgumentParser(prog='Population Protocol Visualiser',
 								description='Analyse and visualise population protocol networks',
 								formatter_class=argparse.RawTextHelpFormatter)
@@ -64,6 +151,28 @@ parser.add_argument('-n', '-nodes', dest='nodes', help='The number of nodes in t
 parser.add_argument('-s', '-states', dest='states', help='The number of initial states, or a list of comma separated numbers indicating how many nodes in each state (must add up to n, the number of nodes)', type=network_config, default=None)
 parser.add_argument('-p', '-protocol', dest='protocol', help='The protocol to run this network with', choices=PROTOCOLS.keys(), default=None)
 parser.add_argument('-a', '-analysis', dest='analysis', help="\n".join(f"{name:<6}" + " : " + analyser.info() for name, analyser in ANALYSERS.items()), choices=ANALYSERS.keys(), default=None)
+parser.add_argument('-o', '-output', dest='output', help='Write the data points of the analysis to this file (.csv, .json or .npz) as they are run, instead of showing figures (unless -save-figures is also used)', type=results_file, default=None)
+parser.add_argument('-e', '-engine', dest='engine', help='The simulation engine, count only stores the number of nodes in each state and supports much larger networks, mean-field follows the expected fraction of nodes in each state (diffusion adds the random fluctuations of a network of this size)', choices=ENGINES.keys(), default="agent")
+parser.add_argument('-j', '-workers', dest='workers', help='The number of worker processes to run trials on', type=positive_number, default=1)
+parser.add_argument('-scheduler', '--scheduler', dest='scheduler', help='How nodes are scheduled, synchronous updates every node each round, sequential updates one random node at a time (rounds are then in parallel time, n updates each, and a round the network converges part way through counts as a whole round)', choices=SCHEDULERS.keys(), default="synchronous")
+parser.add_argument('-topology', '--topology', dest='topology', help='Which nodes neighbour each other, complete connects every node, the others are sparse graphs stored as adjacency arrays', choices=TOPOLOGIES.keys(), default="complete")
+parser.add_argument('-degree', '--degree', dest='degree', help='The (average) number of neighbours of each node in a sparse topology, grids always have 4 (and need a node count that is the product of two numbers of at least 3), erdos-renyi graphs are connected and give every node at least 3', type=positive_number, default=DEFAULT_DEGREE)
+parser.add_argument('-max-rounds', '--max-rounds', dest='max_rounds', help=f'Stop networks that have not converged after this many rounds, they are reported as not converging (networks on sparse topologies can lock into patterns that never converge, so they are limited to {SPARSE_TOPOLOGY_MAX_ROUNDS} rounds by default)', type=positive_number, default=None)
+parser.add_argument('-adaptive', '--adaptive', action='store_true', dest='adaptive', help='Search for the biases where the probability of convergence changes instead of running every bias (bias analyser only)', default=False)
+parser.add_argument('-ci-width', '--ci-width', dest='ci_width', help='Stop repeating each data point once the confidence interval of the average number of rounds is narrower than this (n-majority and adversarial analysers)', type=positive_float, default=None)
+parser.add_argument('-relative-error', '--relative-error', dest='relative_error', help='Stop repeating each data point once the half width of its confidence interval is within this fraction of the average (n-majority and adversarial analysers)', type=positive_float, default=None)
+parser.add_argument('-min-rounds', '--min-rounds', dest='min_rounds', help='The minimum number of repetitions of each data point when using a stopping rule, -r is the maximum', type=positive_number, default=MIN_REPETITIONS)
+parser.add_argument('-profile', '--profile', action='store_true', dest='profile', help='Record the time spent in each phase of the simulation (finding neighbours, running the protocol, updating agents, logging, checking convergence) and print a report', default=False)
+parser.add_argument('-cache', '--cache', dest='cache', help='Cache the trials of each data point in this directory, an analysis with the same seed reuses cached points and only runs the missing trials', default=None)
+parser.add_argument('-cache-size', '--cache-size', dest='cache_size', help='The maximum size of the cache directory in MiB, the least recently used points are removed first', type=positive_number, default=DEFAULT_CACHE_SIZE // 2 ** 20)
+parser.add_argument('-checkpoint', '--checkpoint', dest='checkpoint', help='Periodically save the trials run so far to this file, so the analysis can be resumed with -resume if it is stopped', default=None)
+parser.add_argument('-checkpoint-interval', '--checkpoint-interval', dest='checkpoint_interval', help='The minimum number of seconds between checkpoints', type=positive_float, default=DEFAULT_CHECKPOINT_INTERVAL)
+parser.add_argument('-resume', '--resume', action='store_true', dest='resume', help='Resume the analysis saved in the -checkpoint file, the other arguments must match the stopped analysis', default=False)
+parser.add_argument('-save-figures', '--save-figures', dest='save_figures', help='Save the figures of the analysis as PNG files in this directory instead of showing them, no display is required', default=None)
+parser.add_argument('-animate', '--animate', dest='animate', help='Run a single network and render every round to this animation file (.gif, or .mp4 if ffmpeg is installed) without a display, frames are drawn by -j workers', type=animation_file, default=None)
+parser.add_argument('-fps', '--fps', dest='fps', help='The number of rounds shown per second of the -animate file', type=positive_number, default=10)
+parser.add_argument('-seed', '--seed', dest='seed', help='Seed for the random streams of the analysis, the same seed reproduces the same results (a random seed is used and printed if not given)', type=non_negative_number, default=None)
+
 
 # Parser verifies arguments are correct for ALL analysers
 # Each analyser then uses whatever arguments it requires from the parser
@@ -71,61 +180,200 @@ parser.add_argument('-a', '-analysis', dest='analysis', help="\n".join(f"{name:<
 # Essentially, if the nogui command is used, we ignore ALL other stuff, the CLI is only useful for analysers
 # so only allow analyses with these. Verify all arguments BEFORE the analyses, but no arguments should be
 # required by the parser except the analyser, then the analyser will choose what arguments it wishes to accept
-args = parser.parse_args()
-
-# Network created is invalid to begin with.
-network = None
-network_states = None
-state_config = None
-
-if not args.nogui:
-	# GUI is being used
-	if args.rounds > 1:
-		parser.error("Multiple rounds may only be run without the GUI (use -nogui)")
-
-	if args.analysis is not None:
-		parser.error("Analyses may only be run without the GUI (use -nogui)")
-	# Launch the GUI
-	SimulationGUI()
-	exit()
-
-# If we are using the GUI, validate the arguments provided
-if args.nodes is not None:
-	if args.nodes > MAX_NODE_LIMIT:
-		parser.error("Number of nodes may not exceed " + str(MAX_NODE_LIMIT))
-
-if args.analysis is None:
-	parser.error("An analysis type must be provided when not using the GUI")
-
-if args.states is not None:
-	# Check nodes is provided
-	if args.nodes is None:
-		parser.error("A state configuration may only be provided with a node count.")
-
-	if len(args.states) > 1 and sum(args.states) != args.nodes:
-		# If a state config is given, check the number of nodes in the configuration matches the nodes specified in the network
-		raise argparse.ArgumentTypeError(f"The number of nodes specified ({args.nodes}) does not match the nodes in the state configuration ({sum(args.states)})")
-
-	if len(args.states) == 1:
-		# Only 1 state provided, this means this is the given state
-		if (args.states[0]) > args.nodes:
-			raise argparse.ArgumentTypeError(f"The number of states must be less than or equal to the number of nodes ({args.nodes})")
-		network_states = args.states[0]
-		state_config = None
+def main():
+	args = parser.parse_args()
+
+	# Network created is invalid to begin with.
+	network = None
+	network_states = None
+	state_config = None
+
+	if not args.nogui:
+		# GUI is being used
+		if args.rounds > 1:
+			parser.error("Multiple rounds may only be run without the GUI (use -nogui)")
+
+		if args.analysis is not None:
+			parser.error("Analyses may only be run without the GUI (use -nogui)")
+
+		# Launch the GUI, this loads customtkinter, networkx and the TkAgg backend
+		from gui import SimulationGUI
+		SimulationGUI()
+		return
+
+	if args.save_figures is not None:
+		# Figures are rendered off-screen, the backend must be chosen before pyplot is first imported
+		import matplotlib
+		matplotlib.use("Agg")
+
+	# If we are using the GUI, validate the arguments provided
+	if args.nodes is not None:
+		if args.nodes > ENGINE_NODE_LIMITS[args.engine]:
+			parser.error(f"Number of nodes may not exceed {ENGINE_NODE_LIMITS[args.engine]} using the {args.engine} engine")
+
+	if args.analysis is None and args.animate is None:
+		parser.error("An analysis type (or an -animate file) must be provided when not using the GUI")
+
+	if args.analysis is not None and args.animate is not None:
+		parser.error("-animate runs a single network, so it cannot be used with an analysis")
+
+	if args.engine == "count" and args.scheduler != "synchronous":
+		parser.error("The count engine only supports the synchronous scheduler")
+
+	if args.min_rounds > args.rounds and (args.ci_width is not None or args.relative_error is not None):
+		parser.error(f"The minimum number of repetitions may not exceed the number of rounds ({args.rounds})")
+
+	if args.resume:
+		if args.checkpoint is None:
+			parser.error("A checkpoint file must be given to resume from (use -checkpoint)")
+
+		if not os.path.exists(args.checkpoint):
+			parser.error(f"The checkpoint file {args.checkpoint} does not exist")
+
+	if args.profile and args.workers > 1:
+		parser.error("Profiling only records the main process, so it requires a single worker (-j 1)")
+
+	if args.topology != "complete":
+		if args.engine != "agent":
+			parser.error(f"The {args.engine} engine only supports the complete topology")
+
+		if args.nodes is None:
+			parser.error("A sparse topology may only be used with a node count")
+
+		if args.degree >= args.nodes:
+			parser.error(f"The degree must be less than the number of nodes ({args.nodes})")
+
+	if args.states is not None:
+		# Check nodes is provided
+		if args.nodes is None:
+			parser.error("A state configuration may only be provided with a node count.")
+
+		if len(args.states) > 1 and sum(args.states) != args.nodes:
+			# If a state config is given, check the number of nodes in the configuration matches the nodes specified in the network
+			raise argparse.ArgumentTypeError(f"The number of nodes specified ({args.nodes}) does not match the nodes in the state configuration ({sum(args.states)})")
+
+		if len(args.states) == 1:
+			# Only 1 state provided, this means this is the given state
+			if (args.states[0]) > args.nodes:
+				raise argparse.ArgumentTypeError(f"The number of states must be less than or equal to the number of nodes ({args.nodes})")
+			network_states = args.states[0]
+			state_config = None
+		else:
+			network_states = len(args.states)
+			state_config = args.states
+
+	# Create the network specified by the number of nodes and the state configuration
+	protocol = PROTOCOLS.get(args.protocol)
+
+	if args.animate is not None:
+		animate_network(args, network_states, state_config, protocol)
+		return
+
+	# Get the analyser that was selected
+	analyser_type = ANALYSERS.get(args.analysis, None)
+
+	if analyser_type is None:
+		print("Error: An unknown analyser was selected")
 	else:
-		network_states = len(args.states)
-		state_config = args.states
-
-# Create the network specified by the number of nodes and the state configuration
-protocol = PROTOCOLS.get(args.protocol)
-
-# Get the analyser that was selected
-analyser_type = ANALYSERS.get(args.analysis, None)
-
-if analyser_type is None:
-	print("Error: An unknown analyser was selected")
-else:
-	# Perform the analysis
-	analyser = analyser_type(args.nodes, network_states, state_config, protocol, args.rounds)
-	analyser.analyse()
-	plt.show()
+		# Perform the analysis
+		# Without a seed, a random one is chosen and printed so the analysis can be reproduced
+		checkpoint = Checkpoint(args.checkpoint, args.checkpoint_interval) if args.checkpoint is not None else None
+
+		# A resumed analysis continues with the seed it was started with
+		seed = args.seed
+		if seed is None and args.resume:
+			seed = checkpoint.load_metadata()["seed"]
+		elif seed is None:
+			seed = np.random.SeedSequence().entropy
+			print(f"Using seed {seed}")
+
+			if args.cache is not None:
+				print("Warning: Cached points are only reused by analyses with the same seed, use -seed to reuse them")
+
+		# Every network of the analysis shares the same topology
+		topology = create_topology(args, protocol, seed)
+
+		# Repetitions of a data point stop early once the requested accuracy is met, -r is the maximum
+		stopping_rule = None
+		if args.ci_width is not None or args.relative_error is not None:
+			stopping_rule = StoppingRule(args.ci_width, args.relative_error, args.min_rounds, args.rounds)
+
+		# Results written to a file are only plotted if the figures are also saved
+		plot = args.output is None or args.save_figures is not None
+
+		cache = ResultCache(args.cache, args.cache_size * 2 ** 20) if args.cache is not None else None
+
+		analyser = analyser_type(args.nodes, network_states, state_config, protocol, args.rounds, ENGINES[args.engine], args.workers, args.scheduler, topology, args.adaptive, stopping_rule, seed, args.output, plot, cache, checkpoint, args.max_rounds)
+		if args.resume:
+			try:
+				print(f"Resuming from {analyser.resume()} points saved in {args.checkpoint}")
+			except ValueError as e:
+				parser.error(str(e))
+
+		# The profiler only replaces the simulation's methods while the analysis runs
+		profiler = Profiler() if args.profile else None
+		try:
+			with profiler if profiler is not None else contextlib.nullcontext():
+				analyser.analyse()
+		finally:
+			analyser.close()
+
+		if profiler is not None:
+			print(profiler.report())
+
+		# pyplot is only loaded if the analysis plotted anything
+		if "matplotlib.pyplot" in sys.modules:
+			if args.save_figures is not None:
+				save_figures(args.save_figures, args.analysis)
+			else:
+				import matplotlib.pyplot as plt
+				plt.show()
+
+
+def create_topology(args, protocol, seed):
+	# The topology given by the arguments, or None for a complete network
+	if args.topology == "complete":
+		return None
+
+	try:
+		topology = TOPOLOGIES[args.topology](args.nodes, args.degree, seed)
+	except ValueError as e:
+		parser.error(str(e))
+
+	# Every node needs as many neighbours as the protocol samples
+	if protocol is not None and protocol.sample_size is not None and topology.degrees.min() < protocol.sample_size:
+		parser.error(f"The {args.protocol} protocol requires {protocol.sample_size} neighbours, but some nodes of the {args.topology} topology have {topology.degrees.min()}")
+
+	return topology
+
+
+def animate_network(args, network_states, state_config, protocol):
+	# Runs the network given by the arguments and renders it to the -animate file
+	if args.nodes is None or network_states is None or protocol is None:
+		parser.error("Animating a network requires a number of nodes (-n), states (-s) and a protocol (-p)")
+
+	from animation import animate, animation_recording
+
+	seed = args.seed
+	if seed is None:
+		seed = np.random.SeedSequence().entropy
+		print(f"Using seed {seed}")
+
+	topology = create_topology(args, protocol, seed)
+
+	engine = ENGINES[args.engine]
+	network = engine.network_from_configuration(args.nodes, network_states, protocol, state_config, recording=animation_recording(engine, args.nodes),
+												scheduler=args.scheduler, topology=topology, seed=seed)
+
+	start = time.perf_counter()
+	try:
+		frames = animate(network, args.animate, args.fps, args.workers, seed=seed)
+	except ValueError as e:
+		parser.error(str(e))
+
+	print(f"Wrote {frames} frames to {args.animate} in {time.perf_counter() - start:.1f}s")
+
+
+# Worker processes may import this module, so only run the CLI when this is the main script
+if __name__ == "__main__":
+	main()
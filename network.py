@@ -2,108 +2,238 @@
 # to access components of the networks, such as the agents, opinions etc.
 
 import random
-from agents import HonestAgent
+import numpy as np
+from agents import AgentStore, HONEST, FAULTY
+from ensemble import EnsembleSimulation
+from trajectory import RECORDING_MODES, counts_to_dict
+from schedulers import SCHEDULERS
+from topology import CompleteTopology
 
 
-# A network is simply a list of nodes/agents, each with a specified state
-# Since the network is fully connected, we do not have to store the edges between the
+def validate_configuration(number_of_nodes, number_of_states, state_config=None, faulty_config=None):
+	# Validates the parameters of network_from_configuration, raising a ValueError if they are invalid
+	if number_of_states > number_of_nodes:
+		raise ValueError("Number of states must be less than or equal to number of nodes.")
+
+	faulty_nodes = 0
+	if faulty_config is not None:
+		if len(faulty_config) != number_of_states:
+			raise ValueError(
+				f"The number of states in the faulty configuration ({len(faulty_config)}) does not much the number of states provided ({number_of_states})")
+
+		faulty_nodes = sum(faulty_config)
+
+	if state_config is not None:
+		if sum(state_config) + faulty_nodes != number_of_nodes:
+			raise ValueError(
+				f"The number of nodes in the state configuration ({sum(state_config) + faulty_nodes}) does not much the number of nodes provided ({number_of_nodes})")
+
+		if len(state_config) != number_of_states:
+			raise ValueError(
+				f"The number of states in the state configuration ({len(state_config)}) does not much the number of states provided ({number_of_states})")
+	elif faulty_nodes > number_of_nodes:
+		raise ValueError(f"The number of faulty nodes ({faulty_nodes}) exceeds the number of nodes provided ({number_of_nodes})")
+
+
+def as_seed_sequence(seed=None):
+	# Converts a seed (an int, a SeedSequence or None for a random seed) to a SeedSequence
+	return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+
+def create_generators(seed=None):
+	# Creates the random generators of a network from a seed, either an int, a SeedSequence or None for a random seed
+	# Returns the seed sequence, a NumPy Generator (used by batched rounds) and a random.Random (used by protocols
+	# run one agent at a time), each an independent stream spawned from the seed sequence
+	seed_sequence = as_seed_sequence(seed)
+	numpy_seed, python_seed = seed_sequence.spawn(2)
+	python_state = python_seed.generate_state(4, np.uint64)
+	return seed_sequence, np.random.default_rng(numpy_seed), random.Random(int.from_bytes(python_state.tobytes(), "little"))
+
+
+def create_trajectory(recording):
+	# Creates the trajectory a network records its rounds to, given the name of the recording mode
+	if recording not in RECORDING_MODES:
+		raise ValueError(f"Unknown recording mode {recording}, expected one of {', '.join(RECORDING_MODES)}")
+
+	return RECORDING_MODES[recording]()
+
+
+# A network is simply a list of nodes/agents, each with a specified state, stored as arrays (see AgentStore)
+# By default the network is fully connected, so we do not have to store the edges between the
 # nodes, we can simply select any other node when looking for neighbours as all nodes
-# neighbour each other
+# neighbour each other. Otherwise the topology stores which nodes neighbour each other (see topology.py)
 class PopulationNetwork:
-	def __init__(self, agents, protocol):
+	# Whether the state of every node can be read, otherwise only the number of nodes in each state is known
+	stores_states = True
+
+	def __init__(self, agents, protocol, recording="counts", scheduler="synchronous", topology=None, seed=None):
 		# We accept
-		# The network graph, list of agents
-		self.graph = agents
+		# The network graph, either a list of agents or an AgentStore
+		self.graph = agents if isinstance(agents, AgentStore) else AgentStore.from_agents(agents)
+
+		# Which nodes neighbour each other, node i of the topology is agent i
+		if topology is None:
+			topology = CompleteTopology(len(agents))
+		elif topology.get_number_of_nodes() != len(agents):
+			raise ValueError(f"The topology has {topology.get_number_of_nodes()} nodes, but there are {len(agents)} agents")
 
-		# A dictionary of the states of this network in each round
-		# The key is the round number (0 = initial state) and the value is the list of states
-		# of the network in this round
-		self.data = {}
+		self.topology = topology
+
+		# The states of this network in each round (see trajectory.py), recording is one of
+		# counts, states, deltas or none
+		self.data = create_trajectory(recording)
 
 		self.protocol = protocol
+
+		# The random streams of this network, so a run can be reproduced from its seed (see create_generators)
+		# rng is the NumPy Generator of batched rounds, random is passed to the protocol when agents run one at a time
+		self.seed_sequence, self.rng, self.random = create_generators(seed)
+
+		# The scheduler decides when each agent runs the protocol, either synchronous or sequential
+		if scheduler not in SCHEDULERS:
+			raise ValueError(f"Unknown scheduler {scheduler}, expected one of {', '.join(SCHEDULERS)}")
+
+		self.scheduler = SCHEDULERS[scheduler]()
+
+		# When every agent is honest or faulty (so updating an agent is a masked write), the protocol can run
+		# a whole round at once using its batched method
+		self.batched = protocol.supports_batch() and not self.graph.has_custom_agents()
+
+		# Live count of the number of agents in each state (indexed by state), this is kept up to date
+		# as agents are updated, so agents should only be updated through the network
+		self.state_counts = np.bincount(self.graph.states)
+
 		self.round = 0
 		self.log_graph()
 
 	@classmethod
-	def network_from_configuration(cls, number_of_nodes, number_of_states, protocol, state_config=None):
+	def network_from_configuration(cls, number_of_nodes, number_of_states, protocol, state_config=None, faulty_config=None, recording="counts", scheduler="synchronous", topology=None, seed=None):
 		# Create a network given various parameters
-		if number_of_states > number_of_nodes:
-			raise ValueError("Number of states must be less than or equal to number of nodes.")
+		# faulty_config optionally gives the number of faulty agents in each state, these are
+		# included in the number of nodes but not in the state configuration
+		# seed makes the network reproducible, including its random initial states
+		validate_configuration(number_of_nodes, number_of_states, state_config, faulty_config)
+		seed_sequence = as_seed_sequence(seed)
 
 		# Node configuration is the state of every single node, each element is the state
 		# and the index gives which node is in that state initially
-		node_configuration = []
+		honest_nodes = number_of_nodes - (sum(faulty_config) if faulty_config is not None else 0)
 
 		if state_config is None:
 			# No configuration given, choose a random state for each agent
-			states = range(0, number_of_states)
-			node_configuration.extend([random.choice(states) for j in range(number_of_nodes)])
+			rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+			node_configuration = rng.integers(0, number_of_states, size=honest_nodes)
 		else:
-			# A configuration was given, validate it to ensure configuration matches number of states
-			if sum(state_config) != number_of_nodes:
-				raise ValueError(
-					f"The number of nodes in the state configuration ({sum(state_config)}) does not much the number of nodes provided ({number_of_nodes})")
+			# Use the given configuration to generate the node states
+			node_configuration = np.repeat(np.arange(number_of_states), state_config)
 
-			if len(state_config) != number_of_states:
-				raise ValueError(
-					f"The number of states in the state configuration ({len(state_config)}) does not much the number of states provided ({number_of_states})")
+		# Create representation of agents, honest agents first followed by the faulty agents
+		faulty_states = np.repeat(np.arange(number_of_states), faulty_config if faulty_config is not None else 0)
+		behaviours = np.concatenate([np.full(honest_nodes, HONEST), np.full(len(faulty_states), FAULTY)])
+		agents = AgentStore(np.concatenate([node_configuration, faulty_states]), behaviours)
 
-			# Use the given configuration to generate the node states
-			for state in range(len(state_config)):
-				node_configuration.extend([state for _ in range(state_config[state])])
+		return cls(agents, protocol, recording, scheduler, topology, seed_sequence)
 
-		agents = []
-		# Create representation of agents
-		# Use the state configuration, if one is given to initialise the agents
-		for i in range(len(node_configuration)):
-			agents.append(HonestAgent(node_configuration[i]))
+	@classmethod
+	def run_trials(cls, protocol, trials, state_config, faulty_config=None, rng=None, scheduler="synchronous", topology=None, max_rounds=None):
+		# Runs independent networks with the given configuration until they converge, or max_rounds rounds have run
+		# Returns arrays of the number of rounds logged (network.round) and the winning state of each trial, trials
+		# that did not converge have a winner of -1
+		# Every trial is seeded from rng, so the trials are reproducible given its seed
+		if rng is None:
+			rng = np.random.default_rng()
+
+		if protocol.supports_batch() and scheduler == "synchronous":
+			# Simulate all of the trials at once
+			return EnsembleSimulation(protocol, trials, state_config, faulty_config, rng=rng, topology=topology).run(max_rounds)
+
+		number_of_states = len(state_config)
+		number_of_nodes = sum(state_config) + (sum(faulty_config) if faulty_config is not None else 0)
+
+		# Each trial gets its own independent stream
+		trial_seeds = np.random.SeedSequence(rng.integers(0, 2 ** 63, size=4).tolist()).spawn(trials)
+
+		rounds = np.zeros(trials, dtype=np.int64)
+		winners = np.zeros(trials, dtype=np.int64)
+		for trial in range(trials):
+			network = cls.network_from_configuration(number_of_nodes, number_of_states, protocol, state_config, faulty_config, scheduler=scheduler, topology=topology, seed=trial_seeds[trial])
+			while not network.has_converged() and (max_rounds is None or network.round <= max_rounds):
+				network.run_round()
+
+			rounds[trial] = network.round
+			winners[trial] = network.get_states()[0] if network.has_converged() else -1
 
-		return cls(agents, protocol)
+		return rounds, winners
 
 	def has_converged(self):
-		return self.protocol.is_converged(self.get_states())
+		return self.protocol.is_converged_counts(self.state_counts)
+
+	def is_finished(self):
+		# Whether later rounds can no longer change the network, a simulated network runs until it converges
+		return self.has_converged()
 
 	def get_states(self):
 		# Returns a list of all states in this graph
-		return [agent.state for agent in self.graph]
+		return self.graph.states.tolist()
+
+	def get_state_array(self, nodes=None):
+		# Returns a copy of the array of all states in this graph, or of the states of the given node indices
+		return self.graph.states.copy() if nodes is None else self.graph.states[nodes]
+
+	def get_state_counts(self):
+		# Returns a dictionary of state -> number of nodes in that state
+		return counts_to_dict(self.state_counts)
+
+	def update_agent(self, node, new_state):
+		# Updates the agent of a node using its behaviour, and moves it between state counts if its state changed
+		# Returns the state of the agent afterwards
+		old_state = int(self.graph.states[node])
+		state = self.graph.update(node, new_state)
+
+		if state != old_state:
+			self.grow_state_counts(state)
+			self.state_counts[old_state] -= 1
+			self.state_counts[state] += 1
+
+		return state
+
+	def update_agents(self, indices, new_states):
+		# Updates many agents at once given arrays of their indices and new states
+		old_states = self.graph.states[indices]
+		states = self.graph.update_many(indices, np.asarray(new_states))
+
+		# Only the changed states need counting
+		changed = old_states != states
+		if changed.any():
+			self.grow_state_counts(int(states[changed].max()))
+			self.state_counts -= np.bincount(old_states[changed], minlength=len(self.state_counts))
+			self.state_counts += np.bincount(states[changed], minlength=len(self.state_counts))
+
+	def grow_state_counts(self, state):
+		# Makes room in the state counts for a state that no agent has been in yet
+		if state >= len(self.state_counts):
+			self.state_counts = np.concatenate([self.state_counts, np.zeros(state + 1 - len(self.state_counts), dtype=self.state_counts.dtype)])
+
+	def get_neighbour_states(self, states, node):
+		# The states of the neighbours of a node, given the list of states of every node
+		return self.topology.get_neighbour_states(states, node)
 
 	def log_graph(self):
 		# Add the current configuration and increase round number
-		self.data[self.round] = self.get_states()
+		if self.data.needs_states:
+			self.data.record_states(self.graph.states)
+		else:
+			self.data.record_counts(self.state_counts)
+
 		self.round += 1
 
 	def run_round(self):
-		# This runs the protocol using synchronous interactions, i.e all nodes are updated
-		# (seemingly) simultaneously
+		# This runs one round of the protocol, using the network's scheduler to decide when each node runs
 		# self.round holds the round that is currently about to run
 		if self.has_converged():
 			return
-		
-		# Should copy the agents states
-		graph_copy = [agent.state for agent in self.graph]
-		
-		# For every node, run the protocol
-		for agent in range(len(self.graph)):
-			# agent is the index of the agent
-			# Calculate new state based on neighbours (using copy of graph)
-
-			# Agents state
-			agent_state = graph_copy[agent]
-
-			# Neighbouring states, all nodes that don't have the index as this current node
-			# We remove this current node from the graph temporarily, then sample from the remaining list
-			# Once it has been sampled, the node is then inserted back into the graph
-			agent_copy = graph_copy.pop(agent)
-			neighbour_states = graph_copy
-
-			# Run protocol to find new state
-			new_state = self.protocol.run(agent_state, neighbour_states)
 
-			# Insert back into the list
-			graph_copy.insert(agent, agent_copy)
-
-			# Update this node using agent update method
-			self.graph[agent].update_state(new_state)
+		self.scheduler.run_round(self)
 
 		# Log the new state of the network
 		self.log_graph()
@@ -114,3 +244,397 @@ class PopulationNetwork:
 		
 	def get_graph(self):
 		return self.graph
+
+
+
+# A network that only stores the number of agents in each state, rather than the agents themselves
+# Since the network is fully connected, agents in the same state are interchangeable, so a round
+# can be run by moving counts between states (see PopulationProtocol.run_counts). A round costs
+# O(states^2) rather than O(nodes), so much larger networks can be simulated
+class CountNetwork:
+	stores_states = False
+
+	def __init__(self, state_counts, protocol, faulty_counts=None, recording="counts", seed=None):
+		# state_counts is the number of honest agents in each state, faulty_counts is the number
+		# of faulty agents in each state (these never update)
+		self.counts = np.array(state_counts, dtype=np.int64)
+
+		if faulty_counts is None:
+			self.faulty_counts = np.zeros_like(self.counts)
+		else:
+			self.faulty_counts = np.array(faulty_counts, dtype=np.int64)
+
+		# The state counts of this network in each round, individual nodes are not stored so
+		# only the counts and none recording modes can be used
+		if recording not in ("counts", "none"):
+			raise ValueError(f"A count network cannot record {recording}, only counts or none")
+
+		self.data = create_trajectory(recording)
+
+		self.protocol = protocol
+
+		# Only the NumPy Generator is used, as agents are never run one at a time
+		self.seed_sequence, self.rng, _ = create_generators(seed)
+		self.round = 0
+		self.log_graph()
+
+	@classmethod
+	def network_from_configuration(cls, number_of_nodes, number_of_states, protocol, state_config=None, faulty_config=None, recording="counts", scheduler="synchronous", topology=None, seed=None):
+		# Create a network given the same parameters as PopulationNetwork.network_from_configuration
+		if scheduler != "synchronous":
+			raise ValueError("The count engine only supports the synchronous scheduler")
+
+		if topology is not None and not topology.is_complete():
+			raise ValueError("The count engine only supports complete networks")
+
+		validate_configuration(number_of_nodes, number_of_states, state_config, faulty_config)
+		seed_sequence = as_seed_sequence(seed)
+
+		faulty_counts = np.zeros(number_of_states, dtype=np.int64) if faulty_config is None else faulty_config
+
+		if state_config is None:
+			# No configuration given, choose a random state for each agent
+			honest_nodes = number_of_nodes - sum(faulty_counts)
+			rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+			state_config = rng.multinomial(honest_nodes, [1 / number_of_states] * number_of_states)
+
+		return cls(state_config, protocol, faulty_counts, recording, seed_sequence)
+
+	@classmethod
+	def run_trials(cls, protocol, trials, state_config, faulty_config=None, rng=None, scheduler="synchronous", topology=None, max_rounds=None):
+		# Runs independent networks with the given configuration until they converge (or max_rounds rounds have run),
+		# simulating the counts of every trial at once. Returns the same as PopulationNetwork.run_trials
+		if scheduler != "synchronous":
+			raise ValueError("The count engine only supports the synchronous scheduler")
+
+		if topology is not None and not topology.is_complete():
+			raise ValueError("The count engine only supports complete networks")
+
+		return EnsembleSimulation(protocol, trials, state_config, faulty_config, counts=True, rng=rng).run(max_rounds)
+
+	def has_converged(self):
+		return self.protocol.is_converged_counts(self.counts + self.faulty_counts)
+
+	def is_finished(self):
+		# Whether later rounds can no longer change the network, a simulated network runs until it converges
+		return self.has_converged()
+
+	def get_states(self):
+		# Returns a list of all states in this graph, ordered by state
+		return np.repeat(np.arange(len(self.counts)), self.counts + self.faulty_counts).tolist()
+
+	def get_state_counts(self):
+		# Returns a dictionary of state -> number of nodes in that state
+		return counts_to_dict(self.counts + self.faulty_counts)
+
+	def log_graph(self):
+		# Add the current state counts and increase round number
+		self.data.record_counts(self.counts + self.faulty_counts)
+		self.round += 1
+
+	def run_round(self):
+		# Runs a synchronous round, moving whole groups of agents between states
+		if self.has_converged():
+			return
+
+		self.counts = self.protocol.run_counts(self.counts, self.faulty_counts, self.rng)
+		self.log_graph()
+
+	def get_number_of_nodes(self):
+		# Number of nodes in the graph
+		return int(self.counts.sum() + self.faulty_counts.sum())
+
+
+# Mean-field rounds run by a trial (or a single network) before it is treated as not converging
+MEAN_FIELD_MAX_ROUNDS = 10000
+
+# Without diffusion, a network whose fractions change by less than this in a round is at a fixed point and never converges
+MEAN_FIELD_FIXED_POINT_TOLERANCE = 1e-12
+
+# Integration steps per round (one unit of parallel time) of the mean-field ODE used with the sequential scheduler
+MEAN_FIELD_STEPS_PER_ROUND = 10
+
+
+def expected_transitions(protocol, total_fractions, nodes):
+	# The probability of an agent in state i moving to state j, given the fraction of all agents (including faulty
+	# agents) in each state. As in PopulationProtocol.run_counts, using the expected number of agents in each state
+	# A state expected to hold less than one agent is clipped to none in its own pool, so the pool can fall short of
+	# the other agents, the number of neighbours of every agent is given as nodes - 1 instead
+	pool = nodes * total_fractions[..., None, :] - np.eye(total_fractions.shape[-1])
+	pool_size = np.full(pool.shape[:-1] + (1,), nodes - 1.0)
+	probabilities = np.maximum(protocol.count_transitions(np.maximum(pool, 0), pool_size), 0)
+	return probabilities / probabilities.sum(axis=-1, keepdims=True)
+
+
+def gaussian_noise(rng, covariance):
+	# Samples from a normal distribution with mean 0 and the given covariance matrix (any leading axes are independent)
+	# The covariance matrices of the state fractions are singular (fractions always sum to the same total), so they are
+	# factorised by their eigenvalues rather than a Cholesky decomposition
+	eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+	z = rng.standard_normal(eigenvalues.shape) * np.sqrt(np.maximum(eigenvalues, 0))
+	return np.einsum("...ij,...j->...i", eigenvectors, z)
+
+
+def remove_extinct_states(fractions, previous_fractions, honest_fraction, nodes):
+	# Removes shrinking states with fewer than half an agent expected (so networks can converge), other than the largest
+	# state, and renormalises the fractions of honest agents to their total. States that are growing are kept, so a state
+	# can still be reached from a few agents (e.g faulty agents)
+	fractions = np.maximum(fractions, 0)
+	extinct = (fractions * nodes < 0.5) & (fractions < previous_fractions) & (fractions < fractions.max(axis=-1, keepdims=True))
+	fractions = np.where(extinct, 0, fractions)
+	return fractions * (honest_fraction / fractions.sum(axis=-1, keepdims=True))
+
+
+def mean_field_round(protocol, fractions, faulty_fractions, nodes, scheduler, rng=None):
+	# Runs one round of the mean-field dynamics, returning the new fractions of honest agents in each state
+	# fractions and faulty_fractions are fractions of all nodes, any leading axes of fractions are independent networks
+	# If rng is given, the diffusion approximation of a network of the given number of nodes adds random fluctuations
+	honest_fraction = fractions.sum(axis=-1, keepdims=True)
+
+	if scheduler == "synchronous":
+		# Each agent moves independently, so a round moves the expected fractions x -> xP(x). The number of agents leaving
+		# each state is multinomial, which is approximated by a normal distribution with the same covariance
+		transitions = expected_transitions(protocol, fractions + faulty_fractions, nodes)
+		new_fractions = np.einsum("...i,...ij->...j", fractions, transitions)
+		if rng is not None:
+			covariance = diagonal(new_fractions) - np.einsum("...ij,...i,...ik->...jk", transitions, fractions, transitions)
+			new_fractions = new_fractions + gaussian_noise(rng, covariance / nodes)
+
+		return remove_extinct_states(new_fractions, fractions, honest_fraction, nodes)
+
+	# With the sequential scheduler a random agent moves at each step, over a round of parallel time the fractions follow
+	# dx/dt = xP(x) - x. This is integrated with RK4, or with Euler-Maruyama steps when diffusion is added
+	dt = 1 / MEAN_FIELD_STEPS_PER_ROUND
+
+	def drift(x):
+		return np.einsum("...i,...ij->...j", x, expected_transitions(protocol, x + faulty_fractions, nodes)) - x
+
+	for _ in range(MEAN_FIELD_STEPS_PER_ROUND):
+		if rng is None:
+			k1 = drift(fractions)
+			k2 = drift(fractions + dt / 2 * k1)
+			k3 = drift(fractions + dt / 2 * k2)
+			k4 = drift(fractions + dt * k3)
+			new_fractions = fractions + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+		else:
+			# Each step moves one agent from state i to state j, so the fractions change by (e_j - e_i) / nodes
+			transitions = expected_transitions(protocol, fractions + faulty_fractions, nodes)
+			flow = transitions * fractions[..., :, None]
+			covariance = diagonal(flow.sum(axis=-2)) - flow - np.swapaxes(flow, -1, -2) + diagonal(fractions)
+			new_fractions = fractions + dt * (flow.sum(axis=-2) - fractions) + gaussian_noise(rng, covariance * dt / nodes)
+
+		fractions = remove_extinct_states(new_fractions, fractions, honest_fraction, nodes)
+
+	return fractions
+
+
+def diagonal(vectors):
+	# Diagonal matrices of the given vectors (along the last axis)
+	return vectors[..., :, None] * np.eye(vectors.shape[-1])
+
+
+# A network that follows the expected (mean-field) dynamics of the fraction of agents in each state, instead of simulating
+# agents or counts. A round costs O(states^2) however many nodes there are, so it gives near-instant approximations of
+# very large networks. Transitions use PopulationProtocol.count_transitions with the expected number of agents in each state
+# A state whose expected number of agents falls below half an agent is removed, so a network can converge. Without
+# diffusion the dynamics are deterministic, e.g a voter model network never converges as its expected fractions never change
+class MeanFieldNetwork:
+	# Whether random fluctuations of a network with this many nodes are added, see DiffusionNetwork
+	diffusion = False
+	stores_states = False
+
+	def __init__(self, state_counts, protocol, faulty_counts=None, recording="counts", scheduler="synchronous", seed=None):
+		# state_counts is the number of honest agents in each state, faulty_counts is the number of faulty agents
+		# in each state (these never update)
+		state_counts = np.array(state_counts, dtype=np.float64)
+		faulty_counts = np.zeros_like(state_counts) if faulty_counts is None else np.array(faulty_counts, dtype=np.float64)
+
+		self.nodes = state_counts.sum() + faulty_counts.sum()
+		self.fractions = state_counts / self.nodes
+		self.faulty_fractions = faulty_counts / self.nodes
+
+		if scheduler not in SCHEDULERS:
+			raise ValueError(f"Unknown scheduler {scheduler}, expected one of {', '.join(SCHEDULERS)}")
+
+		self.scheduler = scheduler
+
+		# Only the (expected) counts are recorded, as with a count network
+		if recording not in ("counts", "none"):
+			raise ValueError(f"A mean-field network cannot record {recording}, only counts or none")
+
+		self.data = create_trajectory(recording)
+
+		self.protocol = protocol
+		self.seed_sequence, self.rng, _ = create_generators(seed)
+
+		# Set once the fractions stop changing, without diffusion the network then stays the same in every later round
+		self.fixed_point = False
+
+		self.round = 0
+		self.log_graph()
+
+	@classmethod
+	def network_from_configuration(cls, number_of_nodes, number_of_states, protocol, state_config=None, faulty_config=None, recording="counts", scheduler="synchronous", topology=None, seed=None):
+		# Create a network given the same parameters as PopulationNetwork.network_from_configuration
+		if topology is not None and not topology.is_complete():
+			raise ValueError("The mean-field engine only supports complete networks")
+
+		validate_configuration(number_of_nodes, number_of_states, state_config, faulty_config)
+
+		faulty_counts = np.zeros(number_of_states, dtype=np.int64) if faulty_config is None else faulty_config
+
+		if state_config is None:
+			# No configuration given, the honest agents are expected to be split evenly between the states
+			honest_nodes = number_of_nodes - sum(faulty_counts)
+			state_config = np.full(number_of_states, honest_nodes / number_of_states)
+
+		return cls(state_config, protocol, faulty_counts, recording, scheduler, seed)
+
+	@classmethod
+	def run_trials(cls, protocol, trials, state_config, faulty_config=None, rng=None, scheduler="synchronous", topology=None, max_rounds=None):
+		# Runs the mean-field dynamics of every trial at once until they converge, returns the same as PopulationNetwork.run_trials
+		# Trials that have not converged after MEAN_FIELD_MAX_ROUNDS (or max_rounds, if smaller) have a winner of -1
+		if topology is not None and not topology.is_complete():
+			raise ValueError("The mean-field engine only supports complete networks")
+
+		if rng is None:
+			rng = np.random.default_rng()
+
+		state_config = np.array(state_config, dtype=np.float64)
+		faulty_config = np.zeros_like(state_config) if faulty_config is None else np.array(faulty_config, dtype=np.float64)
+		nodes = state_config.sum() + faulty_config.sum()
+		faulty_fractions = faulty_config / nodes
+
+		# Without diffusion every trial is the same, so only one is run
+		simulated = trials if cls.diffusion else 1
+		fractions = np.tile(state_config / nodes, (simulated, 1))
+		rounds = np.zeros(simulated, dtype=np.int64)
+		winners = np.full(simulated, -1, dtype=np.int64)
+		active = np.arange(simulated)
+		round_limit = MEAN_FIELD_MAX_ROUNDS if max_rounds is None else min(max_rounds, MEAN_FIELD_MAX_ROUNDS)
+
+		while len(active) > 0:
+			rounds[active] += 1
+
+			counts = (fractions + faulty_fractions) * nodes
+			converged = protocol.converged_batch(counts)
+			winners[active[converged]] = counts[converged].argmax(axis=-1)
+
+			running = ~converged & (rounds[active] <= round_limit)
+			active, fractions = active[running], fractions[running]
+			if len(active) == 0:
+				break
+
+			new_fractions = mean_field_round(protocol, fractions, faulty_fractions, nodes, scheduler, rng if cls.diffusion else None)
+
+			# Without diffusion, a trial that has reached a fixed point (e.g the voter model) will never converge
+			if not cls.diffusion and np.allclose(new_fractions, fractions, rtol=0, atol=MEAN_FIELD_FIXED_POINT_TOLERANCE):
+				break
+
+			fractions = new_fractions
+
+		if not cls.diffusion:
+			return np.repeat(rounds, trials), np.repeat(winners, trials)
+
+		return rounds, winners
+
+	def get_counts(self):
+		# The expected number of agents in each state
+		return (self.fractions + self.faulty_fractions) * self.nodes
+
+	def has_converged(self):
+		return self.protocol.is_converged_counts(self.get_counts())
+
+	def is_finished(self):
+		# Whether the network has converged, reached a fixed point or run MEAN_FIELD_MAX_ROUNDS rounds, as in run_trials
+		# A finished network that has not converged is treated as never converging
+		return self.has_converged() or self.fixed_point or self.round > MEAN_FIELD_MAX_ROUNDS
+
+	def get_states(self):
+		# Returns a list of all states in this graph, ordered by state, using the expected counts rounded to whole agents
+		return np.repeat(np.arange(len(self.fractions)), np.rint(self.get_counts()).astype(np.int64)).tolist()
+
+	def get_state_counts(self):
+		# Returns a dictionary of state -> expected number of nodes in that state, rounded to whole agents
+		return counts_to_dict(np.rint(self.get_counts()).astype(np.int64))
+
+	def log_graph(self):
+		# Add the expected state counts (rounded to whole agents) and increase round number
+		self.data.record_counts(np.rint(self.get_counts()).astype(np.int64))
+		self.round += 1
+
+	def run_round(self):
+		# Runs one round of the mean-field dynamics
+		if self.is_finished():
+			return
+
+		new_fractions = mean_field_round(self.protocol, self.fractions, self.faulty_fractions, self.nodes, self.scheduler, self.rng if self.diffusion else None)
+
+		# The round that reaches a fixed point is not logged, as it is the same as the last round
+		if not self.diffusion and np.allclose(new_fractions, self.fractions, rtol=0, atol=MEAN_FIELD_FIXED_POINT_TOLERANCE):
+			self.fixed_point = True
+			return
+
+		self.fractions = new_fractions
+		self.log_graph()
+
+	def get_number_of_nodes(self):
+		# Number of nodes in the graph
+		return int(round(self.nodes))
+
+
+# A mean-field network with a diffusion (SDE) correction, the fluctuations of a network with this many nodes are
+# approximated by normally distributed noise with the covariance of a round. Unlike the mean-field network, trials
+# differ from each other and networks converge, so convergence probabilities and times can be estimated
+class DiffusionNetwork(MeanFieldNetwork):
+	diffusion = True
+
+
+# A network that replays the rounds recorded in a trajectory (e.g loaded with trajectory.load_trajectory) rather than
+# running a protocol, each round moves on to the next recorded round. It has the same interface as the other networks,
+# so a recorded run can be shown (e.g by the GUI) in the same way as a live one
+class RecordedNetwork:
+	def __init__(self, data, converged=True, topology=None):
+		# data is the recorded trajectory, converged is whether the recorded run converged in its last round
+		self.data = data
+		self.stores_states = data.needs_states
+		self.converged = converged
+
+		self.topology = topology if topology is not None else CompleteTopology(self.get_number_of_nodes())
+
+		# As with other networks, round is the number of rounds logged so far (the first is the initial configuration)
+		self.round = 1
+
+	def has_converged(self):
+		return self.converged and self.is_finished()
+
+	def is_finished(self):
+		# Whether every recorded round has been replayed, as with other networks no later round changes the network
+		return self.round >= len(self.data)
+
+	def get_states(self):
+		return self.get_state_array().tolist()
+
+	def get_state_array(self, nodes=None):
+		states = self.data.get_states(self.round - 1)
+		return states.copy() if nodes is None else states[nodes]
+
+	def get_state_counts(self):
+		return self.data.get_counts(self.round - 1)
+
+	def run_round(self):
+		# Moves on to the next recorded round
+		if not self.is_finished():
+			self.round += 1
+
+	def get_number_of_nodes(self):
+		return sum(self.data.get_counts(0).values())
+
+
+# Simulation engines name -> network class
+ENGINES = {
+	"agent": PopulationNetwork,
+	"count": CountNetwork,
+	"mean-field": MeanFieldNetwork,
+	"diffusion": DiffusionNetwork
+}
@@ -0,0 +1,283 @@
+# This file contains an optional profiler for simulations, it records the time spent in each phase of a
+# round (finding neighbours, running the protocol, updating agents, logging and checking convergence),
+# the latency of every round and the number of memory blocks allocated by each round
+#
+# While a profiler is active, the methods of each phase are replaced by timed wrappers on their classes.
+# They are restored when it stops, so simulations run exactly as before when profiling is switched off
+#
+# Usage:
+#	with Profiler() as profiler:
+#		analyser.analyse()
+#	print(profiler.report())
+
+import collections
+import functools
+import sys
+import time
+import tracemalloc
+import numpy as np
+import network
+import protocols
+from ensemble import EnsembleSimulation
+from network import PopulationNetwork, CountNetwork, MeanFieldNetwork
+from protocols import PopulationProtocol
+from topology import CompleteTopology, CSRTopology
+
+# The phases time is recorded for, in the order they are reported
+NEIGHBOURS_PHASE = "neighbours"
+PROTOCOL_PHASE = "protocol.run"
+UPDATE_PHASE = "update_state"
+LOG_PHASE = "log_graph"
+CONVERGENCE_PHASE = "has_converged"
+ROUND_PHASE = "round (other)"
+PHASES = [NEIGHBOURS_PHASE, PROTOCOL_PHASE, UPDATE_PHASE, LOG_PHASE, CONVERGENCE_PHASE, ROUND_PHASE]
+
+# The methods timed by each phase, class -> method name -> phase
+# Protocol methods are timed on every subclass of PopulationProtocol that defines them
+NETWORK_METHODS = {
+	PopulationNetwork: {
+		"get_neighbour_states": NEIGHBOURS_PHASE,
+		"update_agent": UPDATE_PHASE,
+		"update_agents": UPDATE_PHASE,
+		"log_graph": LOG_PHASE,
+		"has_converged": CONVERGENCE_PHASE
+	},
+	CountNetwork: {
+		"log_graph": LOG_PHASE,
+		"has_converged": CONVERGENCE_PHASE
+	},
+	# Also times DiffusionNetwork, which inherits these
+	MeanFieldNetwork: {
+		"log_graph": LOG_PHASE,
+		"has_converged": CONVERGENCE_PHASE
+	},
+	CompleteTopology: {
+		"get_neighbour_states": NEIGHBOURS_PHASE,
+		"sample_neighbours": NEIGHBOURS_PHASE,
+		"choose_neighbours": NEIGHBOURS_PHASE
+	},
+	CSRTopology: {
+		"get_neighbour_states": NEIGHBOURS_PHASE,
+		"sample_neighbours": NEIGHBOURS_PHASE,
+		"choose_neighbours": NEIGHBOURS_PHASE
+	},
+	EnsembleSimulation: {
+		"count_states": CONVERGENCE_PHASE,
+		"finish_converged": CONVERGENCE_PHASE
+	}
+}
+
+PROTOCOL_METHODS = {
+	"run": PROTOCOL_PHASE,
+	"run_batch": PROTOCOL_PHASE,
+	"run_sampled": PROTOCOL_PHASE,
+	"run_counts": PROTOCOL_PHASE,
+	"is_converged": CONVERGENCE_PHASE,
+	"is_converged_counts": CONVERGENCE_PHASE,
+	"converged_batch": CONVERGENCE_PHASE
+}
+
+# Functions of the protocols module that are timed, batched rounds on complete networks sample neighbours with these
+PROTOCOL_FUNCTIONS = {
+	"sample_neighbours": NEIGHBOURS_PHASE,
+	"choose_neighbours": NEIGHBOURS_PHASE
+}
+
+# Functions of the network module that are timed, the mean-field engines run the protocol's expected transitions with these
+NETWORK_FUNCTIONS = {
+	"mean_field_round": PROTOCOL_PHASE
+}
+
+# Round latencies are counted in buckets between these powers of 10 seconds, with 2 buckets per power
+HISTOGRAM_MIN_EXPONENT = -6
+HISTOGRAM_MAX_EXPONENT = 3
+
+
+def protocol_classes():
+	# Every protocol class, including protocols defined outside of protocols.py
+	classes = []
+	pending = [PopulationProtocol]
+	while len(pending) > 0:
+		cls = pending.pop()
+		if cls not in classes:
+			classes.append(cls)
+			pending.extend(cls.__subclasses__())
+
+	return classes
+
+
+class Profiler:
+	# The profiler that is currently running, only one can run at a time as methods are replaced on their classes
+	active = None
+
+	def __init__(self, trace_memory=False):
+		# If trace_memory is set, the peak memory use is also traced (with tracemalloc), this slows down the simulation
+		self.trace_memory = trace_memory
+
+		# Exclusive time spent in each phase (not including the time of any phase it calls), and its number of calls
+		self.phase_times = collections.defaultdict(float)
+		self.phase_calls = collections.Counter()
+
+		# The latency (seconds) and net number of memory blocks allocated of every round run by a network
+		self.round_latencies = []
+		self.round_allocations = []
+
+		self.peak_memory = None
+
+		# The phases currently running, each as [phase, time spent in phases it called]
+		# Simulations are profiled on a single thread
+		self.stack = []
+
+		# (owner, attribute, original) of every replaced method, so they can be restored
+		self.replaced = []
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+
+	def start(self):
+		# Replaces the methods of each phase with timed versions
+		if Profiler.active is not None:
+			raise RuntimeError("Another profiler is already running")
+
+		Profiler.active = self
+
+		for owner, methods in NETWORK_METHODS.items():
+			for name, phase in methods.items():
+				self.replace(owner, name, self.timed(phase, vars(owner)[name]))
+
+		for cls in protocol_classes():
+			for name, phase in PROTOCOL_METHODS.items():
+				if name in cls.__dict__:
+					self.replace(cls, name, self.timed(phase, vars(cls)[name]))
+
+		for name, phase in PROTOCOL_FUNCTIONS.items():
+			self.replace(protocols, name, self.timed(phase, vars(protocols)[name]))
+
+		for name, phase in NETWORK_FUNCTIONS.items():
+			self.replace(network, name, self.timed(phase, vars(network)[name]))
+
+		for network_class in (PopulationNetwork, CountNetwork, MeanFieldNetwork):
+			self.replace(network_class, "run_round", self.timed_round(vars(network_class)["run_round"]))
+
+		if self.trace_memory:
+			tracemalloc.start()
+
+	def stop(self):
+		# Restores the original methods
+		for owner, name, original in reversed(self.replaced):
+			setattr(owner, name, original)
+
+		self.replaced = []
+
+		if self.trace_memory and tracemalloc.is_tracing():
+			_, self.peak_memory = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+
+		Profiler.active = None
+
+	def replace(self, owner, name, function):
+		self.replaced.append((owner, name, vars(owner)[name]))
+		setattr(owner, name, function)
+
+	def timed(self, phase, function):
+		# Wraps a function so the time spent in it is added to the phase
+		if isinstance(function, staticmethod):
+			return staticmethod(self.timed(phase, function.__func__))
+
+		profiler = self
+
+		@functools.wraps(function)
+		def timed_function(*args, **kwargs):
+			stack = profiler.stack
+
+			# Calls within the same phase (e.g a protocol calling its parent's run) are timed by the outer call
+			if len(stack) > 0 and stack[-1][0] == phase:
+				return function(*args, **kwargs)
+
+			frame = [phase, 0.0]
+			stack.append(frame)
+			start = time.perf_counter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				elapsed = time.perf_counter() - start
+				stack.pop()
+				profiler.phase_times[phase] += elapsed - frame[1]
+				profiler.phase_calls[phase] += 1
+				if len(stack) > 0:
+					stack[-1][1] += elapsed
+
+		return timed_function
+
+	def timed_round(self, function):
+		# Wraps run_round to record the latency and allocations of every round, time within the round that
+		# is not in any other phase (e.g the scheduler) is added to the round phase
+		timed_function = self.timed(ROUND_PHASE, function)
+		profiler = self
+
+		@functools.wraps(function)
+		def timed_round(*args, **kwargs):
+			blocks = sys.getallocatedblocks()
+			start = time.perf_counter()
+			result = timed_function(*args, **kwargs)
+			profiler.round_latencies.append(time.perf_counter() - start)
+			profiler.round_allocations.append(sys.getallocatedblocks() - blocks)
+			return result
+
+		return timed_round
+
+	def latency_histogram(self):
+		# Returns a list of (lower bound, upper bound, number of rounds) of the round latencies in seconds
+		edges = 10.0 ** np.arange(HISTOGRAM_MIN_EXPONENT, HISTOGRAM_MAX_EXPONENT + 0.5, 0.5)
+		latencies = np.clip(self.round_latencies, edges[0], edges[-1])
+		counts, _ = np.histogram(latencies, bins=edges)
+		return [(edges[i], edges[i + 1], int(count)) for i, count in enumerate(counts) if count > 0]
+
+	def to_dict(self):
+		# The profile as a dictionary, e.g to be saved as JSON
+		latencies = np.array(self.round_latencies)
+		return {
+			"phases": {phase: {"seconds": self.phase_times[phase], "calls": self.phase_calls[phase]} for phase in PHASES},
+			"rounds": len(latencies),
+			"round_latency_percentiles": {f"p{q}": float(np.percentile(latencies, q)) for q in (50, 90, 99, 100)} if len(latencies) > 0 else {},
+			"round_latency_histogram": [{"from": low, "to": high, "rounds": count} for low, high, count in self.latency_histogram()],
+			"allocated_blocks_per_round": float(np.mean(self.round_allocations)) if len(self.round_allocations) > 0 else None,
+			"peak_memory_bytes": self.peak_memory
+		}
+
+	def report(self):
+		# A text report of the profile
+		total_time = sum(self.phase_times.values())
+		lines = [f"{'Phase':<16}{'Calls':>12}{'Time (s)':>12}{'Per call (us)':>16}{'Share':>8}"]
+		for phase in PHASES:
+			calls = self.phase_calls[phase]
+			seconds = self.phase_times[phase]
+			per_call = seconds / calls * 1e6 if calls > 0 else 0
+			share = seconds / total_time if total_time > 0 else 0
+			lines.append(f"{phase:<16}{calls:>12}{seconds:>12.4f}{per_call:>16.2f}{share:>8.1%}")
+
+		if len(self.round_latencies) > 0:
+			latencies = np.array(self.round_latencies) * 1e6
+			p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+			lines.append("")
+			lines.append(f"Rounds run by networks: {len(latencies)}, latency (us) p50 {p50:.1f}, p90 {p90:.1f}, p99 {p99:.1f}, max {latencies.max():.1f}")
+
+			largest = max(count for _, _, count in self.latency_histogram())
+			for low, high, count in self.latency_histogram():
+				bar = "#" * max(1, round(40 * count / largest))
+				lines.append(f"  {low * 1e6:>12.1f} - {high * 1e6:<12.1f}us {count:>8} {bar}")
+
+			lines.append(f"Net memory blocks allocated per round: mean {np.mean(self.round_allocations):.1f}, max {max(self.round_allocations)}")
+		else:
+			# Ensembles (and the mean-field engines) run rounds of many trials at once rather than through a network
+			lines.append("")
+			lines.append("No rounds were run by individual networks, trials were run together as ensembles")
+
+		if self.peak_memory is not None:
+			lines.append(f"Peak traced memory: {self.peak_memory / 2 ** 20:.1f} MiB")
+
+		return "\n".join(lines)
@@ -2,11 +2,147 @@ from abc import ABC, abstractmethod
 import random
 import collections
 import math
+import numpy as np
+
+# Vectorised log-gamma, used for the hypergeometric probabilities of the count-based engine
+_lgamma = np.vectorize(math.lgamma, otypes=[float])
+
+
+def _log_comb(n, k):
+	# Natural log of n choose k, element-wise. Impossible combinations (k < 0 or k > n) give -inf
+	valid = (k >= 0) & (k <= n)
+	n = np.where(valid, n, 0)
+	k = np.where(valid, k, 0)
+	return np.where(valid, _lgamma(n + 1) - _lgamma(k + 1) - _lgamma(n - k + 1), -np.inf)
+
+
+def _hypergeometric_tail(population, successes, draws, threshold):
+	# Probability of drawing at least threshold successes when drawing (without replacement)
+	# from a population containing the given number of successes
+	x = np.arange(threshold, draws + 1)
+	population = population[..., None]
+	successes = successes[..., None]
+	log_pmf = _log_comb(successes, x) + _log_comb(population - successes, draws - x) - _log_comb(population, draws)
+	return np.exp(log_pmf).sum(axis=-1)
+
+
+# Samples above this size use random keys rather than drawing one neighbour at a time
+SEQUENTIAL_SAMPLE_LIMIT = 16
+
+# Maximum number of random keys generated at once when sampling large numbers of neighbours
+SAMPLE_KEY_CHUNK_SIZE = 2 ** 22
+
+
+def choose_positions(rng, shape, counts, size):
+	# Chooses size positions from range(count) independently (so a position may be chosen more than once)
+	# counts is either a single count, or an array of counts with the given shape
+	# Positions are returned with shape (*shape, size)
+	if np.ndim(counts) == 0:
+		return rng.integers(0, counts, size=shape + (size,))
+
+	return rng.integers(0, counts[..., None], size=shape + (size,))
+
+
+def sample_positions(rng, shape, counts, size):
+	# Samples size distinct positions from range(count), as with choose_positions
+	if size == 0:
+		return np.empty(shape + (0,), dtype=np.int64)
+
+	if size * size <= np.min(counts):
+		# A repeated position is unlikely, so choose positions independently and redraw the samples that repeat one
+		samples = choose_positions(rng, shape, counts, size)
+		repeated = _has_repeats(samples)
+		while repeated.any():
+			repeated_counts = counts if np.ndim(counts) == 0 else counts[repeated]
+			redrawn = choose_positions(rng, (np.count_nonzero(repeated),), repeated_counts, size)
+			samples[repeated] = redrawn
+			repeated[repeated] = _has_repeats(redrawn)
+
+		return samples
+
+	if size <= SEQUENTIAL_SAMPLE_LIMIT:
+		# Draw one position at a time from the remaining positions, skipping over the positions already drawn
+		# The skipped positions must be checked in ascending order
+		samples = np.empty(shape + (size,), dtype=np.int64)
+		for k in range(size):
+			sample = choose_positions(rng, shape, np.subtract(counts, k), 1)[..., 0]
+			taken = np.sort(samples[..., :k], axis=-1)
+			for column in range(k):
+				sample += sample >= taken[..., column]
+
+			samples[..., k] = sample
+
+		return samples
+
+	# For large samples, give every position a random key and take the positions with the smallest keys
+	# Keys are generated in chunks of rows to bound the memory used
+	row_counts = np.broadcast_to(counts, shape).reshape(-1)
+	max_count = int(row_counts.max())
+	samples = np.empty((len(row_counts), size), dtype=np.int64)
+	chunk_size = max(1, SAMPLE_KEY_CHUNK_SIZE // max_count)
+	for start in range(0, len(row_counts), chunk_size):
+		rows = row_counts[start:start + chunk_size]
+		keys = rng.random((len(rows), max_count))
+
+		# Keys are below 1, so positions past the count of a row are never sampled
+		keys[np.arange(max_count) >= rows[:, None]] = 1
+		samples[start:start + chunk_size] = np.argpartition(keys, size - 1, axis=-1)[:, :size]
+
+	return samples.reshape(shape + (size,))
+
+
+def sample_neighbours(rng, node_indices, nodes, size):
+	# Samples size distinct neighbours for each of the given nodes of a complete network with the given number
+	# of nodes, without a node sampling itself. The indices of the sampled neighbours are returned with shape
+	# (*node_indices.shape, size)
+	samples = sample_positions(rng, node_indices.shape, nodes - 1, size)
+
+	# Neighbours are every other node, so skip over the node itself
+	samples += samples >= node_indices[..., None]
+	return samples
+
+
+def choose_neighbours(rng, node_indices, nodes, size):
+	# Chooses size neighbours for each of the given nodes of a complete network independently (so the same
+	# neighbour may be chosen more than once), without a node choosing itself
+	# Indices are returned with shape (*node_indices.shape, size)
+	choices = choose_positions(rng, node_indices.shape, nodes - 1, size)
+	choices += choices >= node_indices[..., None]
+	return choices
+
+
+def _has_repeats(samples):
+	# Whether each sample (along the last axis) contains the same neighbour more than once
+	size = samples.shape[-1]
+	if size > 8:
+		return (np.diff(np.sort(samples, axis=-1), axis=-1) == 0).any(axis=-1)
+
+	# Comparing each pair of columns is faster than sorting small samples
+	repeats = np.zeros(samples.shape[:-1], dtype=bool)
+	for i in range(size):
+		for j in range(i + 1, size):
+			repeats |= samples[..., i] == samples[..., j]
+
+	return repeats
+
+
+def _gather(states, indices):
+	# Gets the states at the given node indices, where indices has shape (*states.shape, k)
+	flat_indices = indices.reshape(indices.shape[:-2] + (-1,))
+	return np.take_along_axis(states, flat_indices, axis=-1).reshape(indices.shape)
 
 
 class PopulationProtocol(ABC):
+	# The number of distinct neighbours the protocol samples each time it runs (as with random.sample) and the
+	# number of neighbours chosen independently of these (as with random.choice)
+	# Protocols that set sample_size and implement run_sampled support the batched run_batch method
+	sample_size = None
+	choice_size = 0
+
 	@abstractmethod
-	def run(self, state, neighbour_states):
+	def run(self, state, neighbour_states, rng=random):
+		# Returns the next state of an agent given its state and the states of its neighbours
+		# rng is the random.Random of the network (see PopulationNetwork), the global random module by default
 		pass
 
 	@abstractmethod
@@ -17,6 +153,82 @@ class PopulationProtocol(ABC):
 	def get_protocol_name(self):
 		pass
 
+	def is_converged_counts(self, state_counts):
+		# Convergence check given the number of agents in each state (indexed by state)
+		# Override this for protocols that can check convergence without a list of every state
+		return self.is_converged([state for state, count in enumerate(state_counts) for _ in range(count)])
+
+	def converged_batch(self, state_counts):
+		# Convergence check for many networks at once, where each row of state_counts is the number of agents
+		# in each state of a network. Returns a boolean array of which networks have converged
+		return np.array([self.is_converged_counts(counts) for counts in state_counts], dtype=bool)
+
+	def supports_batch(self):
+		return self.sample_size is not None
+
+	def run_batch(self, states, rng, topology=None):
+		# Batched version of run. Takes an array of the state of every agent and a NumPy Generator, and returns
+		# an array of the next state of every agent after a synchronous round. Neighbours are sampled from the
+		# topology (see topology.py), or from every other agent if no topology is given
+		# Any leading axes of states are treated as independent networks
+		if not self.supports_batch():
+			raise NotImplementedError(f"The {self.get_protocol_name()} protocol does not support batched rounds")
+
+		nodes = states.shape[-1]
+		node_indices = np.broadcast_to(np.arange(nodes), states.shape)
+
+		if topology is None:
+			if self.sample_size > nodes - 1:
+				raise ValueError(f"The {self.get_protocol_name()} protocol requires {self.sample_size} neighbours ({nodes - 1} neighbours found)")
+
+			samples = sample_neighbours(rng, node_indices, nodes, self.sample_size)
+			choices = choose_neighbours(rng, node_indices, nodes, self.choice_size)
+		else:
+			samples = topology.sample_neighbours(rng, node_indices, self.sample_size)
+			choices = topology.choose_neighbours(rng, node_indices, self.choice_size)
+
+		return self.run_sampled(states, _gather(states, samples), _gather(states, choices))
+
+	def run_sampled(self, states, sampled_states, chosen_states):
+		# Vectorised version of run, given the sampled and chosen neighbour states of every agent
+		# sampled_states has shape (*states.shape, sample_size) and chosen_states has shape (*states.shape, choice_size)
+		raise NotImplementedError(f"The {self.get_protocol_name()} protocol does not support batched rounds")
+
+	def count_transitions(self, pool, pool_size=None):
+		# Used by the count-based engine on complete networks
+		# pool[..., i, j] is the number of neighbours in state j available to an agent in state i. This should return
+		# the probability of an agent in state i moving to state j after running the protocol once
+		# pool_size[..., i, 0] is the number of neighbours of an agent in state i, by default the sum of its pool (the
+		# mean-field engines give it, as their pools of expected counts are clipped at 0)
+		raise NotImplementedError(f"The {self.get_protocol_name()} protocol does not support the count-based engine")
+
+	def run_counts(self, counts, fixed_counts, rng):
+		# Runs a synchronous round on a complete network, given only the number of agents in each state
+		# Agents in the same state are interchangeable, so all agents in a state are moved with a single multinomial
+		# draw, and a round costs O(states^2) instead of O(nodes)
+		# fixed_counts are agents that never update (e.g faulty agents) but can still be sampled as neighbours
+		# Any leading axes of counts are treated as independent networks
+		total_counts = counts + fixed_counts
+
+		# Only states with agents in them (in any network) take part in the round
+		active = np.flatnonzero(total_counts.reshape(-1, total_counts.shape[-1]).any(axis=0))
+		active_total_counts = total_counts[..., active]
+
+		# The neighbours of an agent are every other agent, so remove the agent itself from its own state
+		pool = active_total_counts[..., None, :] - np.eye(len(active), dtype=total_counts.dtype)
+		probabilities = self.count_transitions(np.maximum(pool, 0))
+
+		# Remove any rounding errors so each row is a valid distribution
+		probabilities = np.maximum(probabilities, 0)
+		probabilities = probabilities / probabilities.sum(axis=-1, keepdims=True)
+
+		# moved[..., i, j] is the number of agents moving from state i to state j
+		moved = rng.multinomial(counts[..., active], probabilities)
+
+		new_counts = np.zeros_like(counts)
+		new_counts[..., active] = moved.sum(axis=-2)
+		return new_counts
+
 
 # A class for the majority protocols
 class MajorityProtocol(PopulationProtocol, ABC):
@@ -27,22 +239,39 @@ class MajorityProtocol(PopulationProtocol, ABC):
 
 		return False
 
+	def is_converged_counts(self, state_counts):
+		return np.count_nonzero(state_counts) == 1
+
+	def converged_batch(self, state_counts):
+		return np.count_nonzero(state_counts, axis=-1) == 1
+
 
 class VoterModel(MajorityProtocol):
-	def run(self, state, neighbour_states):
+	sample_size = 1
+
+	def run(self, state, neighbour_states, rng=random):
 		# Voter model simply selects a neighbour at random and changes its state
-		return random.choice(neighbour_states)
+		return rng.choice(neighbour_states)
+
+	def run_sampled(self, states, sampled_states, chosen_states):
+		return sampled_states[..., 0]
+
+	def count_transitions(self, pool, pool_size=None):
+		# The state of a single random neighbour is adopted
+		return pool / pool.sum(axis=-1, keepdims=True)
 
 	def get_protocol_name(self):
 		return "voter"
 
 
 class TwoChoiceProtocol(MajorityProtocol):
-	def run(self, state, neighbour_states):
+	sample_size = 2
+
+	def run(self, state, neighbour_states, rng=random):
 		# Two choice selects 2 neighbours and if the state matches, change its opinion to that
 		# otherwise keep its current state
 
-		sampled_neighbours = random.sample(neighbour_states, 2)
+		sampled_neighbours = rng.sample(neighbour_states, 2)
 
 		if sampled_neighbours[0] == sampled_neighbours[1]:
 			return sampled_neighbours[0]
@@ -50,6 +279,19 @@ class TwoChoiceProtocol(MajorityProtocol):
 		# Keep current state
 		return state
 
+	def run_sampled(self, states, sampled_states, chosen_states):
+		matching = sampled_states[..., 0] == sampled_states[..., 1]
+		return np.where(matching, sampled_states[..., 0], states)
+
+	def count_transitions(self, pool, pool_size=None):
+		# Probability that both sampled neighbours are in state j, otherwise the agent keeps its state
+		if pool_size is None:
+			pool_size = pool.sum(axis=-1, keepdims=True)
+
+		both_sampled = pool * (pool - 1) / (pool_size * (pool_size - 1))
+		keep_state = 1 - both_sampled.sum(axis=-1, keepdims=True)
+		return both_sampled + keep_state * np.eye(pool.shape[-1])
+
 	def get_protocol_name(self):
 		return "twochoice"
 
@@ -64,12 +306,16 @@ class NMajorityProtocol(MajorityProtocol):
 		if n % 2 != 1:
 			raise ValueError("N must be an odd integer for the N-majority protocol")
 
-	def run(self, state, neighbour_states):
+		# n neighbours are sampled, and one more is chosen in case there is no majority
+		self.sample_size = self.n
+		self.choice_size = 1
+
+	def run(self, state, neighbour_states, rng=random):
 		if len(neighbour_states) < self.n:
 			raise ValueError(f"This majority protocol requires {self.n} neighbours ({len(neighbour_states)} neighbours found)")
 
 		# Get n random neighbours
-		sampled_neighbours = random.sample(neighbour_states, self.n)
+		sampled_neighbours = rng.sample(neighbour_states, self.n)
 
 		# Check for a majority
 		state_counts = collections.Counter(sampled_neighbours)
@@ -80,15 +326,43 @@ class NMajorityProtocol(MajorityProtocol):
 			return majority_state
 
 		# A majority was not found, pick a random state from neighbours
-		return random.choice(neighbour_states)
+		return rng.choice(neighbour_states)
+
+	def run_sampled(self, states, sampled_states, chosen_states):
+		# Find the only state that could be a majority using the Boyer-Moore majority vote, one column at a time
+		candidate = sampled_states[..., 0]
+		votes = np.ones_like(candidate)
+		for column in range(1, self.n):
+			state = sampled_states[..., column]
+			candidate = np.where(votes == 0, state, candidate)
+			votes = np.where(state == candidate, votes + 1, votes - 1)
+
+		# Check the candidate is actually a majority, otherwise use the chosen neighbour
+		candidate_count = (sampled_states == candidate[..., None]).sum(axis=-1)
+		return np.where(candidate_count >= math.ceil(self.n / 2), candidate, chosen_states[..., 0])
+
+	def count_transitions(self, pool, pool_size=None):
+		if pool_size is None:
+			pool_size = pool.sum(axis=-1, keepdims=True)
+
+		if pool_size.min() < self.n:
+			raise ValueError(f"This majority protocol requires {self.n} neighbours ({int(pool_size.min())} neighbours found)")
+
+		# Since n is odd at most one state can have a majority, so the probability of a majority of state j
+		# is the hypergeometric tail probability of sampling at least n/2 neighbours in state j
+		majority = _hypergeometric_tail(pool_size, pool, self.n, math.ceil(self.n / 2))
+
+		# Without a majority, a random neighbour is selected
+		no_majority = 1 - majority.sum(axis=-1, keepdims=True)
+		return majority + no_majority * pool / pool_size
 
 	def get_protocol_name(self):
 		return "n-majority"
 
 
 class ThreeMajority(NMajorityProtocol):
-	def run(self, state, neighbour_states):
-		return super().run(state, neighbour_states)
+	def run(self, state, neighbour_states, rng=random):
+		return super().run(state, neighbour_states, rng)
 
 	def __init__(self):
 		super().__init__(3)
@@ -0,0 +1,165 @@
+# This file contains the ways an analysis can write its results to a file, so analyses can run
+# without showing any figures (e.g on machines without a display) and be plotted later
+# CSV files have each data point appended as soon as it has been run, JSON and NPZ files are rewritten
+# periodically, so most of a sweep is kept if it is stopped
+
+import csv
+import json
+import math
+import os
+import time
+from abc import ABC, abstractmethod
+import numpy as np
+
+# Minimum number of seconds between rewrites of formats that are rewritten as a whole (JSON and NPZ)
+REWRITE_INTERVAL = 1.0
+
+
+def replace_file(path, write):
+	# Writes a file by calling write with a temporary path, then moves it over the file so it is never left half written
+	temporary_path = path + ".tmp"
+	write(temporary_path)
+	os.replace(temporary_path, path)
+
+
+class ResultWriter(ABC):
+	def __init__(self, path, columns, metadata=None):
+		# columns are the names of the values of each data point, metadata describes the analysis
+		# (e.g its protocol and number of nodes)
+		self.path = path
+		self.columns = list(columns)
+		self.metadata = metadata if metadata is not None else {}
+		self.points = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def write_point(self, point):
+		# Writes a data point, given a dictionary of column -> value
+		missing = [column for column in self.columns if column not in point]
+		if len(missing) > 0:
+			raise ValueError(f"The data point is missing the columns {', '.join(missing)}")
+
+		self.write_row([to_builtin(point[column]) for column in self.columns])
+		self.points += 1
+
+	@abstractmethod
+	def write_row(self, row):
+		# Writes the values of a data point, in the order of the columns
+		pass
+
+	def close(self):
+		pass
+
+
+# Writes a CSV file with a header of the column names and one line per data point
+class CSVResultWriter(ResultWriter):
+	def __init__(self, path, columns, metadata=None):
+		super().__init__(path, columns, metadata)
+		self.file = open(path, "w", newline="")
+		self.writer = csv.writer(self.file)
+		self.writer.writerow(self.columns)
+		self.file.flush()
+
+	def write_row(self, row):
+		self.writer.writerow(row)
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+
+# A writer that keeps every data point and rewrites the whole file, for formats that cannot be appended to
+# The file is rewritten at most once every REWRITE_INTERVAL seconds (and when closed), so long sweeps do not
+# spend their time rewriting it
+class RewrittenResultWriter(ResultWriter, ABC):
+	def __init__(self, path, columns, metadata=None):
+		super().__init__(path, columns, metadata)
+		self.rows = []
+		self.last_saved = None
+		self.save()
+
+	def write_row(self, row):
+		self.rows.append(row)
+		if time.monotonic() - self.last_saved >= REWRITE_INTERVAL:
+			self.save()
+
+	def save(self):
+		replace_file(self.path, self.write_file)
+		self.last_saved = time.monotonic()
+
+	@abstractmethod
+	def write_file(self, path):
+		# Writes every data point to the file at the given path
+		pass
+
+	def close(self):
+		self.save()
+
+
+# Writes a JSON object of the metadata and a list of the data points (each an object of column -> value)
+class JSONResultWriter(RewrittenResultWriter):
+	def write_file(self, path):
+		with open(path, "w") as f:
+			# JSON has no infinity or NaN, so these are written as null
+			points = [{column: json_value(value) for column, value in zip(self.columns, row)} for row in self.rows]
+			json.dump({"metadata": self.metadata, "columns": self.columns, "points": points}, f, indent=2)
+
+
+# Writes a NumPy .npz archive with one array per column, and the metadata as a JSON string
+class NPZResultWriter(RewrittenResultWriter):
+	def write_file(self, path):
+		arrays = {column: np.array([row[i] for row in self.rows]) for i, column in enumerate(self.columns)}
+		with open(path, "wb") as f:
+			np.savez(f, metadata=json.dumps(self.metadata), **arrays)
+
+
+# Writes nothing, used when an analysis has no output file
+class NoResultWriter(ResultWriter):
+	def write_row(self, row):
+		pass
+
+
+# Result formats file extension -> writer class
+RESULT_FORMATS = {
+	"csv": CSVResultWriter,
+	"json": JSONResultWriter,
+	"npz": NPZResultWriter
+}
+
+
+def result_format(path):
+	# The format of a results file given its path, from its extension
+	extension = os.path.splitext(path)[1].lstrip(".").lower()
+	if extension not in RESULT_FORMATS:
+		raise ValueError(f"Unknown results format .{extension}, expected one of {', '.join('.' + name for name in RESULT_FORMATS)}")
+
+	return extension
+
+
+def create_result_writer(path, columns, metadata=None):
+	# Creates the writer for a results file, the format is chosen by the extension of the path
+	# If path is None, nothing is written
+	if path is None:
+		return NoResultWriter(path, columns, metadata)
+
+	return RESULT_FORMATS[result_format(path)](path, columns, metadata)
+
+
+def to_builtin(value):
+	# Converts NumPy scalars to the matching Python type, so they can be written as JSON
+	if isinstance(value, np.generic):
+		return value.item()
+
+	return value
+
+
+def json_value(value):
+	# Replaces values that cannot be written as JSON (infinity and NaN) with None
+	if isinstance(value, float) and not math.isfinite(value):
+		return None
+
+	return value
@@ -0,0 +1,155 @@
+# This file contains the schedulers of a PopulationNetwork, which decide when each agent
+# runs the protocol. Every round is one unit of parallel time, i.e one interaction per node
+# A sequential round stops early if the network converges part way through, it still counts as a whole round,
+# so the number of rounds is the parallel time rounded up
+
+import math
+from abc import ABC, abstractmethod
+import numpy as np
+
+
+class Scheduler(ABC):
+	@abstractmethod
+	def run_round(self, network):
+		# Runs one round of the protocol on the network
+		pass
+
+
+# All nodes are updated (seemingly) simultaneously, each node runs the protocol using
+# the states of its neighbours at the start of the round
+class SynchronousScheduler(Scheduler):
+	def run_round(self, network):
+		if network.batched:
+			# Run the protocol for every node at once, faulty nodes are masked out when the agents are updated
+			states = network.get_state_array()
+			new_states = network.protocol.run_batch(states, network.rng, network.topology)
+			network.update_agents(np.arange(len(states)), new_states)
+			return
+
+		# Should copy the agents states
+		graph_copy = network.get_states()
+		new_states = np.empty(len(graph_copy), dtype=np.int64)
+
+		# For every node, run the protocol
+		for agent in range(len(graph_copy)):
+			# agent is the index of the agent
+			# Calculate new state based on neighbours (using copy of graph)
+
+			# Agents state
+			agent_state = graph_copy[agent]
+
+			# Neighbouring states of this node in the network's topology
+			# On a complete network this is a view that skips the current node, so the copy of the graph is never modified
+			neighbour_states = network.get_neighbour_states(graph_copy, agent)
+
+			# Run protocol to find new state
+			new_states[agent] = network.protocol.run(agent_state, neighbour_states, network.random)
+
+		# Update every node at once using the agents behaviours
+		network.update_agents(np.arange(len(graph_copy)), new_states)
+
+
+# A random scheduler, where a single random node runs the protocol (interacting with the neighbours it samples)
+# at each step, using the current states of the network. A round is n steps, so rounds are in parallel time
+# The round stops early if the network converges
+class SequentialScheduler(Scheduler):
+	def __init__(self):
+		# For the batched path, the first step of the current block that updates each node
+		self.first_update = None
+
+	def run_round(self, network):
+		if network.batched:
+			self.run_batched_round(network)
+		else:
+			self.run_step_round(network)
+
+	def run_step_round(self, network):
+		# Runs the protocol one node at a time
+		states = network.get_states()
+		for _ in range(len(states)):
+			agent = network.random.randrange(len(states))
+			new_state = network.protocol.run(states[agent], network.get_neighbour_states(states, agent), network.random)
+			states[agent] = network.update_agent(agent, new_state)
+
+			if network.has_converged():
+				return
+
+	def run_batched_round(self, network):
+		# Steps are drawn in blocks. The steps at the start of a block that do not read or update a node
+		# updated by an earlier step of the block are independent of each other, so they can all be run at
+		# once using the states from the start of the block. The first step that does depend on an earlier
+		# step is then run on its own, and the rest of the block is discarded
+		protocol = network.protocol
+		states = network.get_state_array()
+		start_states = states.copy()
+
+		# Faulty nodes run the protocol but never change state
+		honest = network.graph.honest
+		state_counts = network.state_counts.copy()
+
+		nodes = len(states)
+		if self.first_update is None or len(self.first_update) != nodes:
+			self.first_update = np.full(nodes, nodes, dtype=np.int64)
+
+		# Each step involves the node and the neighbours it reads, the expected number of independent
+		# steps grows with the square root of the nodes
+		step_size = 1 + protocol.sample_size + protocol.choice_size
+		block_size = math.ceil(3 * math.sqrt(nodes / step_size))
+
+		remaining_steps = nodes
+		while remaining_steps > 0:
+			size = min(block_size, remaining_steps)
+			agents = network.rng.integers(0, nodes, size=size)
+			samples = network.topology.sample_neighbours(network.rng, agents, protocol.sample_size)
+			choices = network.topology.choose_neighbours(network.rng, agents, protocol.choice_size)
+
+			independent_steps = self.count_independent_steps(agents, np.concatenate([agents[:, None], samples, choices], axis=1))
+			self.run_steps(protocol, states, state_counts, honest, agents[:independent_steps], samples[:independent_steps], choices[:independent_steps])
+
+			if independent_steps < size:
+				# Run the first dependent step using the updated states
+				step = slice(independent_steps, independent_steps + 1)
+				self.run_steps(protocol, states, state_counts, honest, agents[step], samples[step], choices[step])
+				independent_steps += 1
+
+			remaining_steps -= independent_steps
+
+			if protocol.is_converged_counts(state_counts):
+				break
+
+		changed = np.flatnonzero(states != start_states)
+		network.update_agents(changed, states[changed])
+
+	def count_independent_steps(self, agents, involved_nodes):
+		# Returns the number of steps at the start of the block before a step involves (reads or updates)
+		# a node that is updated by an earlier step
+		steps = np.arange(len(agents))
+		np.minimum.at(self.first_update, agents, steps)
+
+		dependent = (self.first_update[involved_nodes] < steps[:, None]).any(axis=1)
+
+		# Reset for the next block
+		self.first_update[agents] = len(self.first_update)
+
+		if not dependent.any():
+			return len(agents)
+
+		return int(dependent.argmax())
+
+	@staticmethod
+	def run_steps(protocol, states, state_counts, honest, agents, samples, choices):
+		# Runs independent steps at once, updating the states of the honest agents and the state counts
+		old_states = states[agents]
+		new_states = np.where(honest[agents], protocol.run_sampled(old_states, states[samples], states[choices]), old_states)
+		states[agents] = new_states
+
+		changed = old_states != new_states
+		state_counts -= np.bincount(old_states[changed], minlength=len(state_counts))
+		state_counts += np.bincount(new_states[changed], minlength=len(state_counts))
+
+
+# Schedulers name -> scheduler class
+SCHEDULERS = {
+	"synchronous": SynchronousScheduler,
+	"sequential": SequentialScheduler
+}
@@ -0,0 +1,219 @@
+# This file contains the topologies a network can have, i.e which nodes neighbour each other
+# Sparse topologies store their adjacency as compact CSR (compressed sparse row) index arrays,
+# networkx is only used to generate or import graphs
+
+import collections.abc
+import numpy as np
+from protocols import sample_neighbours, choose_neighbours, sample_positions, choose_positions
+
+
+# The neighbourhood of a node in a fully connected network, which is every other node
+# This is a read-only view of the states of the network that skips the given node, so protocols
+# can sample neighbours by index without the list of states being copied or modified
+class NeighbourStates(collections.abc.Sequence):
+	def __init__(self, states, node):
+		self.states = states
+		self.node = node
+
+	def __len__(self):
+		return len(self.states) - 1
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+
+		if index < 0:
+			index += len(self)
+
+		if not 0 <= index < len(self):
+			raise IndexError("Neighbour index out of range")
+
+		# Indices at or after the node are shifted by 1 to skip over the node itself
+		return self.states[index + (index >= self.node)]
+
+
+# Every node neighbours every other node, so no edges are stored
+class CompleteTopology:
+	def __init__(self, nodes):
+		self.nodes = nodes
+
+	def get_number_of_nodes(self):
+		return self.nodes
+
+	def is_complete(self):
+		return True
+
+	def get_neighbour_states(self, states, node):
+		# The states of the neighbours of a node, given the list of states of every node
+		return NeighbourStates(states, node)
+
+	def sample_neighbours(self, rng, node_indices, size):
+		# Samples size distinct neighbours for each of the given nodes, returned with shape (*node_indices.shape, size)
+		return sample_neighbours(rng, node_indices, self.nodes, size)
+
+	def choose_neighbours(self, rng, node_indices, size):
+		# Chooses size neighbours for each of the given nodes independently, returned as with sample_neighbours
+		return choose_neighbours(rng, node_indices, self.nodes, size)
+
+	def to_networkx(self):
+		import networkx as nx
+		return nx.complete_graph(self.nodes)
+
+
+# A topology where the neighbours of node v are indices[indptr[v]:indptr[v + 1]]
+# Memory is O(nodes + edges)
+class CSRTopology:
+	def __init__(self, indptr, indices):
+		self.indptr = np.asarray(indptr, dtype=np.int64)
+		self.indices = np.asarray(indices, dtype=np.min_scalar_type(max(len(indptr) - 1, 1)))
+		self.degrees = np.diff(self.indptr)
+
+	@classmethod
+	def from_edges(cls, nodes, edges):
+		# Creates an undirected topology from an (edges x 2) array of node index pairs
+		edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+
+		# Store every edge in both directions, ordered by the node it leaves from
+		sources = np.concatenate([edges[:, 0], edges[:, 1]])
+		targets = np.concatenate([edges[:, 1], edges[:, 0]])
+		order = np.argsort(sources, kind="stable")
+
+		indptr = np.zeros(nodes + 1, dtype=np.int64)
+		np.cumsum(np.bincount(sources, minlength=nodes), out=indptr[1:])
+		return cls(indptr, targets[order])
+
+	@classmethod
+	def from_networkx(cls, graph):
+		# Imports a networkx graph, nodes are numbered in the order networkx lists them
+		node_index = {node: i for i, node in enumerate(graph.nodes())}
+		edges = np.array([(node_index[u], node_index[v]) for u, v in graph.edges() if u != v], dtype=np.int64)
+		return cls.from_edges(len(node_index), edges)
+
+	def get_number_of_nodes(self):
+		return len(self.degrees)
+
+	def get_number_of_edges(self):
+		return len(self.indices) // 2
+
+	def is_complete(self):
+		return False
+
+	def get_neighbours(self, node):
+		return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+	def get_neighbour_states(self, states, node):
+		# The states of the neighbours of a node, given the list of states of every node
+		return [states[neighbour] for neighbour in self.get_neighbours(node).tolist()]
+
+	def sample_neighbours(self, rng, node_indices, size):
+		# Samples size distinct neighbours for each of the given nodes, returned with shape (*node_indices.shape, size)
+		degrees = self.check_degrees(node_indices, size)
+		positions = sample_positions(rng, node_indices.shape, degrees, size)
+		return self.indices[self.indptr[node_indices][..., None] + positions].astype(np.int64)
+
+	def choose_neighbours(self, rng, node_indices, size):
+		# Chooses size neighbours for each of the given nodes independently, returned as with sample_neighbours
+		degrees = self.check_degrees(node_indices, min(size, 1))
+		positions = choose_positions(rng, node_indices.shape, degrees, size)
+		return self.indices[self.indptr[node_indices][..., None] + positions].astype(np.int64)
+
+	def check_degrees(self, node_indices, size):
+		# Returns the degrees of the given nodes, checking they each have at least size neighbours
+		degrees = self.degrees[node_indices]
+		if size > 0 and degrees.size > 0 and degrees.min() < size:
+			raise ValueError(f"The protocol requires {size} neighbours ({degrees.min()} neighbours found)")
+
+		return degrees
+
+	def to_networkx(self):
+		import networkx as nx
+		graph = nx.Graph()
+		graph.add_nodes_from(range(self.get_number_of_nodes()))
+		sources = np.repeat(np.arange(self.get_number_of_nodes()), self.degrees)
+		graph.add_edges_from(zip(sources.tolist(), self.indices.tolist()))
+		return graph
+
+
+# Topology generators, each takes the number of nodes, the (average) degree of each node and an
+# optional seed. networkx is only imported when a graph is generated
+# Generators raise a ValueError for a number of nodes or degree they cannot build a graph for
+
+# Random (Erdos-Renyi) graphs give every node at least this many neighbours (or the degree, if smaller), enough for
+# every protocol that samples neighbours
+ERDOS_RENYI_MIN_DEGREE = 3
+
+
+def complete_topology(nodes, degree=None, seed=None):
+	return CompleteTopology(nodes)
+
+
+def random_regular_topology(nodes, degree, seed=None):
+	import networkx as nx
+	if nodes * degree % 2 != 0:
+		raise ValueError(f"A regular graph needs an even number of nodes times its degree ({nodes} x {degree} is odd)")
+
+	return CSRTopology.from_networkx(nx.random_regular_graph(degree, nodes, seed=seed))
+
+
+def erdos_renyi_topology(nodes, degree, seed=None):
+	# A G(n, p) random graph with the given average degree, patched so it can be simulated: nodes with fewer than
+	# ERDOS_RENYI_MIN_DEGREE neighbours are joined to random nodes, then every smaller component is joined to the
+	# largest one, so the graph is connected and a network on it can converge. The added edges raise the average
+	# degree a little (to about 4.6 for a degree of 4)
+	import networkx as nx
+	graph = nx.fast_gnp_random_graph(nodes, degree / (nodes - 1), seed=seed)
+	rng = np.random.default_rng(seed)
+
+	min_degree = min(degree, ERDOS_RENYI_MIN_DEGREE)
+	for node in [node for node, node_degree in graph.degree() if node_degree < min_degree]:
+		while graph.degree(node) < min_degree:
+			neighbour = int(rng.integers(nodes))
+			if neighbour != node:
+				graph.add_edge(node, neighbour)
+
+	components = sorted(nx.connected_components(graph), key=len, reverse=True)
+	largest_component = list(components[0])
+	for component in components[1:]:
+		graph.add_edge(next(iter(component)), largest_component[rng.integers(len(largest_component))])
+
+	return CSRTopology.from_networkx(graph)
+
+
+def grid_topology(nodes, degree=None, seed=None):
+	# A 2D grid wrapped into a torus, so every node has 4 neighbours
+	# The grid is as square as possible with rows * columns = nodes, a torus needs at least 3 rows and 3 columns
+	# for the neighbours of every node to be different nodes
+	rows = int(np.sqrt(nodes))
+	while nodes % rows != 0:
+		rows -= 1
+
+	if rows < 3:
+		raise ValueError(f"A grid needs a number of nodes that is the product of two numbers of at least 3 (e.g {max(9, round(np.sqrt(nodes)) ** 2)}), {nodes} cannot be wrapped into a torus")
+
+	columns = nodes // rows
+	node_grid = np.arange(nodes).reshape(rows, columns)
+	edges = np.concatenate([
+		np.stack([node_grid.ravel(), np.roll(node_grid, -1, axis=1).ravel()], axis=1),
+		np.stack([node_grid.ravel(), np.roll(node_grid, -1, axis=0).ravel()], axis=1)
+	])
+	return CSRTopology.from_edges(nodes, edges)
+
+
+def small_world_topology(nodes, degree, seed=None):
+	# Watts-Strogatz small world graph, a ring where each edge is rewired with probability 0.1
+	# Each node is joined to degree / 2 neighbours on either side of the ring, so the degree must be even
+	import networkx as nx
+	if degree % 2 != 0:
+		raise ValueError(f"A small world graph needs an even degree ({degree} is odd)")
+
+	return CSRTopology.from_networkx(nx.connected_watts_strogatz_graph(nodes, degree, 0.1, seed=seed))
+
+
+# Topologies name -> generator
+TOPOLOGIES = {
+	"complete": complete_topology,
+	"regular": random_regular_topology,
+	"erdos-renyi": erdos_renyi_topology,
+	"grid": grid_topology,
+	"small-world": small_world_topology
+}
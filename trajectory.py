@@ -0,0 +1,289 @@
+# This file contains the ways a network can record its configuration in each round
+# A trajectory is used as the data of a network, the analysers and GUI read the
+# state counts (or states) of each round from it
+# Trajectories can be saved to a NumPy .npz file and loaded again, e.g to replay a run without simulating it
+
+import json
+from abc import ABC, abstractmethod
+import numpy as np
+from results import replace_file
+
+# A delta trajectory keeps the state of every node every this many rounds, so the states of any round
+# can be found by replaying at most this many rounds of changes
+KEYFRAME_INTERVAL = 64
+
+
+def compact_dtype(states):
+	# The smallest integer type that can hold every state in the array
+	if len(states) == 0:
+		return np.uint8
+
+	return np.min_scalar_type(max(int(states.max()), 0)) if states.min() >= 0 else states.dtype
+
+
+def counts_to_dict(counts):
+	# Converts an array of the number of nodes in each state to a dictionary of state -> count
+	return {state: int(count) for state, count in enumerate(counts) if count > 0}
+
+
+def stack_counts(counts):
+	# Stacks the state counts of each round into a (rounds x states) array, padding rounds with fewer states
+	table = np.zeros((len(counts), max((len(row) for row in counts), default=0)), dtype=np.int64)
+	for rnd, row in enumerate(counts):
+		table[rnd, :len(row)] = row
+
+	return table
+
+
+class Trajectory(ABC):
+	# Whether record_states must be used, otherwise rounds can be recorded from the state counts alone
+	needs_states = False
+
+	def __init__(self):
+		# Number of rounds recorded (round 0 is the initial configuration)
+		self.rounds = 0
+
+	def record_states(self, states):
+		# Records the next round given an array of the state of every node
+		self.record_counts(np.bincount(states))
+
+	@abstractmethod
+	def record_counts(self, counts):
+		# Records the next round given an array of the number of nodes in each state
+		pass
+
+	@abstractmethod
+	def get_counts(self, rnd):
+		# Returns a dictionary of state -> node count in the given round
+		pass
+
+	def get_states(self, rnd):
+		# Returns an array of the state of every node in the given round
+		raise ValueError(f"The {type(self).__name__} does not record the state of every node")
+
+	@abstractmethod
+	def save_arrays(self):
+		# Returns a dictionary of name -> array describing every round, saved by save_trajectory
+		pass
+
+	@classmethod
+	@abstractmethod
+	def from_arrays(cls, arrays):
+		# Creates a trajectory from the arrays returned by save_arrays
+		pass
+
+	def keys(self):
+		# The rounds that can be read from this trajectory
+		return range(self.rounds)
+
+	def __len__(self):
+		return self.rounds
+
+	def __contains__(self, rnd):
+		return rnd in self.keys()
+
+
+# Records only the number of nodes in each state, one small array per round
+class CountsTrajectory(Trajectory):
+	def __init__(self):
+		super().__init__()
+		self.counts = []
+
+	def record_counts(self, counts):
+		self.counts.append(np.array(counts, dtype=np.int64))
+		self.rounds += 1
+
+	def get_counts(self, rnd):
+		return counts_to_dict(self.counts[rnd])
+
+	def save_arrays(self):
+		return {"counts": stack_counts(self.counts)}
+
+	@classmethod
+	def from_arrays(cls, arrays):
+		trajectory = cls()
+		for counts in arrays["counts"]:
+			trajectory.record_counts(counts)
+
+		return trajectory
+
+
+# Records the state of every node in each round, in the smallest integer type that fits the states
+class StatesTrajectory(Trajectory):
+	needs_states = True
+
+	def __init__(self):
+		super().__init__()
+		self.states = []
+
+	def record_states(self, states):
+		states = np.asarray(states)
+		self.states.append(states.astype(compact_dtype(states)))
+		self.rounds += 1
+
+	def record_counts(self, counts):
+		raise ValueError("A states trajectory requires the state of every node")
+
+	def get_counts(self, rnd):
+		return counts_to_dict(np.bincount(self.states[rnd]))
+
+	def get_states(self, rnd):
+		return self.states[rnd]
+
+	def save_arrays(self):
+		states = np.array(self.states).reshape(self.rounds, -1)
+		return {"states": states.astype(compact_dtype(states))}
+
+	@classmethod
+	def from_arrays(cls, arrays):
+		trajectory = cls()
+		for states in arrays["states"]:
+			trajectory.record_states(states)
+
+		return trajectory
+
+
+# Records the initial state of every node, then only the nodes that changed state in each round
+# The state of every node is also kept every KEYFRAME_INTERVAL rounds (keyframes), so any round can be read
+# quickly. The counts of each round are also kept, so they can be read without replaying the changes
+class DeltaTrajectory(Trajectory):
+	needs_states = True
+
+	def __init__(self):
+		super().__init__()
+		self.initial_states = None
+		self.current_states = None
+
+		# For each round after the first, a tuple of (indices of changed nodes, their new states)
+		self.deltas = []
+		self.counts = []
+
+		# The states of every node in rounds 0, KEYFRAME_INTERVAL, 2 * KEYFRAME_INTERVAL, ...
+		self.keyframes = []
+
+	def record_states(self, states):
+		states = np.asarray(states)
+		if self.initial_states is None:
+			self.initial_states = states.astype(compact_dtype(states))
+			self.current_states = self.initial_states.copy()
+		else:
+			changed = np.flatnonzero(states != self.current_states)
+			new_states = states[changed].astype(compact_dtype(states))
+			self.deltas.append((changed.astype(np.min_scalar_type(len(states))), new_states))
+
+			if new_states.dtype.itemsize > self.current_states.dtype.itemsize:
+				# A state that does not fit the states so far
+				self.current_states = self.current_states.astype(new_states.dtype)
+
+			self.current_states[changed] = new_states
+
+		if self.rounds % KEYFRAME_INTERVAL == 0:
+			self.keyframes.append(self.current_states.copy())
+
+		self.counts.append(np.bincount(states))
+		self.rounds += 1
+
+	def record_counts(self, counts):
+		raise ValueError("A delta trajectory requires the state of every node")
+
+	def get_counts(self, rnd):
+		return counts_to_dict(self.counts[rnd])
+
+	def get_states(self, rnd):
+		# Replay the changes up to the given round
+		if not 0 <= rnd < self.rounds:
+			raise IndexError(f"Round {rnd} has not been recorded")
+
+		# Replay from the latest keyframe at or before the round
+		keyframe = rnd // KEYFRAME_INTERVAL
+		states = self.keyframes[keyframe].astype(self.current_states.dtype)
+		for changed, new_states in self.deltas[keyframe * KEYFRAME_INTERVAL:rnd]:
+			states[changed] = new_states
+
+		return states
+
+	def save_arrays(self):
+		# The changes of every round are saved one after another, with the number of changes in each round
+		# Keyframes are not saved, they are rebuilt when the trajectory is loaded
+		changed = [changed.astype(np.int64) for changed, _ in self.deltas]
+		new_states = [new_states.astype(self.current_states.dtype) for _, new_states in self.deltas]
+		return {
+			"initial_states": self.initial_states,
+			"changed": np.concatenate(changed) if len(changed) > 0 else np.zeros(0, dtype=np.int64),
+			"new_states": np.concatenate(new_states) if len(new_states) > 0 else np.zeros(0, dtype=self.current_states.dtype),
+			"changes_per_round": np.array([len(indices) for indices in changed], dtype=np.int64)
+		}
+
+	@classmethod
+	def from_arrays(cls, arrays):
+		trajectory = cls()
+		states = arrays["initial_states"].astype(np.int64)
+		trajectory.record_states(states)
+
+		ends = np.cumsum(arrays["changes_per_round"])
+		for start, end in zip(ends - arrays["changes_per_round"], ends):
+			states[arrays["changed"][start:end]] = arrays["new_states"][start:end]
+			trajectory.record_states(states)
+
+		return trajectory
+
+
+# Keeps no history, only the counts of the latest round (e.g for finding the winning state)
+class NoTrajectory(Trajectory):
+	def __init__(self):
+		super().__init__()
+		self.last_counts = None
+
+	def record_counts(self, counts):
+		self.last_counts = np.array(counts, dtype=np.int64)
+		self.rounds += 1
+
+	def get_counts(self, rnd):
+		if rnd != self.rounds - 1:
+			raise IndexError(f"Only the latest round ({self.rounds - 1}) is recorded")
+
+		return counts_to_dict(self.last_counts)
+
+	def keys(self):
+		return range(self.rounds - 1, self.rounds)
+
+	def save_arrays(self):
+		raise ValueError("A trajectory that keeps no history cannot be saved")
+
+	@classmethod
+	def from_arrays(cls, arrays):
+		raise ValueError("A trajectory that keeps no history cannot be loaded")
+
+
+# Recording modes name -> trajectory class
+RECORDING_MODES = {
+	"counts": CountsTrajectory,
+	"states": StatesTrajectory,
+	"deltas": DeltaTrajectory,
+	"none": NoTrajectory
+}
+
+
+def save_trajectory(path, trajectory, metadata=None):
+	# Saves a trajectory to a NumPy .npz file, with metadata describing the run (any dictionary that can be written as JSON)
+	mode = next(name for name, trajectory_class in RECORDING_MODES.items() if type(trajectory) is trajectory_class)
+	arrays = trajectory.save_arrays()
+
+	def write(path):
+		with open(path, "wb") as f:
+			np.savez_compressed(f, recording=mode, metadata=json.dumps(metadata if metadata is not None else {}), **arrays)
+
+	replace_file(path, write)
+
+
+def load_trajectory(path):
+	# Loads a trajectory saved by save_trajectory, returns the trajectory and its metadata
+	with np.load(path) as saved:
+		mode = str(saved["recording"])
+		if mode not in RECORDING_MODES:
+			raise ValueError(f"Unknown recording mode {mode} in {path}")
+
+		metadata = json.loads(str(saved["metadata"]))
+		arrays = {name: saved[name] for name in saved.files if name not in ("recording", "metadata")}
+
+	return RECORDING_MODES[mode].from_arrays(arrays), metadata
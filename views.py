@@ -0,0 +1,280 @@
+# This file contains the views that draw a network onto a matplotlib figure, used by the GUI
+# Views only need a figure and a canvas, not a window, so they work with any matplotlib backend
+#
+# A view is drawn in full once per network, later rounds only update the artists that change and
+# redraw them over a saved background (blitting), so a round costs far less than redrawing the figure
+#
+# Views draw frames, snapshots of a network after a round (see NetworkFrame). Small networks are drawn
+# node by node with their edges (NetworkView), larger networks as their state counts over time and a
+# sample of their nodes (AggregateView)
+
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
+from trajectory import stack_counts
+
+# Colour of nodes in a state that has no colour
+UNKNOWN_STATE_COLOUR = "#808080"
+
+# Node size and edge style, the same as networkx draws by default
+NODE_SIZE = 300
+EDGE_COLOUR = "k"
+EDGE_WIDTH = 1.0
+
+# Networks with more nodes than this are drawn as an aggregate (see AggregateView) rather than node by node
+NODE_VIEW_LIMIT = 50
+
+# Number of nodes shown by the aggregate view, and their size
+AGGREGATE_SAMPLE_SIZE = 400
+SAMPLE_NODE_SIZE = 12
+
+# Maximum number of rounds drawn in the state counts over time, longer histories are drawn every few rounds
+AGGREGATE_HISTORY_POINTS = 500
+
+
+def shows_nodes(network):
+	# Whether a network is drawn node by node, only networks that store the state of every node can be
+	return network.stores_states and network.get_number_of_nodes() <= NODE_VIEW_LIMIT
+
+
+def create_view(figure, network, state_colours, frame):
+	# Creates the view that draws a network, frame is its first frame (see NetworkFrame)
+	if shows_nodes(network):
+		return NetworkView(figure, network.topology, state_colours, frame)
+
+	return AggregateView(figure, state_colours, frame, network.data)
+
+
+def sample_nodes(network, size=AGGREGATE_SAMPLE_SIZE, seed=None):
+	# Chooses the nodes of a network shown by an aggregate view, returns an array of node indices
+	nodes = network.get_number_of_nodes()
+	if nodes <= size:
+		return np.arange(nodes)
+
+	return np.sort(np.random.default_rng(seed).choice(nodes, size=size, replace=False))
+
+
+def representative_states(state_counts, size):
+	# States of a sample of size nodes with the same proportion of nodes in each state as the network, for
+	# networks that only store the number of nodes in each state. Given as a dictionary of state -> count, the
+	# sample is ordered by state and rounded to whole nodes by the largest remainders
+	states = np.array(sorted(state_counts), dtype=np.int64)
+	counts = np.array([state_counts[state] for state in states], dtype=float)
+	quotas = counts / counts.sum() * size
+
+	sample_counts = np.floor(quotas).astype(np.int64)
+	largest_remainders = np.argsort(sample_counts - quotas, kind="stable")[:size - sample_counts.sum()]
+	sample_counts[largest_remainders] += 1
+	return np.repeat(states, sample_counts)
+
+
+# A snapshot of a network in a round, e.g published by a simulation for a view to draw
+# It holds copies of the network's states, so it can be drawn while the simulation keeps running
+class NetworkFrame:
+	def __init__(self, rnd, state_counts, states, converged=False, max_rounds_reached=False, recorded=False, finished=False):
+		# state_counts is a dictionary of state -> count, states is the state of every node shown
+		# recorded is whether the frame was read from the trajectory of a network, rather than its current round
+		# finished is whether the network will not change in later rounds, e.g a mean-field network at a fixed point
+		self.round = rnd
+		self.state_counts = state_counts
+		self.states = states
+		self.converged = converged
+		self.finished = finished
+		self.max_rounds_reached = max_rounds_reached
+		self.recorded = recorded
+
+	@classmethod
+	def from_network(cls, network, max_rounds=None, sample=None):
+		# The frame of the round that has just been run by a network
+		# sample is the indices of the nodes to keep the states of (see sample_nodes), or None for every node
+		# Networks that do not store their nodes keep a representative sample of the same size instead
+		rnd = network.round - 1
+		state_counts = network.get_state_counts()
+		if network.stores_states:
+			states = network.get_state_array(sample)
+		else:
+			states = representative_states(state_counts, network.get_number_of_nodes() if sample is None else len(sample))
+
+		return cls(rnd, state_counts, states, network.has_converged(), max_rounds is not None and rnd >= max_rounds, finished=network.is_finished())
+
+	@classmethod
+	def from_trajectory(cls, data, rnd, max_rounds=None, sample=None):
+		# The frame of a round recorded in a trajectory, with the same sample as from_network
+		state_counts = data.get_counts(rnd)
+		if data.needs_states:
+			states = data.get_states(rnd)
+			states = states.copy() if sample is None else states[sample]
+		else:
+			states = representative_states(state_counts, sum(state_counts.values()) if sample is None else len(sample))
+
+		return cls(rnd, state_counts, states, max_rounds_reached=max_rounds is not None and rnd >= max_rounds, recorded=True)
+
+
+def counts_to_array(state_counts):
+	# Converts a dictionary of state -> count to an array of the number of nodes in each state
+	counts = np.zeros(max(state_counts, default=-1) + 1, dtype=np.int64)
+	counts[list(state_counts)] = list(state_counts.values())
+	return counts
+
+
+def colour_table(state_colours, number_of_states):
+	# An array of the RGBA colour of each state, given a dictionary of state -> colour
+	colours = np.tile(to_rgba(UNKNOWN_STATE_COLOUR), (number_of_states, 1))
+	for state, colour in state_colours.items():
+		if state < number_of_states:
+			colours[state] = to_rgba(colour)
+
+	return colours
+
+
+# Draws every node and edge of a network, with each node coloured by its state
+# The layout and edges are computed and drawn once, each round then only changes the colours of the nodes
+# whose state changed and redraws the nodes
+class NetworkView:
+	def __init__(self, figure, topology, state_colours, frame, layout_seed=1):
+		# state_colours is a dictionary of state -> colour, frame holds the state of every node
+		# The layout is fixed by layout_seed, so the network is drawn the same way each time
+		import networkx as nx
+
+		self.figure = figure
+		self.state_colours = state_colours
+
+		graph = topology.to_networkx()
+		layout = nx.spring_layout(graph, seed=layout_seed)
+		self.positions = np.array([layout[node] for node in range(topology.get_number_of_nodes())]).reshape(-1, 2)
+
+		self.axes = figure.add_axes((0, 0, 1, 1))
+		self.axes.set_axis_off()
+
+		edges = np.array(list(graph.edges()), dtype=np.int64).reshape(-1, 2)
+		self.axes.add_collection(LineCollection(self.positions[edges], colors=EDGE_COLOUR, linewidths=EDGE_WIDTH, zorder=1))
+
+		# Nodes are animated, so they are left out of the background and drawn over it each round
+		self.states = np.array(frame.states)
+		self.colours = colour_table(state_colours, int(self.states.max(initial=0)) + 1)
+		self.face_colours = self.colours[self.states]
+		self.nodes = self.axes.scatter(self.positions[:, 0], self.positions[:, 1], s=NODE_SIZE, c=self.face_colours, zorder=2, animated=True)
+
+		self.axes.update_datalim(self.positions)
+		self.axes.autoscale_view()
+		self.axes.margins(0.05)
+
+		# The figure without the nodes, saved whenever the whole figure is drawn (e.g when the window is resized)
+		self.background = None
+		self.draw_connection = figure.canvas.mpl_connect("draw_event", self.on_draw)
+
+	def remove(self):
+		# Stops the view from drawing on its figure, e.g before another view replaces it
+		self.figure.canvas.mpl_disconnect(self.draw_connection)
+
+	def update(self, frame):
+		# Recolours the nodes whose state has changed, returns whether the view needs redrawing
+		states = frame.states
+		changed = np.flatnonzero(states != self.states)
+		if len(changed) == 0:
+			return False
+
+		new_states = states[changed]
+		if new_states.max() >= len(self.colours):
+			self.colours = colour_table(self.state_colours, int(new_states.max()) + 1)
+
+		self.states[changed] = new_states
+		self.face_colours[changed] = self.colours[new_states]
+		self.nodes.set_facecolors(self.face_colours)
+		return True
+
+	def on_draw(self, event):
+		# Saves the background after the whole figure is drawn, then draws the nodes over it
+		canvas = self.figure.canvas
+		self.background = canvas.copy_from_bbox(self.figure.bbox)
+		self.axes.draw_artist(self.nodes)
+
+	def redraw(self):
+		# Redraws only the nodes over the saved background
+		canvas = self.figure.canvas
+		if self.background is None:
+			canvas.draw()
+			return
+
+		canvas.restore_region(self.background)
+		self.axes.draw_artist(self.nodes)
+		canvas.blit(self.figure.bbox)
+
+
+# Draws the number of nodes in each state over time as a stacked area, and the states of a sample of nodes
+# without edges, for networks too large to draw node by node
+class AggregateView:
+	def __init__(self, figure, state_colours, frame, data, layout_seed=1):
+		# state_colours is a dictionary of state -> colour, frame holds the states of the sampled nodes
+		# data is the trajectory of the network, the state counts of every round up to the frame are read from it
+		self.figure = figure
+		self.state_colours = state_colours
+		self.data = data
+		self.nodes = sum(frame.state_counts.values())
+
+		self.counts_axes = figure.add_axes((0.1, 0.12, 0.54, 0.78))
+		self.counts_axes.set_xlabel("Round number")
+		self.counts_axes.set_ylabel("Node count")
+		self.counts_axes.set_title("States in network")
+		self.stack = []
+		self.round = frame.round
+
+		# The sampled nodes are placed on a grid in a fixed random order, so nodes in the same state are spread out
+		self.sample_axes = figure.add_axes((0.68, 0.05, 0.3, 0.85))
+		self.sample_axes.set_axis_off()
+		self.sample_axes.set_aspect("equal")
+		self.sample_axes.set_title(f"Sample of {len(frame.states)} nodes")
+
+		columns = max(1, int(np.ceil(np.sqrt(len(frame.states)))))
+		order = np.random.default_rng(layout_seed).permutation(len(frame.states))
+		positions = np.stack([order % columns, -(order // columns)], axis=1)
+
+		self.states = np.array(frame.states)
+		self.colours = colour_table(state_colours, max(max(state_colours, default=0), int(self.states.max(initial=0))) + 1)
+		self.face_colours = self.colours[self.states]
+		self.sample = self.sample_axes.scatter(positions[:, 0], positions[:, 1], s=SAMPLE_NODE_SIZE, c=self.face_colours, marker="s")
+
+		self.draw_history()
+
+	def remove(self):
+		# Nothing is connected to the figure, the view is removed when the figure is cleared
+		pass
+
+	def update(self, frame):
+		# Moves the view to the round of the frame and recolours the sampled nodes whose state changed
+		# Returns whether the view needs redrawing
+		self.round = frame.round
+
+		changed = np.flatnonzero(frame.states != self.states)
+		if len(changed) > 0:
+			new_states = frame.states[changed]
+			if new_states.max() >= len(self.colours):
+				self.colours = colour_table(self.state_colours, int(new_states.max()) + 1)
+
+			self.states[changed] = new_states
+			self.face_colours[changed] = self.colours[new_states]
+			self.sample.set_facecolors(self.face_colours)
+
+		return True
+
+	def draw_history(self):
+		# Draws the stacked state counts up to the current round, long histories are drawn every few rounds
+		# (always including the current round)
+		for collection in self.stack:
+			collection.remove()
+
+		stride = int(np.ceil((self.round + 1) / AGGREGATE_HISTORY_POINTS))
+		rounds = list(range(0, self.round + 1, stride))
+		if rounds[-1] != self.round:
+			rounds.append(self.round)
+
+		history = stack_counts([counts_to_array(self.data.get_counts(rnd)) for rnd in rounds]).T
+		colours = colour_table(self.state_colours, len(history))
+		self.stack = self.counts_axes.stackplot(rounds, history, colors=colours)
+
+		self.counts_axes.set_xlim(0, max(self.round, 1))
+		self.counts_axes.set_ylim(0, max(self.nodes, 1))
+
+	def redraw(self):
+		self.draw_history()
+		self.figure.canvas.draw_idle()